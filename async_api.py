@@ -0,0 +1,753 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+async_api.py - An asyncio interface to the reader and the database.
+
+The rest of nfcCallsheet blocks: while the handler waits on the serial port,
+nothing else happens. This module offers the same operations as coroutines,
+so they can run inside an asyncio service alongside everything else:
+
+    * AsyncNfcSerialHandler reads the serial port without blocking, waking
+      only when the Arduino has sent something.
+    * AsyncCallsheetDatabase runs database calls on a small thread pool.
+    * populateRecord resolves scanned tag data into a CallsheetRecord.
+    * scanPipeline ties them together. Tag N+1 is being scanned while tag N
+      is looked up and published.
+
+    async def main():
+        handler = await AsyncNfcSerialHandler.open()
+        await scanPipeline(handler, publish=print)
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import inspect
+import struct
+import threading
+import time
+
+# local imports
+from . import framing
+from . import line_protocol
+from . import records
+from . import serial_connection
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+# Threads running database calls:
+DB_WORKERS = 4
+# Scans held between the scanner and the resolver before scanning waits:
+PIPELINE_DEPTH = 32
+# Where the serial port can't be watched for data, seconds between checks:
+POLL_INTERVAL = 0.01
+
+# The AsyncCallsheetDatabase used when none is given, made on first use so
+# that its threads are only started once:
+_DEFAULT_DB = None
+_DEFAULT_DB_LOCK = threading.Lock()
+
+
+__all__ = [
+    "populateRecord",
+    "scanPipeline",
+    "AsyncCallsheetDatabase",
+    "AsyncNfcSerialHandler",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def _defaultDatabase():
+    """Gets the AsyncCallsheetDatabase shared by calls not given one.
+
+    Returns:
+        AsyncCallsheetDatabase: The shared database.
+
+    """
+    global _DEFAULT_DB
+    with _DEFAULT_DB_LOCK:
+        if _DEFAULT_DB is None:
+            _DEFAULT_DB = AsyncCallsheetDatabase()
+        return _DEFAULT_DB
+
+
+def _timeoutPayload(timeout):
+    """Packs a timeout for a READ/WRITE_REQUEST.
+
+    Args:
+        timeout (float): Seconds the Arduino should wait for a tag, or None
+            to wait forever.
+
+    Returns:
+        bytes: The timeout in milliseconds, or nothing to wait forever.
+
+    """
+    if timeout is None:
+        return b""
+    return struct.pack(">I", max(1, int(timeout * 1000)))
+
+
+async def populateRecord(ndefData, db=None):
+    """Turns data read from a tag into a full record from the database.
+
+    This is the asynchronous counterpart of CallsheetRecord's
+    populateFromNdefData followed by populateFromDatabase.
+
+    Args:
+        ndefData (dict): The data read from the tag.
+
+        db (AsyncCallsheetDatabase): The database to look the record up in
+            (optional). Defaults to the shared database.
+
+    Returns:
+        records.CallsheetRecord: The record.
+
+    """
+    if db is None:
+        db = _defaultDatabase()
+    record = records.CallsheetRecord()
+    record.populateFromNdefData(ndefData)
+    recordData = await db.getByUuid(record['uuid'])
+    if recordData is None:
+        print("No record found for uuid '{}'".format(record['uuid']))
+    else:
+        record.update(recordData)
+    return record
+
+
+async def scanPipeline(handler, db=None, publish=None,
+                       debounce=serial_connection.DEFAULT_DEBOUNCE,
+                       depth=PIPELINE_DEPTH):
+    """Scans tags continuously, resolving and publishing each one.
+
+    Scanning and resolving run as separate tasks joined by a queue. The
+    next tag can be scanned while the last one is still being looked up.
+    This runs until it is cancelled, or until either side fails.
+
+    Args:
+        handler (AsyncNfcSerialHandler): The reader to scan with.
+
+        db (AsyncCallsheetDatabase): The database to resolve records from
+            (optional). Defaults to the shared database.
+
+        publish (callable): Called with each record and its ScanEvent
+            (optional). It may be a coroutine function.
+
+        debounce (float): Seconds within which a repeat of the same tag is
+            ignored.
+
+        depth (int): Scans that may wait to be resolved before scanning
+            waits too.
+
+    """
+    if db is None:
+        db = _defaultDatabase()
+    events = asyncio.Queue(maxsize=depth)
+
+    async def scanTags():
+        scanner = handler.scan(debounce=debounce)
+        try:
+            async for event in scanner:
+                await events.put(event)
+        finally:
+            await scanner.aclose()
+
+    async def resolveTags():
+        while True:
+            event = await events.get()
+            record = await populateRecord(event.ndefData, db)
+            if publish is not None:
+                result = publish(record, event)
+                if inspect.isawaitable(result):
+                    await result
+
+    tasks = [
+        asyncio.ensure_future(scanTags()),
+        asyncio.ensure_future(resolveTags()),
+        ]
+    try:
+        (done, _) = await asyncio.wait(
+            tasks,
+            return_when=asyncio.FIRST_EXCEPTION
+            )
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class AsyncCallsheetDatabase(object):
+    """The callsheet database, with its calls run off the event loop.
+
+    Args:
+        db (database.CallsheetDatabase): The database to wrap (optional).
+            Defaults to the shared database.
+
+        executor (concurrent.futures.Executor): Where to run the calls
+            (optional). Defaults to a pool of DB_WORKERS threads.
+
+    """
+    def __init__(self, db=None, executor=None):
+        self.db = db or records.CALLSHEET_DB
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(
+            max_workers=DB_WORKERS,
+            thread_name_prefix="callsheet-db",
+            )
+
+    async def _call(self, method, *args):
+        """Runs one database method on the executor.
+
+        Args:
+            method (callable): The CallsheetDatabase method.
+
+            *args: Its arguments.
+
+        Returns:
+            object: Whatever the method returns.
+
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(method, *args)
+            )
+
+    async def getByUuid(self, recordUuid):
+        """See CallsheetDatabase.getByUuid."""
+        return await self._call(self.db.getByUuid, recordUuid)
+
+    async def getByName(self, name):
+        """See CallsheetDatabase.getByName."""
+        return await self._call(self.db.getByName, name)
+
+    async def getByTagId(self, nfcTagId):
+        """See CallsheetDatabase.getByTagId."""
+        return await self._call(self.db.getByTagId, nfcTagId)
+
+    async def create(self, callsheetRecord):
+        """See CallsheetDatabase.create."""
+        return await self._call(self.db.create, callsheetRecord)
+
+    async def update(self, callsheetRecord):
+        """See CallsheetDatabase.update."""
+        return await self._call(self.db.update, callsheetRecord)
+
+    async def upsert(self, callsheetRecord):
+        """See CallsheetDatabase.upsert."""
+        return await self._call(self.db.upsert, callsheetRecord)
+
+    def close(self):
+        """Waits for running calls to finish, then stops the threads."""
+        self.executor.shutdown(wait=True)
+
+
+class AsyncNfcSerialHandler(object):
+    """Reads and writes NFC tags without blocking the event loop.
+
+    Each operation takes the reader for its whole length, as the blocking
+    NfcSerialHandler does, so the two can share a reader safely.
+
+    Args:
+        link (serial_connection.ReaderConnection): The reader to talk to.
+            Use open() to connect to one without blocking.
+
+    """
+    def __init__(self, link):
+        self.link = link
+        self.connection = link.connection
+        # For its handling of stray frames:
+        self._handler = serial_connection.NfcSerialHandler(link=link)
+        self._lock = None
+
+    @classmethod
+    async def open(cls, comPort=None,
+                   baudrate=serial_connection.NEGOTIATED_BAUDRATE):
+        """Connects to the reader on a worker thread.
+
+        Args:
+            comPort (str): The port the reader is on (optional). By default
+                it is searched for.
+
+            baudrate (int): The fastest rate to negotiate up to (optional).
+
+        Returns:
+            AsyncNfcSerialHandler: A handler for the shared reader.
+
+        """
+        loop = asyncio.get_running_loop()
+        link = await loop.run_in_executor(
+            None,
+            functools.partial(
+                serial_connection.SerialConnection,
+                comPort=comPort,
+                baudrate=baudrate
+                )
+            )
+        return cls(link)
+
+    @contextlib.asynccontextmanager
+    async def _holdingReader(self):
+        """Takes the reader for one operation.
+
+        The asyncio lock keeps coroutines on this loop out of each other's
+        way; the reader's own lock keeps out other threads.
+
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while not self.link.lock.acquire(blocking=False):
+                await asyncio.sleep(serial_connection.STOP_POLL)
+            try:
+                yield
+            finally:
+                self.link.lock.release()
+
+    async def _readable(self):
+        """Waits until the serial port has data to read."""
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        def wake():
+            if not readable.done():
+                readable.set_result(None)
+
+        try:
+            fileno = self.connection.fileno()
+            loop.add_reader(fileno, wake)
+        except (AttributeError, NotImplementedError):
+            # No pollable file descriptor here (Windows), so poll instead.
+            await asyncio.sleep(POLL_INTERVAL)
+            return
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fileno)
+
+    async def _receive(self):
+        """Waits for bytes from the Arduino.
+
+        Returns:
+            bytes: Everything that has arrived so far.
+
+        """
+        while True:
+            waiting = self.connection.in_waiting
+            if waiting:
+                return self.connection.read(waiting)
+            await self._readable()
+
+    async def readFrame(self):
+        """Waits for the next binary frame from the Arduino.
+
+        Returns:
+            framing.Frame: The frame.
+
+        """
+        while True:
+            frame = self.link.bufferedFrame()
+            if frame is not None:
+                return frame
+            stall = self.link.parser.stallDeadline()
+            if stall is None:
+                self.link.feed(await self._receive())
+                continue
+            # A partial frame is held; if the rest doesn't come in time, the
+            # parser gives up on it when fed again.
+            try:
+                data = await asyncio.wait_for(
+                    self._receive(),
+                    max(0, stall - time.monotonic())
+                    )
+            except asyncio.TimeoutError:
+                data = b""
+            self.link.feed(data)
+
+    async def _readLine(self):
+        """Waits for the next line of text from the Arduino.
+
+        Returns:
+            line_protocol.Line: The line.
+
+        """
+        while True:
+            line = self.link.bufferedLine()
+            if line is not None:
+                return line
+            self.link.feedText(await self._receive())
+
+    async def _waitForFrame(self, *msgTypes):
+        """Waits for a frame of one of the given types, handling others.
+
+        Args:
+            *msgTypes: The framing.MSG_* types to wait for.
+
+        Returns:
+            framing.Frame: The first frame of one of those types.
+
+        """
+        while True:
+            frame = await self.readFrame()
+            if frame.msgType in msgTypes:
+                return frame
+            # pylint: disable=protected-access
+            self._handler._handleUnexpectedFrame(frame)
+
+    async def _waitForSignal(self, transmissionType):
+        """Waits for an "nfc2py:" signal of one type.
+
+        Other lines go to the reader's text sink.
+
+        Args:
+            transmissionType (str): The transmission type, such as "01".
+
+        """
+        while True:
+            line = await self._readLine()
+            if not line.isSignal():
+                if line.kind != line_protocol.LINE_BLANK:
+                    self.link.textSink.write(line.text)
+                continue
+            print("--> Signal Received")
+            if line.value == transmissionType:
+                return
+            msg = "Unexpected Transmission Type: '{}'"
+            print(msg.format(line.value))
+
+    async def _cancelRequest(self, *doneTypes):
+        """Tells the Arduino to stop waiting for a tag, and waits for it to.
+
+        Args:
+            *doneTypes: The framing.MSG_* types that end the request.
+
+        Returns:
+            framing.Frame: The frame that ended the request, or None if the
+                Arduino never confirmed.
+
+        """
+        self.link.sendFrame(framing.MSG_CANCEL)
+        try:
+            return await asyncio.wait_for(
+                self._waitForFrame(*doneTypes),
+                serial_connection.HANDSHAKE_TIMEOUT
+                )
+        except asyncio.TimeoutError:
+            print("WARNING: Reader did not confirm the cancel.")
+            return None
+
+    async def _collectFramedTag(self):
+        """Collects the frames describing one tag, up to the end of the read.
+
+        Returns:
+            dict: The ndef data, or None if no tag was read.
+
+        """
+        ndefData = {}
+        while True:
+            frame = await self._waitForFrame(
+                framing.MSG_TAG_UID,
+                framing.MSG_NDEF_RECORD,
+                framing.MSG_READ_DONE
+                )
+            if frame.msgType == framing.MSG_TAG_UID:
+                print("--> receiving ndef data")
+                ndefData['uid'] = framing.formatUid(frame.payload)
+            elif frame.msgType == framing.MSG_NDEF_RECORD:
+                serial_connection.parseNdefPayload(
+                    frame.payload.decode('latin-1'),
+                    ndefData
+                    )
+            else:
+                break
+        if 'uid' not in ndefData:
+            print("--> No tag was read.")
+            return None
+        print("--> Done receiving ndef data.")
+        return ndefData
+
+    async def _collectNdefData(self):
+        """Collects one text protocol tag transmission.
+
+        Returns:
+            dict: The ndef data.
+
+        """
+        await self._waitForSignal(line_protocol.SIGNAL_TAG_START)
+        print("--> receiving ndef data")
+        ndefData = {}
+        while not serial_connection.applyNdefLine(await self._readLine(),
+                                                  ndefData,
+                                                  self.link.textSink):
+            pass
+        return ndefData
+
+    async def readTag(self, timeout=None):
+        """Waits for a tag to be read, without blocking the event loop.
+
+        Cancelling the coroutine cancels the read on the Arduino too.
+
+        Args:
+            timeout (float): Seconds to wait for a tag (optional). By default
+                this waits forever.
+
+        Returns:
+            dict: The ndef data, or None if no tag was read in time.
+
+        """
+        print("-> Listening for NDEF data.")
+        async with self._holdingReader():
+            if self.link.protocol != serial_connection.PROTOCOL_BINARY:
+                self.connection.write(b":read:")
+                try:
+                    return await asyncio.wait_for(
+                        self._collectNdefData(),
+                        timeout
+                        )
+                except asyncio.TimeoutError:
+                    # The original firmware can't be told to stop waiting.
+                    return None
+            self.link.sendFrame(
+                framing.MSG_READ_REQUEST,
+                _timeoutPayload(timeout)
+                )
+            try:
+                return await asyncio.wait_for(
+                    self._collectFramedTag(),
+                    timeout
+                    )
+            except asyncio.TimeoutError:
+                await self._cancelRequest(framing.MSG_READ_DONE)
+                return None
+            except asyncio.CancelledError:
+                await self._cancelRequest(framing.MSG_READ_DONE)
+                raise
+
+    async def _writePayloadFramed(self, recordUuid):
+        """Sends the payload once the Arduino has asked for it.
+
+        Args:
+            recordUuid (str): The record ID to write to the tag.
+
+        Returns:
+            bool: True once the tag is written.
+
+        Raises:
+            framing.ProtocolError: if the write failed or never finished.
+
+        """
+        print("<-- writing ndef data")
+        print("  {}".format(recordUuid))
+        self.link.sendFrame(
+            framing.MSG_WRITE_PAYLOAD,
+            recordUuid.encode('ascii')
+            )
+        writeStart = time.perf_counter()
+        try:
+            frame = await asyncio.wait_for(
+                self._waitForFrame(framing.MSG_WRITE_DONE),
+                serial_connection.WRITE_TIMEOUT
+                )
+        except asyncio.TimeoutError:
+            raise framing.ProtocolError(
+                "Timed out waiting for the tag write to finish."
+                )
+        if frame.payload[:1] != bytes([framing.WRITE_OK]):
+            raise framing.ProtocolError("Tag write failed.")
+        print("DONE: You may remove the tag from the reader.")
+        elapsed = time.perf_counter() - writeStart
+        print("Tag written in {:.0f} ms.".format(elapsed * 1000))
+        return True
+
+    async def _writeTagFramed(self, recordUuid, timeout):
+        """Requests a tag write in binary mode.
+
+        Args:
+            recordUuid (str): The record ID to write to the tag.
+
+            timeout (float): Seconds to wait for a tag, or None.
+
+        Returns:
+            bool: True if the tag was written, False if no tag was presented.
+
+        """
+        self.link.sendFrame(
+            framing.MSG_WRITE_REQUEST,
+            _timeoutPayload(timeout)
+            )
+        waitTypes = (framing.MSG_READY_FOR_PAYLOAD, framing.MSG_WRITE_DONE)
+        try:
+            frame = await asyncio.wait_for(
+                self._waitForFrame(*waitTypes),
+                timeout
+                )
+        except asyncio.TimeoutError:
+            frame = await self._cancelRequest(*waitTypes)
+        except asyncio.CancelledError:
+            frame = await self._cancelRequest(*waitTypes)
+            if frame is not None and \
+                    frame.msgType == framing.MSG_READY_FOR_PAYLOAD:
+                # Too late to stop; finish the write before giving up.
+                await self._writePayloadFramed(recordUuid)
+            raise
+        if frame is None:
+            return False
+        if frame.msgType == framing.MSG_WRITE_DONE:
+            if frame.payload[:1] == bytes([framing.WRITE_NO_TAG]):
+                print("No tag was presented; nothing was written.")
+                return False
+            raise framing.ProtocolError("Tag write failed.")
+        return await self._writePayloadFramed(recordUuid)
+
+    async def writeTag(self, recordUuid, timeout=None):
+        """Writes a record's uuid to the next tag presented.
+
+        Args:
+            recordUuid (str): The record ID to write to the tag.
+
+            timeout (float): Seconds to wait for a tag (optional). By default
+                this waits forever.
+
+        Returns:
+            bool: True if the tag was written, False if no tag was presented.
+
+        Raises:
+            framing.ProtocolError: if the write failed or never finished.
+
+        """
+        async with self._holdingReader():
+            if self.link.protocol == serial_connection.PROTOCOL_BINARY:
+                return await self._writeTagFramed(recordUuid, timeout)
+            self.connection.write(b":new:")
+            try:
+                await asyncio.wait_for(
+                    self._waitForSignal(
+                        line_protocol.SIGNAL_READY_FOR_PAYLOAD),
+                    timeout
+                    )
+            except asyncio.TimeoutError:
+                return False
+            print("<-- writing ndef data")
+            print("  {}".format(recordUuid))
+            self.connection.write(
+                ("uuid:{}$".format(recordUuid)).encode('ascii')
+                )
+            try:
+                await asyncio.wait_for(
+                    self._waitForSignal(line_protocol.SIGNAL_DONE),
+                    serial_connection.WRITE_TIMEOUT
+                    )
+            except asyncio.TimeoutError:
+                raise framing.ProtocolError(
+                    "Timed out waiting for the tag write to finish."
+                    )
+            print("DONE: You may remove the tag from the reader.")
+            return True
+
+    async def _stopScanning(self):
+        """Takes the Arduino out of scan mode, and waits for it to agree."""
+        if self.link.protocol == serial_connection.PROTOCOL_BINARY:
+            self.link.sendFrame(framing.MSG_SCAN_STOP)
+
+            async def stopped():
+                while True:
+                    frame = await self.readFrame()
+                    if (frame.msgType == framing.MSG_SCAN_ACK and
+                            frame.payload == b"\x00"):
+                        return
+        else:
+            self.connection.write(b":stop:")
+
+            async def stopped():
+                while not (await self._readLine()).isSignal(
+                        line_protocol.SIGNAL_SCAN_STOPPED):
+                    pass
+        try:
+            await asyncio.wait_for(
+                stopped(),
+                serial_connection.HANDSHAKE_TIMEOUT
+                )
+        except asyncio.TimeoutError:
+            print("WARNING: Reader did not confirm end of scan.")
+
+    async def _nextScannedTag(self):
+        """Waits for the next tag reported by the Arduino in scan mode.
+
+        Returns:
+            dict: The ndef data (data from the NFC tag) defining a record.
+
+        """
+        if self.link.protocol != serial_connection.PROTOCOL_BINARY:
+            return await self._collectNdefData()
+        while True:
+            frame = await self._waitForFrame(
+                framing.MSG_TAG_UID,
+                framing.MSG_SCAN_ACK
+                )
+            if frame.msgType == framing.MSG_TAG_UID:
+                break
+        # Put it back for the collector, which starts at the UID
+        self.link.pushFrame(frame)
+        return await self._collectFramedTag()
+
+    async def scan(self, debounce=serial_connection.DEFAULT_DEBOUNCE):
+        """Scans tags continuously, yielding each one as it is tapped.
+
+        Scanning stops when the generator is closed, which should be done
+        explicitly with aclose() so that the Arduino is taken out of scan
+        mode straight away.
+
+        Args:
+            debounce (float): Seconds within which a repeat of the same tag
+                is ignored.
+
+        Yields:
+            serial_connection.ScanEvent: One event per tag scanned.
+
+        """
+        print("-> Scanning continuously for NDEF data.")
+        lastSeen = {}
+        async with self._holdingReader():
+            if self.link.protocol == serial_connection.PROTOCOL_BINARY:
+                self.link.sendFrame(framing.MSG_SCAN_START)
+            else:
+                self.connection.write(b":scan:")
+            try:
+                while True:
+                    ndefData = await self._nextScannedTag()
+                    uid = ndefData.get('uid') if ndefData else None
+                    if uid is None:
+                        continue
+                    now = time.monotonic()
+                    if now - lastSeen.get(uid, -debounce) < debounce:
+                        lastSeen[uid] = now
+                        continue
+                    lastSeen[uid] = now
+                    yield serial_connection.ScanEvent(
+                        ndefData,
+                        deviceId=self.link.deviceId,
+                        readerId=self.link.readerId,
+                        )
+            finally:
+                await self._stopScanning()
@@ -0,0 +1,649 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+benchmark.py - End-to-end timings, run against a simulated reader.
+
+Measures the paths a stage operator waits on, with no hardware attached:
+
+    scanToRecord    CallsheetCmdlineApp.readTag, from the read request to
+                    the record resolved from the database
+    tagWrite        CallsheetRecord.writeToTag, from the request to the
+                    reader confirming the write
+    dbLookup        CallsheetDatabase.getByUuid, uncached
+    dbLookupCached  CallsheetDatabase.getByUuid, from the record cache
+    catalogImport   catalog.importCatalog of a generated CSV, per record
+    replay          replay.Replayer of a capture file, at full speed, if
+                    one is given with -replay
+
+Each run works on a scratch database and a simulator.SimulatedReader. The
+reader benchmarks run once per protocol the simulator speaks, named for it,
+such as "scanToRecord.legacy" and "tagWrite.binary"; -protocol picks one.
+The results can be saved to JSON and compared against an earlier run:
+
+    python -m nfcCallsheet.benchmark -out before.json
+    python -m nfcCallsheet.benchmark -compare before.json
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import contextlib
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# local imports
+from . import capture
+from . import catalog
+from . import database
+from . import diagnostics
+from . import main
+from . import records
+from . import replay
+from . import scheduler
+from . import serial_connection
+from . import shellscript_base
+from . import simulator
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+# Version of the results file layout:
+RESULTS_VERSION = 1
+DEFAULT_ROUNDS = 50
+DEFAULT_DB_RECORDS = 5000
+DEFAULT_TAGS = 20
+# Changes smaller than this fraction are reported as noise by compare:
+NOISE_THRESHOLD = 0.05
+# The protocols the reader benchmarks run against, unless told otherwise:
+PROTOCOLS = (
+    serial_connection.PROTOCOL_LEGACY,
+    serial_connection.PROTOCOL_BINARY,
+)
+
+
+__all__ = [
+    "compareResults",
+    "loadResults",
+    "runBenchmarks",
+    "saveResults",
+    "BenchmarkApp",
+    "Timings",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def _percentile(ordered, fraction):
+    """Picks a percentile from sorted samples, by nearest rank.
+
+    Args:
+        ordered (list): The samples, sorted.
+
+        fraction (float): The percentile, from 0 to 1.
+
+    Returns:
+        float: The sample at that percentile.
+
+    """
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Context manager sending stdout nowhere, for the chatty code paths."""
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+@contextlib.contextmanager
+def _benchEnvironment(db, reader):
+    """Points the shared database and scheduler at the benchmark's own.
+
+    The reader gets a scheduler of its own, so each reader benchmarked talks
+    to its own port, whatever was made before.
+
+    Args:
+        db (database.CallsheetDatabase): The scratch database.
+
+        reader (simulator.SimulatedReader): The running simulated reader.
+
+    Yields:
+        serial_connection.ReaderConnection: The connection to the reader.
+
+    """
+    previousDb = records.CALLSHEET_DB
+    with _quiet():
+        link = reader.connect()
+        benchScheduler = scheduler.CommandScheduler(link=link)
+    previousScheduler = scheduler.setScheduler(benchScheduler)
+    records.CALLSHEET_DB = db
+    try:
+        yield link
+    finally:
+        records.CALLSHEET_DB = previousDb
+        scheduler.setScheduler(previousScheduler)
+        benchScheduler.shutdown()
+        link.close()
+
+
+def _makeRecords(count, seed=0):
+    """Makes records for a scratch database.
+
+    Args:
+        count (int): The number of records.
+
+        seed (int): Seeds the field values (optional).
+
+    Returns:
+        list: The records, as dicts.
+
+    """
+    rand = random.Random(seed)
+    rows = []
+    for index in range(count):
+        rows.append({
+            "uuid": "{:05x}".format(index),
+            "name": "prop{}".format(index),
+            "nfcTagId": "",
+            "recordType": rand.choice(("weapon", "rigid", "set")),
+            "scale": 1,
+            "location": records.DEFAULT_LOCATION,
+            "created": "2019-05-01 14:03:22",
+        })
+    return rows
+
+
+def _makeApp():
+    """Makes the commandline app, as if it were run with no arguments.
+
+    Returns:
+        main.CallsheetCmdlineApp: The app.
+
+    """
+    argv = sys.argv
+    sys.argv = [argv[0]]
+    try:
+        return main.CallsheetCmdlineApp()
+    finally:
+        sys.argv = argv
+
+
+def benchScanToRecord(tags, rounds):
+    """Times reading tags through the commandline app.
+
+    Args:
+        tags (list): The simulated tags on the reader.
+
+        rounds (int): The number of reads.
+
+    Returns:
+        Timings: The time of each read.
+
+    """
+    app = _makeApp()
+    timings = Timings("scanToRecord")
+    for _ in range(rounds):
+        with _quiet():
+            with timings.time():
+                app.readTag()
+    return timings
+
+
+def benchTagWrite(rounds):
+    """Times writing record uuids to tags.
+
+    Args:
+        rounds (int): The number of writes.
+
+    Returns:
+        Timings: The time of each write.
+
+    """
+    timings = Timings("tagWrite")
+    for index in range(rounds):
+        record = records.CallsheetRecord(uuid="{:05x}".format(index))
+        with _quiet():
+            with timings.time():
+                record.writeToTag()
+    return timings
+
+
+def benchDbLookups(location, uuids, rounds, cached):
+    """Times looking records up by uuid.
+
+    Args:
+        location (str): The path to the database file.
+
+        uuids (list): The uuids to look up, at random.
+
+        rounds (int): The number of lookups.
+
+        cached (bool): Look up through the record cache, warmed first.
+
+    Returns:
+        Timings: The time of each lookup.
+
+    """
+    cacheSize = len(uuids) if cached else 0
+    with _quiet():
+        db = database.CallsheetDatabase(location, cacheSize=cacheSize)
+    rand = random.Random(0)
+    sample = [rand.choice(uuids) for _ in range(rounds)]
+    if cached:
+        for recordUuid in uuids:
+            db.getByUuid(recordUuid)
+    timings = Timings("dbLookupCached" if cached else "dbLookup")
+    try:
+        for recordUuid in sample:
+            with timings.time():
+                db.getByUuid(recordUuid)
+    finally:
+        db.close()
+    return timings
+
+
+def benchCatalogImport(workDir, count):
+    """Times importing a catalog into an empty database.
+
+    Args:
+        workDir (str): A scratch directory.
+
+        count (int): The number of records in the catalog.
+
+    Returns:
+        Timings: One sample per record, each the mean time per record.
+
+    """
+    path = os.path.join(workDir, "catalog.csv")
+    rows = _makeRecords(count, seed=1)
+    with open(path, 'w', newline='') as catalogFile:
+        writer = csv.DictWriter(catalogFile, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    with _quiet():
+        db = database.CallsheetDatabase(
+            os.path.join(workDir, "import.db"),
+            cacheSize=0
+            )
+    timings = Timings("catalogImport")
+    try:
+        with _quiet():
+            start = time.perf_counter()
+            catalog.importCatalog(path, db=db, quiet=True)
+            elapsed = time.perf_counter() - start
+    finally:
+        db.close()
+    timings.samples.extend([elapsed / count] * count)
+    return timings
+
+
+def benchReplay(recorded, rounds):
+    """Times replaying a captured session at full speed.
+
+    Unlike the simulator, a replay involves no serial port or threads, so
+    this times the protocol code alone, on the same bytes every run.
+
+    Args:
+        recorded (capture.Capture): The capture.
+
+        rounds (int): The number of replays.
+
+    Returns:
+        Timings: The time of each replay.
+
+    """
+    timings = Timings("replay")
+    for _ in range(rounds):
+        with _quiet():
+            replayer = replay.Replayer(recorded)
+            try:
+                with timings.time():
+                    replayer.run()
+            finally:
+                replayer.link.close()
+    return timings
+
+
+def runBenchmarks(rounds=DEFAULT_ROUNDS, dbRecords=DEFAULT_DB_RECORDS,
+                  tagCount=DEFAULT_TAGS, capturePath=None, protocols=PROTOCOLS,
+                  **readerOptions):
+    """Runs every benchmark.
+
+    Args:
+        rounds (int): The number of samples per benchmark (optional).
+
+        dbRecords (int): The number of records in the scratch database, and
+            in the imported catalog (optional).
+
+        tagCount (int): The number of tags on the simulated reader
+            (optional).
+
+        capturePath (str): A capture file to time replaying (optional).
+
+        protocols (tuple): The protocols to simulate the reader speaking,
+            running the reader benchmarks against each (optional).
+
+        **readerOptions: Passed on to simulator.SimulatedReader, such as
+            tagLatency, baudrate or faults.
+
+    Returns:
+        dict: The results, as saved by saveResults.
+
+    """
+    results = {}
+    tags = simulator.makeTags(tagCount)
+    rows = _makeRecords(dbRecords)
+    for (row, tag) in zip(rows, tags):
+        # The tags carry the uuids of the first records:
+        tag.payloads = ["#" + row["uuid"]]
+        row["nfcTagId"] = tag.nfcTagId
+    with tempfile.TemporaryDirectory() as workDir:
+        location = os.path.join(workDir, "callsheet.db")
+        with _quiet():
+            db = database.CallsheetDatabase(location)
+            db.createMany(rows)
+        try:
+            for protocol in protocols:
+                with simulator.SimulatedReader(tags=tags, protocol=protocol,
+                                               **readerOptions) as reader:
+                    with _benchEnvironment(db, reader):
+                        for timings in (benchScanToRecord(tags, rounds),
+                                        benchTagWrite(rounds)):
+                            name = "{}.{}".format(timings.name, protocol)
+                            results[name] = timings.summary()
+        finally:
+            db.close()
+        uuids = [row["uuid"] for row in rows]
+        for cached in (False, True):
+            timings = benchDbLookups(location, uuids, rounds * 20, cached)
+            results[timings.name] = timings.summary()
+        timings = benchCatalogImport(workDir, dbRecords)
+        results[timings.name] = timings.summary()
+    if capturePath:
+        timings = benchReplay(capture.readCapture(capturePath), rounds)
+        results[timings.name] = timings.summary()
+    settings = {
+        "rounds": rounds,
+        "dbRecords": dbRecords,
+        "tagCount": tagCount,
+        "protocols": list(protocols),
+    }
+    if capturePath:
+        settings["capture"] = os.path.basename(capturePath)
+    for (key, value) in readerOptions.items():
+        if isinstance(value, (int, float, str, bool, type(None))):
+            settings[key] = value
+    return {
+        "version": RESULTS_VERSION,
+        "created": datetime.datetime.now().isoformat(timespec='seconds'),
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "settings": settings,
+        "results": results,
+    }
+
+
+def _revision():
+    """Finds the git revision of the code being benchmarked.
+
+    Returns:
+        str: The short revision, or None if it can't be found.
+
+    """
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('ascii').strip()
+
+
+def saveResults(results, path):
+    """Writes benchmark results to a JSON file.
+
+    Args:
+        results (dict): The results from runBenchmarks.
+
+        path (str): The file to write.
+
+    """
+    with open(path, 'w') as resultsFile:
+        json.dump(results, resultsFile, indent=2, sort_keys=True)
+
+
+def loadResults(path):
+    """Reads benchmark results saved by saveResults.
+
+    Args:
+        path (str): The file to read.
+
+    Returns:
+        dict: The results.
+
+    Raises:
+        ValueError: if the file is from a newer version of this software.
+
+    """
+    with open(path) as resultsFile:
+        results = json.load(resultsFile)
+    if results.get("version", 0) > RESULTS_VERSION:
+        raise ValueError("Results in {} are from a newer version.".format(
+            path))
+    return results
+
+
+def compareResults(before, after):
+    """Compares the median times of two benchmark runs.
+
+    Args:
+        before (dict): The earlier results.
+
+        after (dict): The later results.
+
+    Returns:
+        list: (name, median before, median after, change) tuples, the change
+            as a fraction of the earlier median. Benchmarks missing from
+            either run are left out.
+
+    """
+    rows = []
+    for (name, summary) in sorted(after["results"].items()):
+        previous = before["results"].get(name)
+        if previous is None or not previous["p50"]:
+            continue
+        change = (summary["p50"] - previous["p50"]) / previous["p50"]
+        rows.append((name, previous["p50"], summary["p50"], change))
+    return rows
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class Timings(object):
+    """The samples taken by one benchmark.
+
+    Args:
+        name (str): The benchmark's name.
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+
+    @contextlib.contextmanager
+    def time(self):
+        """Context manager adding the time the block took as a sample."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.append(time.perf_counter() - start)
+
+    def summary(self):
+        """Summarizes the samples.
+
+        Returns:
+            dict: The count, mean, p50, p95, p99 and max in seconds, and
+                the rate per second.
+
+        """
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"count": 0}
+        mean = sum(ordered) / len(ordered)
+        return {
+            "count": len(ordered),
+            "mean": mean,
+            "p50": _percentile(ordered, 0.50),
+            "p95": _percentile(ordered, 0.95),
+            "p99": _percentile(ordered, 0.99),
+            "max": ordered[-1],
+            "perSecond": 1.0 / mean if mean else None,
+        }
+
+
+class BenchmarkApp(diagnostics.DiagnosticsMixin,
+                   shellscript_base.BaseShellScript):
+    """Runs the benchmarks from the commandline."""
+    def registerArgs(self):
+        """Registers the commandline arguments for this tool."""
+        self.parser.add_argument(
+            '-rounds',
+            help='samples per benchmark (default {})'.format(DEFAULT_ROUNDS),
+            type=int,
+            default=DEFAULT_ROUNDS,
+            )
+
+        self.parser.add_argument(
+            '-records',
+            help='records in the scratch database (default {})'.format(
+                DEFAULT_DB_RECORDS),
+            type=int,
+            default=DEFAULT_DB_RECORDS,
+            )
+
+        self.parser.add_argument(
+            '-tagLatency',
+            help='seconds for the simulated reader to find a tag '
+                 '(default {})'.format(simulator.DEFAULT_TAG_LATENCY),
+            type=float,
+            default=simulator.DEFAULT_TAG_LATENCY,
+            )
+
+        self.parser.add_argument(
+            '-baud',
+            help='serial rate to simulate; 0 for full speed (default '
+                 '{})'.format(serial_connection.DEFAULT_BAUDRATE),
+            type=int,
+            default=serial_connection.DEFAULT_BAUDRATE,
+            )
+
+        self.parser.add_argument(
+            '-protocol',
+            help='the protocol the simulated reader speaks (default both)',
+            choices=PROTOCOLS + ('both',),
+            default='both',
+            )
+
+        self.parser.add_argument(
+            '-replay',
+            help='also time replaying this capture file',
+            metavar='PATH',
+            )
+
+        self.parser.add_argument(
+            '-out',
+            help='save the results to this JSON file',
+            metavar='PATH',
+            )
+
+        self.parser.add_argument(
+            '-compare',
+            help='compare the results against an earlier JSON file',
+            metavar='PATH',
+            )
+
+    def run(self):
+        """Runs the benchmarks, then saves and compares the results."""
+        results = runBenchmarks(
+            rounds=self.args.rounds,
+            dbRecords=self.args.records,
+            tagLatency=self.args.tagLatency,
+            baudrate=self.args.baud or None,
+            capturePath=self.args.replay,
+            protocols=self._protocols(),
+            )
+        print("{:<22}{:>10}{:>10}{:>10}{:>12}".format(
+            "benchmark", "p50 ms", "p95 ms", "p99 ms", "per sec"))
+        for (name, summary) in sorted(results["results"].items()):
+            print("{:<22}{:>10.3f}{:>10.3f}{:>10.3f}{:>12.1f}".format(
+                name,
+                summary["p50"] * 1000,
+                summary["p95"] * 1000,
+                summary["p99"] * 1000,
+                summary["perSecond"],
+                ))
+        if self.args.out:
+            saveResults(results, self.args.out)
+            print("Results saved to {}".format(self.args.out))
+        if self.args.compare:
+            before = loadResults(self.args.compare)
+            print("\nAgainst {} ({}):".format(
+                self.args.compare,
+                before.get("revision") or "unknown revision"
+                ))
+            for (name, previous, current, change) in compareResults(
+                    before, results):
+                note = ""
+                if abs(change) >= NOISE_THRESHOLD:
+                    note = "slower" if change > 0 else "faster"
+                print("{:<22}{:>10.3f}{:>10.3f}{:>+9.1%}  {}".format(
+                    name,
+                    previous * 1000,
+                    current * 1000,
+                    change,
+                    note,
+                    ))
+
+    def _protocols(self):
+        """The protocols asked for with -protocol.
+
+        Returns:
+            tuple: The protocols to run the reader benchmarks against.
+
+        """
+        if self.args.protocol == 'both':
+            return PROTOCOLS
+        return (self.args.protocol,)
+
+
+###############################################################################
+# EXECUTE
+###############################################################################
+if __name__ == "__main__":
+    app = BenchmarkApp()
+    app.run()
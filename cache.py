@@ -0,0 +1,259 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+cache.py - An in-process cache of database records.
+
+During a shoot the same few hundred props get scanned over and over. Rather
+than going back to the database for each of those scans, recently seen records
+are held in memory, keyed by uuid, with least-recently-used eviction and an
+optional time-to-live.
+
+Records can also be found by name or by nfcTagId. Neither of those is unique
+in the database, so those keys only ever point at the record the database
+returned for that exact query.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import collections
+import threading
+import time
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+DEFAULT_MAX_SIZE = 1024
+
+
+__all__ = [
+    "RecordCache",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class RecordCache(object):
+    """A bounded, thread-safe LRU cache of records keyed by uuid.
+
+    Records are copied on the way in and on the way out, so callers are free
+    to modify what they are given.
+
+    Args:
+        maxSize (int): The most records held at once. Zero disables caching.
+
+        ttl (float): Seconds a record stays valid after being stored
+            (optional). By default records never expire.
+
+    """
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE, ttl=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # uuid -> (record, expiry time or None), least recently used first:
+        self._entries = collections.OrderedDict()
+        # (field, value) -> uuid, for lookups by a non-unique field:
+        self._aliases = {}
+        # uuid -> set of (field, value) aliases pointing at it:
+        self._aliasesByUuid = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, recordUuid):
+        """Finds a live entry and marks it as recently used.
+
+        Must be called with the lock held.
+
+        Args:
+            recordUuid (str): The uuid of the record to find.
+
+        Returns:
+            dict: The cached record, or None if absent or expired.
+
+        """
+        entry = self._entries.get(recordUuid)
+        if entry is None:
+            return None
+        (record, expires) = entry
+        if expires is not None and expires < time.monotonic():
+            self._discard(recordUuid)
+            return None
+        self._entries.move_to_end(recordUuid)
+        return record
+
+    def _discard(self, recordUuid):
+        """Drops a record and every alias pointing at it.
+
+        Must be called with the lock held.
+
+        Args:
+            recordUuid (str): The uuid of the record to drop.
+
+        """
+        self._entries.pop(recordUuid, None)
+        for alias in self._aliasesByUuid.pop(recordUuid, ()):
+            del self._aliases[alias]
+
+    def _addAlias(self, alias, recordUuid):
+        """Points a (field, value) alias at a record.
+
+        Must be called with the lock held.
+
+        Args:
+            alias (tuple): The (field, value) pair.
+
+            recordUuid (str): The uuid of the record it should point at.
+
+        """
+        oldUuid = self._aliases.get(alias)
+        if oldUuid is not None:
+            self._aliasesByUuid[oldUuid].discard(alias)
+        self._aliases[alias] = recordUuid
+        self._aliasesByUuid.setdefault(recordUuid, set()).add(alias)
+
+    def get(self, recordUuid):
+        """Fetches a record by its uuid.
+
+        Args:
+            recordUuid (str): The uuid of the record.
+
+        Returns:
+            dict: A copy of the cached record, or None on a miss.
+
+        """
+        with self._lock:
+            record = self._lookup(recordUuid)
+            if record is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(record)
+
+    def getBy(self, field, value):
+        """Fetches a record by a non-unique field, such as name or nfcTagId.
+
+        This only hits if the same query was answered earlier through put().
+
+        Args:
+            field (str): The name of the field that was queried.
+
+            value (object): The value that was queried for.
+
+        Returns:
+            dict: A copy of the cached record, or None on a miss.
+
+        """
+        with self._lock:
+            recordUuid = self._aliases.get((field, value))
+            record = None
+            if recordUuid is not None:
+                record = self._lookup(recordUuid)
+            if record is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(record)
+
+    def put(self, record, field=None):
+        """Stores a complete record, evicting the least recently used if full.
+
+        Args:
+            record (dict): The record to store. It must contain a uuid.
+
+            field (str): If this record answers a query by a non-unique field,
+                the name of that field (optional).
+
+        """
+        if not self.maxSize:
+            return
+        recordUuid = record['uuid']
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[recordUuid] = (dict(record), expires)
+            self._entries.move_to_end(recordUuid)
+            if field is not None:
+                self._addAlias((field, record[field]), recordUuid)
+            while len(self._entries) > self.maxSize:
+                (oldestUuid, _) = next(iter(self._entries.items()))
+                self._discard(oldestUuid)
+                self.evictions += 1
+
+    def merge(self, changes, recordUuid=None, staleFields=()):
+        """Writes changed fields through to a cached record.
+
+        If the record is not cached, nothing happens. Aliases for any of the
+        changed fields are dropped, since the record may no longer match them.
+
+        Args:
+            changes (dict): The changed fields.
+
+            recordUuid (str): The uuid of the record that changed (optional).
+                Defaults to the uuid in changes.
+
+            staleFields (iterable): Fields that the write changed to values
+                the caller doesn't know, to be dropped from the cached copy.
+
+        """
+        recordUuid = recordUuid or changes['uuid']
+        with self._lock:
+            record = self._lookup(recordUuid)
+            if record is None:
+                return
+            record.update(changes)
+            for field in staleFields:
+                record.pop(field, None)
+            aliases = self._aliasesByUuid.get(recordUuid, set())
+            for alias in [alias for alias in aliases if alias[0] in changes]:
+                aliases.discard(alias)
+                del self._aliases[alias]
+
+    def invalidate(self, recordUuid):
+        """Drops a record from the cache.
+
+        Args:
+            recordUuid (str): The uuid of the record to drop.
+
+        """
+        with self._lock:
+            self._discard(recordUuid)
+
+    def clear(self):
+        """Drops every record from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._aliases.clear()
+            self._aliasesByUuid.clear()
+
+    def stats(self):
+        """Reports how well the cache is doing.
+
+        Returns:
+            dict: The hit, miss and eviction counts, the current size, and the
+                hit rate.
+
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "hitRate": float(self.hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,296 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+callsheet_state.py - The current callsheet, sent on as changes.
+
+The capture software shouldn't have to reload the whole callsheet because
+one prop was scanned. A CallsheetState holds the props on the callsheet,
+keyed by uuid. Each scan, removal or update applied to it returns a diff
+that holds only what changed:
+
+    {
+        "sequence": 42,
+        "added": {"5e2d4": {"uuid": "5e2d4", "name": "Sword", ...}},
+        "removed": ["a91c0"],
+        "changed": {"77f3b": {"scale": 2}},
+    }
+
+Scanning a prop that is already on the callsheet, unchanged, produces no
+diff at all.
+
+Every diff carries the next sequence number. A consumer keeps its own copy,
+applies diffs in order with applyDiff(), and spots a missed diff by the gap
+in the sequence. It then starts again from a snapshot(), which holds every
+record along with the sequence number it is current as of.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import copy
+import threading
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+__all__ = [
+    "isEmptyDiff",
+    "CallsheetState",
+    "SequenceError",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def isEmptyDiff(diff):
+    """Reports whether a diff changes nothing.
+
+    Args:
+        diff (dict): The diff.
+
+    Returns:
+        bool: True if nothing was added, removed or changed.
+
+    """
+    return not (diff["added"] or diff["removed"] or diff["changed"])
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class SequenceError(Exception):
+    """Raised when a diff arrives out of order. Resync from a snapshot."""
+
+
+class CallsheetState(object):
+    """The props on the callsheet, keyed by uuid, and the diffs between.
+
+    Args:
+        listener (callable): Called with every non-empty diff, in order
+            (optional).
+
+    """
+    def __init__(self, listener=None):
+        self.listener = listener
+        self.records = {}
+        self.sequence = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, recordUuid):
+        return recordUuid in self.records
+
+    def _emit(self, added=None, removed=None, changed=None):
+        """Applies a set of changes and returns them as a diff.
+
+        Args:
+            added (dict): New records, keyed by uuid (optional).
+
+            removed (list): The uuids of records taken off (optional).
+
+            changed (dict): The fields that changed, keyed by uuid
+                (optional).
+
+        Returns:
+            dict: The diff, or None if there was nothing to change.
+
+        """
+        diff = {
+            "sequence": self.sequence + 1,
+            "added": added or {},
+            "removed": removed or [],
+            "changed": changed or {},
+        }
+        if isEmptyDiff(diff):
+            return None
+        self._applyChanges(diff)
+        self.sequence = diff["sequence"]
+        if self.listener is not None:
+            self.listener(diff)
+        return diff
+
+    def _applyChanges(self, diff):
+        """Applies the contents of a diff, without checking its sequence.
+
+        Args:
+            diff (dict): The diff.
+
+        """
+        for (recordUuid, record) in diff["added"].items():
+            self.records[recordUuid] = dict(record)
+        for recordUuid in diff["removed"]:
+            self.records.pop(recordUuid, None)
+        for (recordUuid, fields) in diff["changed"].items():
+            self.records[recordUuid].update(fields)
+
+    def _changedFields(self, recordUuid, record):
+        """Finds the fields of a record that differ from the stored copy.
+
+        Args:
+            recordUuid (str): The record's uuid.
+
+            record (dict): The new copy of the record.
+
+        Returns:
+            dict: The fields whose values differ, with their new values.
+
+        """
+        stored = self.records[recordUuid]
+        return dict(
+            (key, value) for (key, value) in record.items()
+            if key not in stored or stored[key] != value
+            )
+
+    def scan(self, record):
+        """Puts a scanned prop on the callsheet, or refreshes it.
+
+        Args:
+            record (dict): The resolved record.
+
+        Returns:
+            dict: The diff, or None if the prop was already on the callsheet
+                exactly as it is.
+
+        """
+        recordUuid = record['uuid']
+        with self._lock:
+            if recordUuid not in self.records:
+                return self._emit(added={recordUuid: dict(record)})
+            fields = self._changedFields(recordUuid, record)
+            return self._emit(changed={recordUuid: fields} if fields else {})
+
+    def remove(self, recordUuid):
+        """Takes a prop off the callsheet.
+
+        Args:
+            recordUuid (str): The prop's uuid.
+
+        Returns:
+            dict: The diff, or None if the prop wasn't on the callsheet.
+
+        """
+        with self._lock:
+            if recordUuid not in self.records:
+                return None
+            return self._emit(removed=[recordUuid])
+
+    def update(self, recordUuid, fields):
+        """Changes some fields of a prop already on the callsheet.
+
+        Args:
+            recordUuid (str): The prop's uuid.
+
+            fields (dict): The fields to change, with their new values.
+
+        Returns:
+            dict: The diff, or None if nothing actually changed.
+
+        Raises:
+            KeyError: if the prop isn't on the callsheet.
+
+        """
+        with self._lock:
+            if recordUuid not in self.records:
+                raise KeyError(recordUuid)
+            fields = self._changedFields(recordUuid, fields)
+            return self._emit(changed={recordUuid: fields} if fields else {})
+
+    def replace(self, newRecords):
+        """Makes the callsheet hold exactly the given props.
+
+        This is for a callsheet rebuilt for a new shoot. Props carried over
+        from the last shoot are not sent again unless they have changed.
+
+        Args:
+            newRecords (iterable): The records for the new callsheet.
+
+        Returns:
+            dict: The diff, or None if the callsheet was already exactly
+                this.
+
+        """
+        with self._lock:
+            added = {}
+            changed = {}
+            kept = set()
+            for record in newRecords:
+                recordUuid = record['uuid']
+                kept.add(recordUuid)
+                if recordUuid not in self.records:
+                    added[recordUuid] = dict(record)
+                    continue
+                fields = self._changedFields(recordUuid, record)
+                if fields:
+                    changed[recordUuid] = fields
+            removed = [
+                recordUuid for recordUuid in self.records
+                if recordUuid not in kept
+                ]
+            return self._emit(added=added, removed=removed, changed=changed)
+
+    def snapshot(self):
+        """Copies the whole callsheet, for a consumer that needs to resync.
+
+        Returns:
+            dict: The "sequence" the snapshot is current as of, and every
+                record on the callsheet, keyed by uuid, as "records".
+
+        """
+        with self._lock:
+            return {
+                "sequence": self.sequence,
+                "records": copy.deepcopy(self.records),
+            }
+
+    def loadSnapshot(self, snapshot):
+        """Replaces this copy of the callsheet with a snapshot.
+
+        Args:
+            snapshot (dict): A snapshot, as returned by snapshot().
+
+        """
+        with self._lock:
+            self.records = copy.deepcopy(snapshot["records"])
+            self.sequence = snapshot["sequence"]
+
+    def applyDiff(self, diff):
+        """Applies a diff received from another CallsheetState.
+
+        Diffs already applied, such as ones that came in alongside a newer
+        snapshot, are ignored.
+
+        Args:
+            diff (dict): The diff.
+
+        Returns:
+            bool: True if the diff was applied, False if it was already
+                reflected here.
+
+        Raises:
+            SequenceError: if a diff was missed. Load a fresh snapshot.
+
+        """
+        with self._lock:
+            if diff["sequence"] <= self.sequence:
+                return False
+            if diff["sequence"] != self.sequence + 1:
+                msg = "Expected diff {} but got {}; resync from a snapshot."
+                raise SequenceError(
+                    msg.format(self.sequence + 1, diff["sequence"])
+                    )
+            self._applyChanges(diff)
+            self.sequence = diff["sequence"]
+            return True
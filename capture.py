@@ -0,0 +1,295 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+capture.py - Records the serial traffic with a reader, for replay later.
+
+Reader problems on stage come and go. With a capture running, every byte
+sent to and received from the Arduino is written to a file as it happens,
+with when it happened, so that the session can be replayed afterwards
+(see replay.py) without the reader, or the problem, having to show up again.
+
+A capture file is a header followed by chunks:
+
+    "NFCCAP", version (1 byte)
+    length of the header info (2 bytes), header info (JSON)
+    chunk: direction (1 byte), microseconds since the previous chunk
+           (4 bytes), length (2 bytes), the bytes
+
+The header info says how the reader was talking when the capture started:
+its protocol, device ID, baud rate and reply to HELLO.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import json
+import struct
+import threading
+import time
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+CAPTURE_MAGIC = b"NFCCAP"
+CAPTURE_VERSION = 1
+
+# Which way a chunk went:
+DIRECTION_IN = 0   # From the Arduino
+DIRECTION_OUT = 1  # To the Arduino
+
+_INFO_LENGTH = struct.Struct(">H")
+_CHUNK = struct.Struct(">BIH")
+# The most bytes in one chunk; longer reads and writes are split:
+MAX_CHUNK = 0xFFFF
+# The longest gap between chunks that is kept (about 71 minutes); a longer
+# idle spell is shortened to this:
+MAX_GAP = 0xFFFFFFFF
+
+
+__all__ = [
+    "readCapture",
+    "Capture",
+    "CaptureFormatError",
+    "CaptureWriter",
+    "CapturingConnection",
+    "Chunk",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def readCapture(path):
+    """Reads a capture file.
+
+    Args:
+        path (str): The file to read.
+
+    Returns:
+        Capture: The capture.
+
+    Raises:
+        CaptureFormatError: if the file isn't a capture this can read.
+
+    """
+    with open(path, 'rb') as captureFile:
+        data = captureFile.read()
+    headerLength = len(CAPTURE_MAGIC) + 1 + _INFO_LENGTH.size
+    if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise CaptureFormatError("{} is not a capture file.".format(path))
+    if len(data) < headerLength:
+        raise CaptureFormatError("{} is truncated.".format(path))
+    version = data[len(CAPTURE_MAGIC)]
+    if version > CAPTURE_VERSION:
+        raise CaptureFormatError(
+            "{} is from a newer version (capture version {}).".format(
+                path, version)
+            )
+    (infoLength,) = _INFO_LENGTH.unpack_from(data, headerLength - 2)
+    offset = headerLength + infoLength
+    try:
+        info = json.loads(data[headerLength:offset].decode('utf-8'))
+    except ValueError as e:
+        raise CaptureFormatError("{} has a bad header: {}".format(path, e))
+    chunks = []
+    elapsed = 0
+    while offset < len(data):
+        if offset + _CHUNK.size > len(data):
+            # A capture cut off mid-write, such as by a crash, is read up to
+            # its last whole chunk.
+            break
+        (direction, gap, length) = _CHUNK.unpack_from(data, offset)
+        offset += _CHUNK.size
+        if offset + length > len(data):
+            break
+        elapsed += gap
+        chunks.append(Chunk(
+            direction,
+            elapsed / 1e6,
+            data[offset:offset + length]
+            ))
+        offset += length
+    return Capture(info, chunks)
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class CaptureFormatError(ValueError):
+    """Raised when a capture file can't be read."""
+
+
+class Chunk(object):
+    """One read from, or write to, the Arduino.
+
+    Args:
+        direction (int): DIRECTION_IN or DIRECTION_OUT.
+
+        seconds (float): When it happened, in seconds from the start of the
+            capture.
+
+        data (bytes): The bytes.
+
+    """
+    __slots__ = ("direction", "time", "data")
+
+    def __init__(self, direction, seconds, data):
+        self.direction = direction
+        self.time = seconds
+        self.data = data
+
+    def __repr__(self):
+        return "Chunk({}, {:.6f}, {!r})".format(
+            "in" if self.direction == DIRECTION_IN else "out",
+            self.time,
+            self.data
+            )
+
+
+class Capture(object):
+    """A capture read back from a file.
+
+    Args:
+        info (dict): How the reader was talking when the capture started.
+
+        chunks (list): The Chunks, in order.
+
+    """
+    def __init__(self, info, chunks):
+        self.info = info
+        self.chunks = chunks
+
+    def __len__(self):
+        return len(self.chunks)
+
+    @property
+    def duration(self):
+        """float: Seconds from the start of the capture to its last chunk."""
+        return self.chunks[-1].time if self.chunks else 0.0
+
+    def outbound(self):
+        """Joins up everything the host sent.
+
+        Returns:
+            bytes: The bytes.
+
+        """
+        return b"".join(
+            chunk.data for chunk in self.chunks
+            if chunk.direction == DIRECTION_OUT
+            )
+
+
+class CaptureWriter(object):
+    """Writes chunks to a capture file as they happen.
+
+    Each chunk is flushed straight away, so a capture survives the crash it
+    was running to catch.
+
+    Args:
+        path (str): The file to write. It is replaced if it exists.
+
+        info (dict): How the reader is talking, for the header (optional).
+            It must be JSON serializable.
+
+    """
+    def __init__(self, path, info=None):
+        self.path = path
+        self.bytesIn = 0
+        self.bytesOut = 0
+        info = dict(info or {})
+        info.setdefault("started", time.time())
+        infoData = json.dumps(info, sort_keys=True).encode('utf-8')
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._file.write(struct.pack(">B", CAPTURE_VERSION))
+        self._file.write(_INFO_LENGTH.pack(len(infoData)))
+        self._file.write(infoData)
+        self._file.flush()
+        self._last = time.monotonic()
+
+    def record(self, direction, data):
+        """Writes one read or write.
+
+        Args:
+            direction (int): DIRECTION_IN or DIRECTION_OUT.
+
+            data (bytes): The bytes.
+
+        """
+        if not data:
+            return
+        with self._lock:
+            if self._file is None:
+                return
+            now = time.monotonic()
+            gap = min(int((now - self._last) * 1e6), MAX_GAP)
+            self._last = now
+            view = memoryview(data)
+            for start in range(0, len(view), MAX_CHUNK):
+                piece = view[start:start + MAX_CHUNK]
+                self._file.write(_CHUNK.pack(direction, gap, len(piece)))
+                self._file.write(piece)
+                gap = 0
+            self._file.flush()
+            if direction == DIRECTION_IN:
+                self.bytesIn += len(view)
+            else:
+                self.bytesOut += len(view)
+
+    def close(self):
+        """Finishes the capture file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class CapturingConnection(object):
+    """Stands in for a serial connection, recording what goes through it.
+
+    Everything but read() and write() is passed straight on to the real
+    connection, including setting its timeout or baud rate.
+
+    Args:
+        connection (serial.Serial): The real connection.
+
+        writer (CaptureWriter): Where the traffic is recorded.
+
+    """
+    def __init__(self, connection, writer):
+        object.__setattr__(self, "connection", connection)
+        object.__setattr__(self, "writer", writer)
+
+    def read(self, size=1):
+        """Reads from the real connection, recording what was read."""
+        data = self.connection.read(size)
+        self.writer.record(DIRECTION_IN, data)
+        return data
+
+    def write(self, data):
+        """Writes to the real connection, recording what was written."""
+        self.writer.record(DIRECTION_OUT, data)
+        return self.connection.write(data)
+
+    def close(self):
+        """Closes the real connection and finishes the capture."""
+        self.connection.close()
+        self.writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.connection, name, value)
@@ -0,0 +1,320 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+catalog.py - Bulk import and export of prop records.
+
+Onboarding a new stage can mean thousands of prop definitions, far too many to
+enter one prompt at a time. This module streams a catalog file (CSV or JSON
+Lines) into the database, and streams the database back out to a catalog file.
+
+Rows are handled as generators from end to end, so memory use stays flat no
+matter how large the catalog is. Writes are grouped into batched transactions
+by CallsheetDatabase.createMany.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import csv
+import json
+import os
+import time
+
+# local imports
+from . import database
+from . import records
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+CSV_EXTENSIONS = (".csv",)
+JSONL_EXTENSIONS = (".jsonl", ".ndjson")
+
+
+__all__ = [
+    "ImportStats",
+    "exportCatalog",
+    "importCatalog",
+    "iterCatalogRows",
+    "iterCsvRows",
+    "iterJsonlRows",
+    "iterValidRecords",
+    "validateRow",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def _catalogFormat(path):
+    """Determines the catalog format of a file from its extension.
+
+    Args:
+        path (str): The path to the catalog file.
+
+    Returns:
+        str: Either "csv" or "jsonl".
+
+    Raises:
+        ValueError: if the extension is not a known catalog format.
+
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in CSV_EXTENSIONS:
+        return "csv"
+    if extension in JSONL_EXTENSIONS:
+        return "jsonl"
+    msg = "Unknown catalog format '{}'; expected one of: {}"
+    raise ValueError(msg.format(
+        extension,
+        ", ".join(CSV_EXTENSIONS + JSONL_EXTENSIONS)
+        ))
+
+
+def iterCsvRows(path):
+    """Streams the rows of a CSV catalog, one dict at a time.
+
+    The first line of the file is expected to be a header naming the fields.
+
+    Args:
+        path (str): The path to the CSV file.
+
+    Yields:
+        dict: The fields of one row.
+
+    """
+    with open(path, newline="", encoding="utf-8") as csvFile:
+        for row in csv.DictReader(csvFile):
+            yield row
+
+
+def iterJsonlRows(path):
+    """Streams the rows of a JSON Lines catalog, one dict at a time.
+
+    Blank lines are skipped.
+
+    Args:
+        path (str): The path to the JSON Lines file.
+
+    Yields:
+        dict: The fields of one row.
+
+    """
+    with open(path, encoding="utf-8") as jsonlFile:
+        for line in jsonlFile:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iterCatalogRows(path):
+    """Streams the rows of a catalog file, choosing a reader by extension.
+
+    Args:
+        path (str): The path to the catalog file.
+
+    Yields:
+        dict: The fields of one row.
+
+    """
+    if _catalogFormat(path) == "csv":
+        return iterCsvRows(path)
+    return iterJsonlRows(path)
+
+
+def validateRow(row, fieldNames):
+    """Turns one catalog row into a CallsheetRecord.
+
+    Empty values are dropped so that the record's defaults apply to them (a
+    CSV file has no way to leave a column out of a single row), as are columns
+    the database maintains itself. A record without a uuid is given a new one.
+
+    Args:
+        row (dict): The fields of one catalog row.
+
+        fieldNames (iterable): The fields a record is allowed to have.
+
+    Returns:
+        records.CallsheetRecord: The validated record.
+
+    Raises:
+        ValueError: if the row has unknown fields, no name, or a bad scale.
+
+    """
+    kwargs = {}
+    for (key, value) in row.items():
+        if value is None or value == "":
+            continue
+        if key in database.DB_MANAGED_COLUMNS:
+            # Written by the database itself; present in exported catalogs.
+            continue
+        kwargs[key] = value
+    unknown = [key for key in kwargs if key not in fieldNames]
+    if unknown:
+        raise ValueError("Unknown field(s): {}".format(", ".join(unknown)))
+    if not kwargs.get('name'):
+        raise ValueError("Row has no name.")
+    if 'scale' in kwargs:
+        try:
+            scale = float(kwargs['scale'])
+        except (TypeError, ValueError):
+            msg = "Scale is not a number: {}".format(kwargs['scale'])
+            raise ValueError(msg)
+        kwargs['scale'] = int(scale) if scale.is_integer() else scale
+    if 'uuid' in kwargs:
+        kwargs['uuid'] = str(kwargs['uuid'])
+    return records.CallsheetRecord(**kwargs)
+
+
+def iterValidRecords(rows, stats=None):
+    """Validates a stream of catalog rows, yielding the good ones as records.
+
+    Rows that fail validation are reported and skipped rather than stopping
+    the import.
+
+    Args:
+        rows (iterable): The catalog rows, as dicts.
+
+        stats (ImportStats): Counters to update as rows are read (optional).
+
+    Yields:
+        records.CallsheetRecord: One record per valid row.
+
+    """
+    fieldNames = frozenset(records.CallsheetRecord().keys())
+    for (lineNum, row) in enumerate(rows, 1):
+        if stats is not None:
+            stats.read += 1
+        try:
+            record = validateRow(row, fieldNames)
+        except ValueError as e:
+            print("WARNING: Skipping catalog row {}: {}".format(lineNum, e))
+            if stats is not None:
+                stats.skipped += 1
+            continue
+        yield record
+
+
+def importCatalog(path, db=None, batchSize=database.DB_BATCH_SIZE,
+                  replace=False, quiet=False):
+    """Streams a catalog file into the database.
+
+    Args:
+        path (str): The path to the CSV or JSON Lines catalog file.
+
+        db (database.CallsheetDatabase): The database to import into
+            (optional). Defaults to the shared callsheet database.
+
+        batchSize (int): The number of records written per transaction.
+
+        replace (bool): Replace records whose uuid already exists.
+
+        quiet (bool): Suppress the per-batch progress report.
+
+    Returns:
+        ImportStats: The counts and throughput of the import.
+
+    """
+    db = db or records.CALLSHEET_DB
+    stats = ImportStats()
+
+    def reportProgress(batchCount):
+        stats.imported += batchCount
+        if not quiet:
+            print(stats)
+
+    print("Importing catalog from {}".format(path))
+    rows = iterCatalogRows(path)
+    db.createMany(
+        iterValidRecords(rows, stats=stats),
+        batchSize=batchSize,
+        replace=replace,
+        callback=reportProgress,
+        )
+    stats.finish()
+    print("Import complete: {}".format(stats))
+    return stats
+
+
+def exportCatalog(path, db=None, batchSize=database.DB_BATCH_SIZE):
+    """Streams every record in the database out to a catalog file.
+
+    Args:
+        path (str): The path of the CSV or JSON Lines file to write.
+
+        db (database.CallsheetDatabase): The database to export from
+            (optional). Defaults to the shared callsheet database.
+
+        batchSize (int): The number of rows fetched per round trip.
+
+    Returns:
+        int: The number of records exported.
+
+    """
+    db = db or records.CALLSHEET_DB
+    catalogFormat = _catalogFormat(path)
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as outFile:
+        writer = None
+        for row in db.iterRecords(batchSize=batchSize):
+            if catalogFormat == "jsonl":
+                outFile.write(json.dumps(row))
+                outFile.write("\n")
+            else:
+                if writer is None:
+                    writer = csv.DictWriter(outFile, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+            count += 1
+    print("Exported {} records to {}".format(count, path))
+    return count
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class ImportStats(object):
+    """Progress and throughput counters for a catalog import."""
+    def __init__(self):
+        self.read = 0
+        self.imported = 0
+        self.skipped = 0
+        self.startTime = time.perf_counter()
+        self.endTime = None
+
+    def __str__(self):
+        msg = "{} imported, {} skipped, {} read in {:.2f}s ({:.0f} records/s)"
+        return msg.format(
+            self.imported,
+            self.skipped,
+            self.read,
+            self.elapsed,
+            self.rate
+            )
+
+    @property
+    def elapsed(self):
+        """float: Seconds spent on the import so far."""
+        endTime = self.endTime or time.perf_counter()
+        return endTime - self.startTime
+
+    @property
+    def rate(self):
+        """float: Records imported per second."""
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+        return self.imported / elapsed
+
+    def finish(self):
+        """Stops the clock on the import."""
+        self.endTime = time.perf_counter()
@@ -0,0 +1,558 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+daemon.py - A resident callsheet service, and the client that talks to it.
+
+Every run of main.py opens the database and the serial port from scratch,
+and opening the port resets the Arduino. The daemon does that once, then
+stays up. It holds the reader, the database connection and the record cache,
+and serves requests over a Unix domain socket. Once it is running, the
+commandline only sends requests, and each operation costs a round trip
+instead of a restart.
+
+Messages are JSON objects, each sent as a 4-byte big-endian length followed
+by that many bytes of UTF-8. A request names an operation and its arguments:
+
+    {"op": "lookup", "args": {"name": "Sword"}}
+
+and gets back either its result or an error:
+
+    {"ok": true, "result": {...}}
+    {"ok": false, "error": "ValueError: Unknown callsheet field(s): color"}
+
+The operations are ping, read, lookup, create, update and assign. Reader
+operations go through the command scheduler, so requests from several
+clients take turns on the reader. They wait scheduler.DEFAULT_TIMEOUT for a
+tag unless given a timeout, and are cancelled if the client goes away in the
+meantime, such as with Ctrl+C, so the reader isn't left waiting for nobody.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import concurrent.futures
+import json
+import os
+import select
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+
+# local imports
+from . import records
+from . import scheduler
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(),
+    "nfcCallsheet.sock"
+    )
+# Seconds a client waits to reach the daemon before deciding none is running:
+CONNECT_TIMEOUT = 0.5
+# The largest message either side will accept:
+MAX_MESSAGE = 1 << 20
+# Seconds between checks that a client waiting on the reader is still there:
+CLIENT_POLL = 0.5
+
+_LENGTH = struct.Struct(">I")
+
+
+__all__ = [
+    "connect",
+    "receiveMessage",
+    "sendMessage",
+    "serve",
+    "CallsheetDaemon",
+    "DaemonClient",
+    "DaemonError",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def _receiveExactly(sock, size):
+    """Reads an exact number of bytes from a socket.
+
+    Args:
+        sock (socket.socket): The socket to read from.
+
+        size (int): The number of bytes to read.
+
+    Returns:
+        bytes: The bytes, or None if the other end closed first.
+
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def _clientGone(sock):
+    """Checks whether the other end of a connection has closed it.
+
+    Args:
+        sock (socket.socket): The connection.
+
+    Returns:
+        bool: True if it has closed.
+
+    """
+    try:
+        (readable, _, _) = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return not sock.recv(1, socket.MSG_PEEK)
+    except OSError:
+        return True
+
+
+def sendMessage(sock, message):
+    """Sends one length-prefixed JSON message.
+
+    Args:
+        sock (socket.socket): The socket to send on.
+
+        message (dict): The message.
+
+    """
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def receiveMessage(sock):
+    """Receives one length-prefixed JSON message.
+
+    Args:
+        sock (socket.socket): The socket to read from.
+
+    Returns:
+        dict: The message, or None if the other end closed the connection.
+
+    Raises:
+        ValueError: if the message is too large or isn't valid JSON.
+
+    """
+    header = _receiveExactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    (length,) = _LENGTH.unpack(header)
+    if length > MAX_MESSAGE:
+        msg = "Message of {} bytes exceeds the {} byte maximum."
+        raise ValueError(msg.format(length, MAX_MESSAGE))
+    data = _receiveExactly(sock, length)
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+def serve(path=DEFAULT_SOCKET):
+    """Runs the daemon until it is interrupted.
+
+    Args:
+        path (str): The socket to listen on (optional).
+
+    """
+    server = CallsheetDaemon(path)
+    print("Callsheet daemon listening on {}".format(path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def connect(path=DEFAULT_SOCKET):
+    """Connects to the daemon, if one is running.
+
+    Args:
+        path (str): The daemon's socket (optional).
+
+    Returns:
+        DaemonClient: A connected client, or None if no daemon is listening.
+
+    """
+    try:
+        return DaemonClient(path)
+    except OSError:
+        return None
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class DaemonError(Exception):
+    """Raised by the client when the daemon reports that a request failed."""
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    """Serves the requests from one client connection, in turn."""
+    def handle(self):
+        while True:
+            try:
+                message = receiveMessage(self.request)
+            except ValueError as e:
+                sendMessage(self.request, {"ok": False, "error": str(e)})
+                return
+            if message is None:
+                return
+            reply = self.server.dispatch(message, client=self.request)
+            try:
+                sendMessage(self.request, reply)
+            except OSError:
+                # The client went away while its request was served.
+                return
+
+
+class CallsheetDaemon(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """The resident service, listening on a Unix domain socket.
+
+    Each client connection is served on its own thread. The reader is opened
+    when the daemon starts, rather than on the first request.
+
+    Args:
+        path (str): The socket to listen on.
+
+    Raises:
+        RuntimeError: if another daemon is already listening there.
+
+    """
+    daemon_threads = True
+    # Requests a client may make, and the methods that serve them:
+    operations = {
+        "ping": "ping",
+        "read": "read",
+        "lookup": "lookup",
+        "create": "create",
+        "update": "update",
+        "assign": "assign",
+    }
+
+    def __init__(self, path):
+        self._removeStaleSocket(path)
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        self.path = path
+        self.started = time.time()
+        self.scheduler = scheduler.getScheduler()
+        # The connection of the client whose request each thread serves:
+        self._clients = threading.local()
+
+    @staticmethod
+    def _removeStaleSocket(path):
+        """Removes a socket file left behind by a daemon that has died.
+
+        Args:
+            path (str): The socket to listen on.
+
+        Raises:
+            RuntimeError: if a daemon is still listening there.
+
+        """
+        if not os.path.exists(path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError("A daemon is already listening on {}".format(path))
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def dispatch(self, message, client=None):
+        """Serves one request.
+
+        Args:
+            message (dict): The request, naming its "op" and its "args".
+
+            client (socket.socket): The client's connection, watched while
+                waiting on the reader (optional).
+
+        Returns:
+            dict: The response to send back.
+
+        """
+        operation = self.operations.get(message.get("op"))
+        if operation is None:
+            msg = "Unknown operation: {}".format(message.get("op"))
+            return {"ok": False, "error": msg}
+        self._clients.sock = client
+        try:
+            result = getattr(self, operation)(**message.get("args", {}))
+        except Exception as e:  #pylint: disable=broad-except
+            return {"ok": False, "error": "{}: {}".format(type(e).__name__, e)}
+        return {"ok": True, "result": result}
+
+    def _awaitReader(self, future):
+        """Waits for a reader command, cancelling it if the client leaves.
+
+        Args:
+            future (scheduler.CommandFuture): The command.
+
+        Returns:
+            object: The command's result.
+
+        Raises:
+            DaemonError: if the client went away first.
+
+        """
+        client = getattr(self._clients, "sock", None)
+        while True:
+            (done, _) = concurrent.futures.wait([future], timeout=CLIENT_POLL)
+            if done:
+                return future.result()
+            if client is not None and _clientGone(client):
+                future.cancel()
+                raise DaemonError("The client went away.")
+
+    def _readNdefData(self, timeout=None):
+        """Reads a tag through the scheduler.
+
+        Args:
+            timeout (float): Seconds to wait for a tag (optional). By
+                default, scheduler.DEFAULT_TIMEOUT.
+
+        Returns:
+            dict: The ndef data read from the tag.
+
+        """
+        if timeout is None:
+            timeout = scheduler.DEFAULT_TIMEOUT
+        return self._awaitReader(self.scheduler.readTag(timeout=timeout))
+
+    def _writeToTag(self, record, tagType=None, timeout=None):
+        """Writes a record to the next tag presented, through the scheduler.
+
+        Args:
+            record (records.CallsheetRecord): The record.
+
+            tagType (str): Write the whole record, sized for this type of
+                tag, rather than just its uuid (optional).
+
+            timeout (float): Seconds to wait for a tag (optional). By
+                default, scheduler.DEFAULT_TIMEOUT.
+
+        """
+        if timeout is None:
+            timeout = scheduler.DEFAULT_TIMEOUT
+        self._awaitReader(self.scheduler.writeTag(
+            record.tagPayload(tagType=tagType),
+            timeout=timeout
+            ))
+
+    def _loadRecord(self, uuid=None, name=None, nfcTagId=None):
+        """Loads a record from the database by one of its keys.
+
+        Returns:
+            records.CallsheetRecord: The record.
+
+        Raises:
+            KeyError: if there is no such record.
+
+        """
+        recordData = self.lookup(uuid=uuid, name=name, nfcTagId=nfcTagId)
+        if recordData is None:
+            raise KeyError("No record found.")
+        return records.CallsheetRecord.fromRow(recordData)
+
+    def ping(self):
+        """Reports that the daemon is alive.
+
+        Returns:
+            dict: The daemon's process ID and its uptime in seconds.
+
+        """
+        return {"pid": os.getpid(), "uptime": time.time() - self.started}
+
+    def read(self, timeout=None):
+        """Reads a tag and looks up its record.
+
+        Args:
+            timeout (float): Seconds to wait for a tag (optional). By
+                default, scheduler.DEFAULT_TIMEOUT.
+
+        Returns:
+            dict: The record.
+
+        """
+        record = records.CallsheetRecord()
+        record.populateFromNdefData(self._readNdefData(timeout))
+        record.populateFromDatabase()
+        return dict(record)
+
+    def lookup(self, uuid=None, name=None, nfcTagId=None):
+        """Looks a record up in the database.
+
+        Args:
+            uuid (str): The record's uuid (optional).
+
+            name (str): The record's name (optional).
+
+            nfcTagId (str): The UID of the record's NFC tag (optional).
+
+        Returns:
+            dict: The record, or None if there is no such record.
+
+        Raises:
+            ValueError: if no key was given.
+
+        """
+        if uuid:
+            return records.CALLSHEET_DB.getByUuid(uuid)
+        if nfcTagId:
+            return records.CALLSHEET_DB.getByTagId(nfcTagId)
+        if name:
+            return records.CALLSHEET_DB.getByName(name)
+        raise ValueError("A uuid, name or nfcTagId is required.")
+
+    def create(self, fields, tagType=None):
+        """Creates a record and writes it to the next tag presented.
+
+        Args:
+            fields (dict): The new record's fields.
+
+            tagType (str): Write the whole record, sized for this type of
+                tag, rather than just its uuid (optional).
+
+        Returns:
+            dict: The record.
+
+        """
+        record = records.CallsheetRecord(**fields)
+        record.writeToDatabase()
+        self._writeToTag(record, tagType=tagType)
+        return dict(record)
+
+    def update(self, fields, uuid=None, timeout=None):
+        """Updates a record with new values.
+
+        Args:
+            fields (dict): The fields to change.
+
+            uuid (str): The record to change (optional). By default the
+                record is read from the next tag presented.
+
+            timeout (float): Seconds to wait for a tag, when reading one
+                (optional).
+
+        Returns:
+            dict: The updated "record" and the names of the fields that
+                "changed".
+
+        """
+        if uuid is None:
+            record = records.CallsheetRecord(**self.read(timeout))
+        else:
+            record = self._loadRecord(uuid=uuid)
+        record.update(fields)
+        changed = record.saveToDatabase()
+        return {"record": dict(record), "changed": changed}
+
+    def assign(self, uuid=None, name=None, timeout=None, tagType=None):
+        """Assigns a new tag to an existing record.
+
+        The next tag presented is read for its UID, then the record is
+        written to it.
+
+        Args:
+            uuid (str): The record's uuid (optional).
+
+            name (str): The record's name, if no uuid is given (optional).
+
+            timeout (float): Seconds to wait for the tag, to read it and
+                again to write it (optional). By default,
+                scheduler.DEFAULT_TIMEOUT.
+
+            tagType (str): Write the whole record, sized for this type of
+                tag, rather than just its uuid (optional).
+
+        Returns:
+            dict: The updated record.
+
+        """
+        record = self._loadRecord(uuid=uuid, name=name)
+        record['nfcTagId'] = self._readNdefData(timeout)['uid']
+        record.saveToDatabase()
+        self._writeToTag(record, tagType=tagType, timeout=timeout)
+        return dict(record)
+
+
+class DaemonClient(object):
+    """A connection to a running callsheet daemon.
+
+    Args:
+        path (str): The daemon's socket (optional).
+
+    Raises:
+        OSError: if no daemon is listening there.
+
+    """
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        # Reader operations wait on a person, so replies may take a while.
+        self.sock.settimeout(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def request(self, op, **args):
+        """Sends one request to the daemon and waits for its result.
+
+        Args:
+            op (str): The operation, such as "read" or "lookup".
+
+            **args: The operation's arguments.
+
+        Returns:
+            object: The operation's result.
+
+        Raises:
+            DaemonError: if the request failed, or the daemon went away.
+
+        """
+        sendMessage(self.sock, {"op": op, "args": args})
+        reply = receiveMessage(self.sock)
+        if reply is None:
+            raise DaemonError("The daemon closed the connection.")
+        if not reply["ok"]:
+            raise DaemonError(reply["error"])
+        return reply["result"]
+
+    def close(self):
+        """Closes the connection."""
+        self.sock.close()
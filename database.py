@@ -19,20 +19,81 @@ location.
 # IMPORTS
 ###############################################################################
 # stdlib imports
+import collections
+import contextlib
+import itertools
 import os
 import sqlite3
+import threading
 
 # local imports
-from . import records
+from . import cache
+from . import instrumentation
 
 ###############################################################################
 # GLOBALS
 ###############################################################################
 DB_LOCATION = './callsheet.db'
+# Seconds a connection will wait on a locked database before giving up:
+DB_TIMEOUT = 5.0
+# Number of rows written per transaction, or read per fetch, by bulk methods:
+DB_BATCH_SIZE = 500
+# The most values bound in one "IN (...)" list; sqlite's own limit is 999 on
+# older builds:
+DB_MAX_PARAMS = 900
+# Pragmas applied to every connection when it is opened. WAL lets readers
+# carry on while a write is in progress, and NORMAL sync is safe under WAL
+# while avoiding an fsync on every commit.
+DB_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("temp_store", "MEMORY"),
+    ("cache_size", -8000),
+    ("busy_timeout", int(DB_TIMEOUT * 1000)),
+)
+
+# The version of the schema this software expects. It is stored in the
+# database file's user_version pragma; a file at an older version is migrated
+# in place when it is opened. Version 0 is the original untyped, unindexed
+# table (or no table at all).
+SCHEMA_VERSION = 2
+# sqlite expression for the current time, with milliseconds:
+_NOW_SQL = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+# The callsheet table's columns and their declarations, as of version 1:
+_COLUMNS_V1 = (
+    ("uuid", "TEXT PRIMARY KEY NOT NULL"),
+    ("name", "TEXT"),
+    ("nfcTagId", "TEXT"),
+    ("recordType", "TEXT"),
+    ("scale", "NUMERIC DEFAULT 1"),
+    ("location", "TEXT"),
+    ("created", "TEXT"),
+)
+# ...and as of version 2:
+_COLUMNS_V2 = _COLUMNS_V1 + (
+    ("modified", "TEXT DEFAULT ({})".format(_NOW_SQL)),
+)
+# The callsheet table's columns and their declarations, as of SCHEMA_VERSION:
+CALLSHEET_COLUMNS = _COLUMNS_V2
+# Columns maintained by the database itself, never written by records:
+DB_MANAGED_COLUMNS = ("modified",)
+# Secondary indexes on the callsheet table, as (index name, column) pairs:
+_INDEXES_V1 = (
+    ("callsheet_nfcTagId", "nfcTagId"),
+    ("callsheet_name", "name"),
+    ("callsheet_location", "location"),
+    ("callsheet_recordType", "recordType"),
+)
+_INDEXES_V2 = _INDEXES_V1 + (
+    ("callsheet_modified", "modified"),
+)
+CALLSHEET_INDEXES = _INDEXES_V2
 
 
 __all__ = [
     "dictFactory",
+    "SCHEMA_VERSION",
+    "ConnectionManager",
     "CallsheetDatabase",
 ]
 __author__ = 'astetson'
@@ -59,43 +120,354 @@ def dictFactory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+
+def _tableExists(connection, tableName):
+    """Reports whether a table exists in the database.
+
+    Args:
+        connection (sqlite3.Connection): The connection to the database.
+
+        tableName (str): The name of the table to look for.
+
+    Returns:
+        bool: True if the table exists.
+
+    """
+    row = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+        (tableName,)
+        ).fetchone()
+    return row is not None
+
+
+def _rebuildTable(connection, columns):
+    """Creates the callsheet table with the given columns.
+
+    If the table already exists, its rows are copied into the new layout and
+    the old table is dropped, taking its indexes and triggers with it. Should
+    the old table hold more than one row for a uuid, the last one written
+    wins.
+
+    Args:
+        connection (sqlite3.Connection): The connection to the database,
+            inside of an open transaction.
+
+        columns (tuple): (name, declaration) pairs for the new table.
+
+    """
+    createCommand = "CREATE TABLE {} ({})"
+    columnDefs = ",".join(
+        "{} {}".format(name, decl) for (name, decl) in columns
+        )
+    if not _tableExists(connection, "callsheet"):
+        connection.execute(createCommand.format("callsheet", columnDefs))
+        return
+    connection.execute(createCommand.format("callsheet_new", columnDefs))
+    oldColumns = [
+        row['name'] for row in
+        connection.execute("PRAGMA table_info(callsheet)")
+        ]
+    copyColumns = ",".join(
+        name for (name, _) in columns if name in oldColumns
+        )
+    connection.execute(
+        "INSERT OR REPLACE INTO callsheet_new ({0}) SELECT {0} FROM "
+        "callsheet WHERE uuid IS NOT NULL ORDER BY rowid".format(copyColumns)
+        )
+    connection.execute("DROP TABLE callsheet")
+    connection.execute("ALTER TABLE callsheet_new RENAME TO callsheet")
+
+
+def _createIndexes(connection, indexes):
+    """Creates secondary indexes on the callsheet table.
+
+    Args:
+        connection (sqlite3.Connection): The connection to the database.
+
+        indexes (tuple): (index name, column) pairs.
+
+    """
+    for (indexName, column) in indexes:
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS {} ON callsheet ({})".format(
+                indexName,
+                column
+                )
+            )
+
+
+def _migrateToV1(connection):
+    """Migrates the callsheet table to schema version 1.
+
+    Version 1 gives the columns real types, makes uuid the primary key, and
+    indexes the columns that records are looked up by.
+
+    Args:
+        connection (sqlite3.Connection): The connection to migrate, inside of
+            an open transaction.
+
+    """
+    print("Migrating callsheet table to schema version 1.")
+    _rebuildTable(connection, _COLUMNS_V1)
+    _createIndexes(connection, _INDEXES_V1)
+
+
+def _migrateToV2(connection):
+    """Migrates the callsheet table to schema version 2.
+
+    Version 2 stamps every row with the time it was last written, in an
+    indexed "modified" column, so that readers can ask for only the rows that
+    changed since they last looked. Inserts are stamped by the column default
+    and updates by a trigger.
+
+    Args:
+        connection (sqlite3.Connection): The connection to migrate, inside of
+            an open transaction.
+
+    """
+    print("Migrating callsheet table to schema version 2.")
+    _rebuildTable(connection, _COLUMNS_V2)
+    _createIndexes(connection, _INDEXES_V2)
+    # Only stamp updates that didn't set "modified" themselves. Triggers do
+    # not fire recursively, so the trigger's own update ends the chain.
+    connection.execute(
+        "CREATE TRIGGER IF NOT EXISTS callsheet_touch AFTER UPDATE ON "
+        "callsheet WHEN NEW.modified IS OLD.modified BEGIN "
+        "UPDATE callsheet SET modified = {} WHERE uuid = NEW.uuid; "
+        "END".format(_NOW_SQL)
+        )
+
+
+# Each entry migrates the schema from the version before it to its own:
+MIGRATIONS = (
+    (1, _migrateToV1),
+    (2, _migrateToV2),
+)
+
+
+def _writableKeys(callsheetRecord):
+    """Lists the keys of a record that should be written to the database.
+
+    Args:
+        callsheetRecord (dict): The record about to be written.
+
+    Returns:
+        list: The record's keys, less any DB_MANAGED_COLUMNS.
+
+    """
+    return [
+        key for key in callsheetRecord.keys()
+        if key not in DB_MANAGED_COLUMNS
+        ]
+
+
+def _valuesDiffer(storedValue, newValue):
+    """Compares a stored DB value with a record value.
+
+    Older rows were written with every value quoted as text, so a stored '1'
+    and a record's 1 are treated as the same value.
+
+    Args:
+        storedValue (object): The value read from the database.
+
+        newValue (object): The value held by the record.
+
+    Returns:
+        bool: True if the values are meaningfully different.
+
+    """
+    if storedValue == newValue:
+        return False
+    return str(storedValue) != str(newValue)
+
 ###############################################################################
 # CLASSES
 ###############################################################################
+class ConnectionManager(object):
+    """Keeps long-lived sqlite connections, one per thread.
+
+    Opening a sqlite connection, tuning it and tearing it down again costs far
+    more than the single statement we usually want to run. Instead, each
+    thread is handed its own connection the first time it asks, and that
+    connection is reused until close() is called.
+
+    Connections are opened in autocommit mode; statements that need to be
+    grouped together should be run inside of transaction().
+
+    Args:
+        location (str): The path to the sqlite database file.
+
+        pragmas (tuple): (name, value) pairs applied to each new connection.
+
+    """
+    def __init__(self, location=DB_LOCATION, pragmas=DB_PRAGMAS):
+        self.location = location
+        self.pragmas = pragmas
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _connect(self):
+        """Opens and tunes a new connection to the database.
+
+        Returns:
+            sqlite3.Connection: The new connection.
+
+        """
+        connection = sqlite3.connect(
+            self.location,
+            timeout=DB_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+            )
+        connection.row_factory = dictFactory
+        for (name, value) in self.pragmas:
+            connection.execute("PRAGMA {}={}".format(name, value))
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    def connection(self):
+        """Returns the connection belonging to the calling thread.
+
+        Returns:
+            sqlite3.Connection: The connection for this thread.
+
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+            self._local.depth = 0
+        return connection
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        """Context manager wrapping the enclosed statements in a transaction.
+
+        The transaction is committed when the block exits normally and rolled
+        back if it raises. Nested transaction() blocks join the outermost
+        transaction rather than starting a new one.
+
+        Args:
+            immediate (bool): Take the write lock up front (BEGIN IMMEDIATE),
+                which avoids a lock upgrade failing partway through a write.
+
+        Yields:
+            sqlite3.Connection: The connection the transaction is running on.
+
+        """
+        connection = self.connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield connection
+            finally:
+                self._local.depth -= 1
+            return
+        connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        self._local.depth = 1
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        """Closes every connection handed out by this manager."""
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+
 class CallsheetDatabase(object):
-    """Object providing an interface for interacting with the database."""
-    def __init__(self):
+    """Object providing an interface for interacting with the database.
+
+    Lookups by uuid and by name are served from an in-process RecordCache
+    when possible. Writes made through this object keep that cache current.
+
+    Args:
+        location (str): The path to the sqlite database file (optional).
+            Defaults to DB_LOCATION.
+
+        cacheSize (int): The most records held in the cache. Zero disables
+            the cache.
+
+        cacheTtl (float): Seconds a cached record stays valid (optional). By
+            default cached records never expire.
+
+    """
+    def __init__(self, location=None, cacheSize=cache.DEFAULT_MAX_SIZE,
+                 cacheTtl=None):
+        self.location = location or DB_LOCATION
+        self.connections = ConnectionManager(self.location)
+        self.cache = cache.RecordCache(maxSize=cacheSize, ttl=cacheTtl)
+        # A preload.StageIndex, consulted ahead of the cache when set:
+        self.stageIndex = None
+        self._columnNames = None
         self._initializeDB()
 
     def _initializeDB(self):
-        """Makes the database at the expected location if one doesn't exist."""
-        if not os.path.isfile(DB_LOCATION):
-            print("No DB found. Creating at {}".format(DB_LOCATION))
-            callsheetRecord = records.CallsheetRecord()
-            qmarks = ",".join(callsheetRecord.keys())
-            createCommand = "CREATE TABLE callsheet ({})".format(qmarks)
-            print(createCommand)
-            self._executeDBCmd(createCommand)
+        """Makes the database at the expected location if one doesn't exist.
+
+        An existing database written by an older version of this software is
+        migrated, in place, up to SCHEMA_VERSION.
+
+        Raises:
+            RuntimeError: if the database is newer than this software.
+
+        """
+        if not os.path.isfile(self.location):
+            print("No DB found. Creating at {}".format(self.location))
+        with self.transaction(immediate=True) as connection:
+            version = self.schemaVersion()
+            if version > SCHEMA_VERSION:
+                msg = ("Database schema version {} is newer than this "
+                       "software supports ({}).")
+                raise RuntimeError(msg.format(version, SCHEMA_VERSION))
+            for (migrationVersion, migration) in MIGRATIONS:
+                if migrationVersion <= version:
+                    continue
+                migration(connection)
+                connection.execute(
+                    "PRAGMA user_version={}".format(migrationVersion)
+                    )
         print("DB initialized")
 
-    def _executeDBCmd(self, command):
+    def schemaVersion(self):
+        """Reports the schema version of the database.
+
+        Returns:
+            int: The schema version stored in the database file.
+
+        """
+        row = self._fetchOneDBCmd("PRAGMA user_version")
+        return row['user_version']
+
+    def _executeDBCmd(self, command, params=()):
         """Executes a given command in sqlite3 for the database.
 
-        Establishes the connection with the DB, creates a cursor, executes the
-        command, and closes the connection.
+        The command runs on this thread's persistent connection, inside of a
+        transaction. If a transaction is already open, the command joins it.
 
         Args:
             command (str): The command to execute in sqlite3.
 
+            params (tuple): Values bound to the command's placeholders
+                (optional).
+
         """
-        connection = sqlite3.connect(DB_LOCATION)
-        connection.row_factory = dictFactory
-        cur = connection.cursor()
-        cur.execute(command)
-        connection.commit()
-        connection.close()
+        with self.transaction(immediate=True) as connection:
+            connection.execute(command, params)
 
-    def _fetchOneDBCmd(self, command):
+    def _fetchOneDBCmd(self, command, params=()):
         """Runs a fetchone operation with given command.
 
         This is used for pulling information about one single object from the
@@ -104,17 +476,120 @@ class CallsheetDatabase(object):
         Args:
             command (str): The command to execute in sqlite3.
 
+            params (tuple): Values bound to the command's placeholders
+                (optional).
+
         Returns:
             dict: The record data from the database.
 
         """
-        connection = sqlite3.connect(DB_LOCATION)
-        connection.row_factory = dictFactory
-        cur = connection.cursor()
-        cur.execute(command)
-        record = cur.fetchone()
-        connection.close()
-        return record
+        connection = self.connections.connection()
+        return connection.execute(command, params).fetchone()
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        """Opens an explicit transaction scope on this thread's connection.
+
+        Use this to group several writes so that they share one commit:
+
+            with db.transaction():
+                db.create(recordA)
+                db.create(recordB)
+
+        If the transaction is rolled back, the record cache is cleared, since
+        it may hold writes that never landed.
+
+        Args:
+            immediate (bool): Take the write lock when the transaction starts.
+
+        Yields:
+            sqlite3.Connection: The connection the transaction runs on.
+
+        """
+        try:
+            with self.connections.transaction(immediate=immediate) as conn:
+                yield conn
+        except BaseException:
+            self.cache.clear()
+            raise
+
+    def close(self):
+        """Closes all of the connections held open for this database."""
+        self.connections.close()
+
+    def _putInStageIndex(self, callsheetRecord, keys):
+        """Puts a record that was just written into the stage index, if any.
+
+        The index is given the row as it was written. A record that didn't
+        carry every column may not match the stored row, so it is dropped
+        from the index instead, until the index is next refreshed.
+
+        Args:
+            callsheetRecord (dict): The record that was written.
+
+            keys (iterable): The fields that were written.
+
+        """
+        if self.stageIndex is None:
+            return
+        columns = set(self._tableColumns()).difference(DB_MANAGED_COLUMNS)
+        if columns.issubset(keys):
+            self.stageIndex.put(
+                dict((key, callsheetRecord[key]) for key in keys)
+                )
+        else:
+            self.stageIndex.discard(callsheetRecord['uuid'])
+
+    def _mergeIntoStageIndex(self, changes, recordUuid):
+        """Writes changed fields through to the stage index's copy, if any.
+
+        Args:
+            changes (dict): The fields that were written.
+
+            recordUuid (str): The uuid of the record that was written.
+
+        """
+        if self.stageIndex is not None:
+            self.stageIndex.merge(
+                changes,
+                recordUuid,
+                staleFields=DB_MANAGED_COLUMNS,
+                )
+
+    def _tableColumns(self):
+        """Returns the names of the columns in the callsheet table.
+
+        The column names are looked up once and remembered, since the schema
+        does not change underneath a running process.
+
+        Returns:
+            tuple: The column names, in table order.
+
+        """
+        if self._columnNames is None:
+            connection = self.connections.connection()
+            rows = connection.execute("PRAGMA table_info(callsheet)")
+            self._columnNames = tuple(row['name'] for row in rows)
+        return self._columnNames
+
+    def _validateColumns(self, keys):
+        """Makes sure that every key names a column of the callsheet table.
+
+        Column names cannot be bound as sqlite parameters, so they are checked
+        against the table before being formatted into a statement.
+
+        Args:
+            keys (iterable): The keys to check.
+
+        Raises:
+            ValueError: if a key is not a column in the callsheet table.
+
+        """
+        columns = self._tableColumns()
+        unknown = [key for key in keys if key not in columns]
+        if unknown:
+            msg = "Unknown callsheet field(s): {}".format(", ".join(unknown))
+            raise ValueError(msg)
 
     def create(self, callsheetRecord):
         """Creates a new record in the database. Uses the uuid as the key.
@@ -126,31 +601,95 @@ class CallsheetDatabase(object):
         """
         if not 'uuid' in callsheetRecord.keys():
             raise ValueError("Record for creation must contain a UUID.")
-        sqlValues = ["'"+str(i)+"'" for i in callsheetRecord.values()]
+        keys = _writableKeys(callsheetRecord)
+        self._validateColumns(keys)
         writeCommand = "INSERT INTO callsheet ({}) VALUES ({})"
         writeCommand = writeCommand.format(
-            ",".join(callsheetRecord.keys()),
-            ",".join(sqlValues)
+            ",".join(keys),
+            ",".join("?" * len(keys))
+            )
+        print("Writing: '{}'".format(callsheetRecord['uuid']))
+        self._executeDBCmd(
+            writeCommand,
+            tuple(callsheetRecord[key] for key in keys)
             )
-        print("Writing: '{}'".format(writeCommand))
-        self._executeDBCmd(writeCommand)
+        self._putInStageIndex(callsheetRecord, keys)
+        columns = set(self._tableColumns()).difference(DB_MANAGED_COLUMNS)
+        if columns.issubset(keys):
+            self.cache.put(callsheetRecord)
+        else:
+            self.cache.invalidate(callsheetRecord['uuid'])
 
     def update(self, callsheetRecord):
         """Updates an existing record in the DB. Uses uuid as the key.
 
+        Every field of the given record is written in one statement.
+
         Args:
             callsheetRecord (dict): The dict of data to update the record with.
 
         """
-        for key in callsheetRecord.keys():
-            updateCommand = "UPDATE callsheet SET {}='{}' WHERE uuid='{}'"
-            updateCommand = updateCommand.format(
-                key,
-                callsheetRecord[key],
-                callsheetRecord['uuid']
-                )
-            self._executeDBCmd(updateCommand)
+        if not 'uuid' in callsheetRecord.keys():
+            raise ValueError("Record for update must contain a UUID.")
+        keys = [
+            key for key in _writableKeys(callsheetRecord) if key != 'uuid'
+            ]
+        if not keys:
+            return
+        self._validateColumns(keys)
+        updateCommand = "UPDATE callsheet SET {} WHERE uuid = ?".format(
+            ",".join("{}=?".format(key) for key in keys)
+            )
+        params = [callsheetRecord[key] for key in keys]
+        params.append(callsheetRecord['uuid'])
+        self._executeDBCmd(updateCommand, tuple(params))
+        changes = dict((key, callsheetRecord[key]) for key in keys)
+        self._mergeIntoStageIndex(changes, callsheetRecord['uuid'])
+        self.cache.merge(
+            changes,
+            recordUuid=callsheetRecord['uuid'],
+            staleFields=DB_MANAGED_COLUMNS,
+            )
+
+    @instrumentation.timed("db.upsert")
+    def upsert(self, callsheetRecord):
+        """Writes a record to the DB, creating it if it does not exist yet.
+
+        The stored row is compared against the given record and only the
+        fields whose values differ are written, in a single UPDATE. The read
+        and the write share one transaction.
 
+        Args:
+            callsheetRecord (dict): The dict of data to write for this record.
+
+        Returns:
+            list: The names of the fields that were written. Empty if the
+                stored record already matched.
+
+        """
+        if not 'uuid' in callsheetRecord.keys():
+            raise ValueError("Record for upsert must contain a UUID.")
+        self._validateColumns(callsheetRecord.keys())
+        with self.transaction(immediate=True):
+            stored = self._fetchOneDBCmd(
+                "SELECT * FROM callsheet WHERE uuid = ?",
+                (callsheetRecord['uuid'],)
+                )
+            if stored is None:
+                self.create(callsheetRecord)
+                return list(callsheetRecord.keys())
+            changes = {}
+            for key in _writableKeys(callsheetRecord):
+                value = callsheetRecord[key]
+                if key != 'uuid' and _valuesDiffer(stored.get(key), value):
+                    changes[key] = value
+            if changes:
+                changes['uuid'] = callsheetRecord['uuid']
+                self.update(changes)
+                del changes['uuid']
+        return list(changes.keys())
+
+    @instrumentation.timed("db.getByUuid")
     def getByUuid(self, recordUuid):
         """Fetches a record from the database using the uuid for the search.
 
@@ -163,11 +702,66 @@ class CallsheetDatabase(object):
             dict: The record data from the database.
 
         """
-        loadCommand = "SELECT * FROM callsheet WHERE uuid = '{}'"
-        loadCommand = loadCommand.format(recordUuid)
-        record = self._fetchOneDBCmd(loadCommand)
+        if self.stageIndex is not None:
+            record = self.stageIndex.get(recordUuid)
+            if record is not None:
+                instrumentation.count("db.stageIndexHit")
+                return record
+        record = self.cache.get(recordUuid)
+        if record is not None:
+            instrumentation.count("db.cacheHit")
+            return record
+        instrumentation.count("db.query")
+        loadCommand = "SELECT * FROM callsheet WHERE uuid = ?"
+        record = self._fetchOneDBCmd(loadCommand, (recordUuid,))
+        if record is not None:
+            self.cache.put(record)
         return record
 
+    @instrumentation.timed("db.getByUuids")
+    def getByUuids(self, recordUuids):
+        """Fetches many records at once, by uuid.
+
+        Records in the stage index or the cache are answered from there. All
+        of the rest are fetched in one "WHERE uuid IN (...)" query, split up
+        only if there are more than DB_MAX_PARAMS of them.
+
+        Args:
+            recordUuids (iterable): The unique IDs of the records.
+
+        Returns:
+            dict: The record data from the database, keyed by uuid. Uuids
+                with no record are left out.
+
+        """
+        found = {}
+        missing = []
+        for recordUuid in recordUuids:
+            if recordUuid in found:
+                continue
+            record = None
+            if self.stageIndex is not None:
+                record = self.stageIndex.get(recordUuid)
+            if record is None:
+                record = self.cache.get(recordUuid)
+            if record is None:
+                missing.append(recordUuid)
+            else:
+                found[recordUuid] = record
+        missing = list(collections.OrderedDict.fromkeys(missing))
+        instrumentation.count("db.query", len(missing))
+        connection = self.connections.connection()
+        for start in range(0, len(missing), DB_MAX_PARAMS):
+            chunk = missing[start:start + DB_MAX_PARAMS]
+            loadCommand = "SELECT * FROM callsheet WHERE uuid IN ({})".format(
+                ",".join("?" * len(chunk))
+                )
+            for record in connection.execute(loadCommand, chunk):
+                self.cache.put(record)
+                found[record['uuid']] = record
+        return found
+
+    @instrumentation.timed("db.getByName")
     def getByName(self, name):
         """Fetches a record from the database using the name for the search.
 
@@ -177,6 +771,140 @@ class CallsheetDatabase(object):
         match.
 
         """
-        loadCommand = "SELECT * FROM callsheet WHERE name = '{}'".format(name)
-        record = self._fetchOneDBCmd(loadCommand)
+        record = self.cache.getBy('name', name)
+        if record is not None:
+            return record
+        loadCommand = "SELECT * FROM callsheet WHERE name = ?"
+        record = self._fetchOneDBCmd(loadCommand, (name,))
+        if record is not None:
+            self.cache.put(record, field='name')
         return record
+
+    @instrumentation.timed("db.getByTagId")
+    def getByTagId(self, nfcTagId):
+        """Fetches a record from the database using the NFC tag's hardware ID.
+
+        Like getByName, this is not guaranteed to match only one record, and
+        only one match will be returned.
+
+        Args:
+            nfcTagId (str): The UID of the NFC tag, as reported by the reader.
+
+        Returns:
+            dict: The record data from the database.
+
+        """
+        if self.stageIndex is not None:
+            record = self.stageIndex.getByTagId(nfcTagId)
+            if record is not None:
+                instrumentation.count("db.stageIndexHit")
+                return record
+        record = self.cache.getBy('nfcTagId', nfcTagId)
+        if record is not None:
+            instrumentation.count("db.cacheHit")
+            return record
+        instrumentation.count("db.query")
+        loadCommand = "SELECT * FROM callsheet WHERE nfcTagId = ?"
+        record = self._fetchOneDBCmd(loadCommand, (nfcTagId,))
+        if record is not None:
+            self.cache.put(record, field='nfcTagId')
+        return record
+
+    def createMany(self, callsheetRecords, batchSize=DB_BATCH_SIZE,
+                   replace=False, callback=None):
+        """Creates many records, writing them in batched transactions.
+
+        The records are consumed lazily; only batchSize of them are held in
+        memory at a time. Each batch is written with executemany inside of one
+        transaction, so a batch either lands completely or not at all.
+
+        Args:
+            callsheetRecords (iterable): The dicts of data to write. This may
+                be a generator.
+
+            batchSize (int): The number of records written per transaction.
+
+            replace (bool): Replace records whose uuid already exists rather
+                than failing on them.
+
+            callback (callable): Called with the number of records in each
+                batch, once that batch has been committed (optional).
+
+        Returns:
+            int: The total number of records written.
+
+        """
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        iterator = iter(callsheetRecords)
+        total = 0
+        while True:
+            batch = list(itertools.islice(iterator, batchSize))
+            if not batch:
+                return total
+            # Records may not all carry the same keys, so group them by key
+            # set; each group is one executemany.
+            groups = {}
+            for callsheetRecord in batch:
+                if not 'uuid' in callsheetRecord.keys():
+                    raise ValueError("Record for creation must contain a UUID.")
+                self.cache.invalidate(callsheetRecord['uuid'])
+                keys = tuple(_writableKeys(callsheetRecord))
+                groups.setdefault(keys, []).append(
+                    tuple(callsheetRecord[key] for key in keys)
+                    )
+            with self.transaction(immediate=True) as connection:
+                for (keys, rows) in groups.items():
+                    self._validateColumns(keys)
+                    writeCommand = "{} INTO callsheet ({}) VALUES ({})".format(
+                        verb,
+                        ",".join(keys),
+                        ",".join("?" * len(keys))
+                        )
+                    connection.executemany(writeCommand, rows)
+            for callsheetRecord in batch:
+                self._putInStageIndex(
+                    callsheetRecord,
+                    _writableKeys(callsheetRecord)
+                    )
+            total += len(batch)
+            if callback is not None:
+                callback(len(batch))
+
+    def iterRecords(self, batchSize=DB_BATCH_SIZE, location=None,
+                    since=None):
+        """Streams every record in the database, optionally filtered.
+
+        Rows are pulled from the cursor batchSize at a time, so the whole table
+        is never held in memory at once.
+
+        Args:
+            batchSize (int): The number of rows fetched per round trip.
+
+            location (str): Only stream records at this location (optional).
+
+            since (str): Only stream records modified at or after this
+                "modified" timestamp (optional).
+
+        Yields:
+            dict: The record data from the database.
+
+        """
+        loadCommand = "SELECT * FROM callsheet"
+        clauses = []
+        params = []
+        if location is not None:
+            clauses.append("location = ?")
+            params.append(location)
+        if since is not None:
+            clauses.append("modified >= ?")
+            params.append(since)
+        if clauses:
+            loadCommand += " WHERE " + " AND ".join(clauses)
+        connection = self.connections.connection()
+        cursor = connection.execute(loadCommand, params)
+        while True:
+            rows = cursor.fetchmany(batchSize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
@@ -0,0 +1,113 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+diagnostics.py - Timing options for the callsheet's scripts.
+
+DiagnosticsMixin adds the commandline options that time the phases of a
+script's run() with instrumentation.py, which BaseShellScript can't offer
+without depending on this package:
+
+    class BenchmarkApp(diagnostics.DiagnosticsMixin,
+                       shellscript_base.BaseShellScript):
+        ...
+
+    --stats, --statsFile PATH   the phase timings from instrumentation.py
+
+The profiling options, --profile, --profileSample and --traceAlloc, come
+with BaseShellScript itself.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import functools
+
+# local imports
+from . import instrumentation
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+__all__ = [
+    "DiagnosticsMixin",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class DiagnosticsMixin(object):
+    """Adds timing options to a BaseShellScript.
+
+    With --stats or --statsFile, the phases timed by instrumentation are
+    recorded while run() runs, and reported when it returns, inside any
+    profiler BaseShellScript wraps around run(). It must come before
+    BaseShellScript among the bases.
+
+    """
+    def _addDefaultArgs(self):
+        """Adds the timing arguments to the default ones."""
+        super(DiagnosticsMixin, self)._addDefaultArgs()
+        self.parser.add_argument(
+            '--stats',
+            action='store_true',
+            help='print how long each phase took when finished',
+            )
+        self.parser.add_argument(
+            '--statsFile',
+            metavar='PATH',
+            help='write how long each phase took to a JSON file when '
+                 'finished',
+            )
+
+    def _wrapRun(self, run):
+        """Wraps run() to record its timings, then in any profilers.
+
+        Args:
+            run (callable): The run() to wrap.
+
+        Returns:
+            callable: The wrapped run().
+
+        """
+        if self.args.stats or self.args.statsFile:
+            run = self._withStats(run)
+        return super(DiagnosticsMixin, self)._wrapRun(run)
+
+    def _withStats(self, run):
+        """Wraps run() to record instrumentation's timings, and report them.
+
+        Args:
+            run (callable): The run() to wrap.
+
+        Returns:
+            callable: The wrapped run().
+
+        """
+        @functools.wraps(run)
+        def runWithStats(*args, **kwargs):
+            instrumentation.enable()
+            try:
+                return run(*args, **kwargs)
+            finally:
+                instrumentation.disable()
+                self._reportStats()
+        return runWithStats
+
+    def _reportStats(self):
+        """Prints and/or saves the timings recorded, as asked."""
+        if self.args.stats:
+            print(instrumentation.REGISTRY.report())
+        if self.args.statsFile:
+            instrumentation.REGISTRY.dump(self.args.statsFile)
+            print("Stats written to {}".format(self.args.statsFile))
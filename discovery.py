@@ -0,0 +1,381 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+discovery.py - Finds the serial port the NFC reader is plugged into.
+
+On the stage PCs the reader shows up under whichever /dev/ttyACM* or
+/dev/ttyUSB* name the kernel hands it that day. Rather than guessing, every
+candidate port is probed in parallel: it is opened, the Arduino's boot banner
+is waited for, and the reader is asked to identify itself with a HELLO frame.
+A reply from device 1001 is our reader. Firmware that only speaks the
+original text protocol never replies, so for it the boot banner is taken as
+identification enough.
+
+The port that was found is cached, and is tried on its own before anything
+else the next time, so a reader that hasn't moved is connected to without
+touching any other port. The probe's open connection is handed over as is;
+opening the port again would reset the Arduino a second time.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import concurrent.futures
+import glob
+import os
+import struct
+import time
+
+# extended imports
+import serial
+import serial.tools.list_ports
+
+# local imports
+from . import framing
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+# Where Linux puts USB serial devices; other platforms ask pyserial instead.
+CANDIDATE_PATTERNS = ("/dev/ttyACM*", "/dev/ttyUSB*")
+# The last port a reader was found on:
+PORT_CACHE = os.path.join(os.path.expanduser("~"), ".nfcCallsheet_port")
+# Opening the port resets the Arduino, which then announces itself with this
+# banner once it is ready for commands. If the banner hasn't shown up within
+# BOOT_TIMEOUT seconds (a board that doesn't reset on open, for example), we
+# carry on regardless.
+BOOT_BANNER = b"Awaiting command"
+BOOT_TIMEOUT = 2.0
+# Seconds to wait for the reply to the identifying HELLO:
+IDENTIFY_TIMEOUT = 0.5
+
+
+__all__ = [
+    "candidatePorts",
+    "discoverReader",
+    "discoverReaders",
+    "identifyReader",
+    "loadCachedPort",
+    "saveCachedPort",
+    "sayHello",
+    "waitForBoot",
+    "ReaderProbe",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def candidatePorts():
+    """Lists the serial ports a reader might be plugged into.
+
+    Returns:
+        list: The port names, in sorted order.
+
+    """
+    ports = []
+    for pattern in CANDIDATE_PATTERNS:
+        ports.extend(glob.glob(pattern))
+    if not ports:
+        ports = [port.device for port in serial.tools.list_ports.comports()]
+    return sorted(set(ports))
+
+
+def loadCachedPort():
+    """Reads the port a reader was last found on.
+
+    Returns:
+        str: The port name, or None if nothing has been cached.
+
+    """
+    try:
+        with open(PORT_CACHE) as cacheFile:
+            return cacheFile.read().strip() or None
+    except OSError:
+        return None
+
+
+def saveCachedPort(port):
+    """Remembers the port a reader was found on, for next time.
+
+    Failing to write the cache only costs a slower start next time, so it is
+    not treated as an error.
+
+    Args:
+        port (str): The port name.
+
+    """
+    try:
+        with open(PORT_CACHE, 'w') as cacheFile:
+            cacheFile.write("{}\n".format(port))
+    except OSError as e:
+        print("Unable to cache reader port: {}".format(e))
+
+
+def waitForBoot(connection, timeout=BOOT_TIMEOUT):
+    """Waits for the Arduino to announce that it is ready.
+
+    Args:
+        connection (serial.Serial): A newly opened port.
+
+        timeout (float): The most seconds to wait.
+
+    Returns:
+        bool: True if the boot banner was seen.
+
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            connection.timeout = remaining
+            if BOOT_BANNER in connection.readline():
+                return True
+    finally:
+        connection.timeout = None
+
+
+def _waitForHelloAck(connection, timeout):
+    """Waits a limited time for the reply to a HELLO frame.
+
+    Args:
+        connection (serial.Serial): The port the HELLO was sent on.
+
+        timeout (float): The most seconds to wait.
+
+    Returns:
+        framing.Frame: The HELLO_ACK, or None if it didn't arrive in time.
+
+    """
+    parser = framing.FrameParser()
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            connection.timeout = remaining
+            data = connection.read(max(1, connection.in_waiting))
+            for frame in parser.feed(data):
+                if frame.msgType == framing.MSG_HELLO_ACK:
+                    return frame
+    finally:
+        connection.timeout = None
+
+
+def sayHello(connection, deviceId=framing.DEVICE_ID,
+             timeout=IDENTIFY_TIMEOUT):
+    """Asks whatever is on a port to identify itself with a HELLO frame.
+
+    Args:
+        connection (serial.Serial): The open port.
+
+        deviceId (int): The device ID to address the HELLO to.
+
+        timeout (float): Seconds to wait for the reply.
+
+    Returns:
+        framing.Frame: The HELLO_ACK, or None if it didn't arrive in time.
+
+    """
+    connection.write(framing.encodeFrame(
+        framing.MSG_HELLO,
+        struct.pack(">B", framing.PROTOCOL_VERSION),
+        deviceId
+        ))
+    return _waitForHelloAck(connection, timeout)
+
+
+def identifyReader(port, baudrate, deviceId=framing.DEVICE_ID,
+                   timeout=IDENTIFY_TIMEOUT):
+    """Opens one port and checks whether our reader is on the other end.
+
+    Args:
+        port (str): The port to probe.
+
+        baudrate (int): The rate the Arduino boots at.
+
+        deviceId (int): The device ID to look for.
+
+        timeout (float): Seconds to wait for the reply to the HELLO.
+
+    Returns:
+        ReaderProbe: The identified reader, with its connection still open,
+            or None if the port doesn't have our reader on it.
+
+    """
+    start = time.perf_counter()
+    try:
+        connection = serial.Serial(port, baudrate=baudrate)
+    except (serial.SerialException, OSError):
+        return None
+    try:
+        booted = waitForBoot(connection)
+        readyTime = time.perf_counter() - start
+        helloAck = sayHello(connection, deviceId, timeout)
+    except (serial.SerialException, OSError):
+        connection.close()
+        return None
+    if helloAck is not None and helloAck.deviceId == deviceId:
+        return ReaderProbe(port, connection, deviceId, helloAck, readyTime)
+    if helloAck is None and booted:
+        # The original firmware: it announced itself, but can't say more.
+        return ReaderProbe(port, connection, deviceId, None, readyTime)
+    connection.close()
+    return None
+
+
+def _releaseUnclaimed(future, claimed):
+    """Closes the connection of a probe that lost the race.
+
+    Args:
+        future (concurrent.futures.Future): A finished identifyReader call.
+
+        claimed (ReaderProbe): The probe that was kept.
+
+    """
+    probe = future.result()
+    if probe is not None and probe is not claimed:
+        probe.connection.close()
+
+
+def discoverReader(baudrate, deviceId=framing.DEVICE_ID, ports=None):
+    """Finds the reader, trying the port it was last found on first.
+
+    Args:
+        baudrate (int): The rate the Arduino boots at.
+
+        deviceId (int): The device ID to look for.
+
+        ports (list): The ports to search (optional). Defaults to every
+            candidate port.
+
+    Returns:
+        ReaderProbe: The reader that was found, with its connection open.
+
+    Raises:
+        SerialException: if no port has the reader on it.
+
+    """
+    start = time.perf_counter()
+    if ports is None:
+        ports = candidatePorts()
+    cachedPort = loadCachedPort()
+    found = None
+    if cachedPort:
+        found = identifyReader(cachedPort, baudrate, deviceId)
+        ports = [port for port in ports if port != cachedPort]
+    if found is None and ports:
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(ports)
+            )
+        futures = [
+            executor.submit(identifyReader, port, baudrate, deviceId)
+            for port in ports
+            ]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                found = future.result()
+                if found is not None:
+                    break
+        finally:
+            # Probes still running close their own port once they finish.
+            for future in futures:
+                future.add_done_callback(
+                    lambda done: _releaseUnclaimed(done, found)
+                    )
+            executor.shutdown(wait=False)
+    if found is None:
+        msg = "No NFC reader found. Is the NFC Reader plugged in?\n"\
+              "Is it being used by another program?"
+        raise serial.SerialException(msg)
+    if found.port != cachedPort:
+        saveCachedPort(found.port)
+    print("Found reader {} on {} in {:.2f}s.".format(
+        found.deviceId,
+        found.port,
+        time.perf_counter() - start
+        ))
+    return found
+
+
+def discoverReaders(baudrate, deviceId=framing.DEVICE_ID, ports=None):
+    """Finds every reader that is plugged in.
+
+    Args:
+        baudrate (int): The rate the Arduinos boot at.
+
+        deviceId (int): The device ID to look for.
+
+        ports (list): The ports to search (optional). Defaults to every
+            candidate port.
+
+    Returns:
+        list: A ReaderProbe for each reader found, with its connection open,
+            in port order.
+
+    """
+    if ports is None:
+        ports = candidatePorts()
+    if not ports:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(ports)) as executor:
+        probes = executor.map(
+            lambda port: identifyReader(port, baudrate, deviceId),
+            ports
+            )
+        found = [probe for probe in probes if probe is not None]
+    print("Found {} reader(s): {}".format(
+        len(found),
+        ", ".join(probe.port for probe in found)
+        ))
+    return found
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class ReaderProbe(object):
+    """A reader found on a port, with the port left open for use.
+
+    Args:
+        port (str): The port the reader is on.
+
+        connection (serial.Serial): The open connection to it.
+
+        deviceId (int): The reader's device ID.
+
+        helloAck (framing.Frame): Its reply to the identifying HELLO, or None
+            if it only speaks the original text protocol.
+
+        readyTime (float): Seconds from opening the port to the reader being
+            ready.
+
+    """
+    __slots__ = ("port", "connection", "deviceId", "helloAck", "readyTime")
+
+    def __init__(self, port, connection, deviceId, helloAck, readyTime):
+        self.port = port
+        self.connection = connection
+        self.deviceId = deviceId
+        self.helloAck = helloAck
+        self.readyTime = readyTime
+
+    def __repr__(self):
+        return "ReaderProbe(port={!r}, deviceId={})".format(
+            self.port,
+            self.deviceId
+            )
@@ -0,0 +1,355 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+framing.py - The binary serial protocol spoken with the Arduino.
+
+The original serial shorthand is line-oriented text ("nfc2py:1001:01", then
+"uid:0x04 0xBC ..." and so on). It is verbose, and any payload containing a
+colon or a line break confuses it. Once the Arduino has agreed to it during
+the handshake, messages are instead sent as compact binary frames:
+
+    offset  size  field
+    0       1     sync byte (0xA5)
+    1       1     protocol version
+    2       2     device ID (big-endian, 1001 for the callsheet reader)
+    4       1     message type
+    5       2     payload length (big-endian)
+    7       n     payload
+    7+n     2     CRC-16/CCITT-FALSE of bytes 1 through 6+n (big-endian)
+
+A frame whose CRC doesn't match is dropped, and the parser hunts for the next
+sync byte, so a corrupted frame is detected instead of misparsed. A stray
+sync byte can also claim a long payload that never comes, and hold up the
+real frames behind it; a frame still incomplete FRAME_TIMEOUT seconds after
+its header arrived is given up on the same way. The Arduino's side of the
+protocol lives in nfcPyInterface.ino.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import struct
+import time
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+SYNC = 0xA5
+PROTOCOL_VERSION = 1
+DEVICE_ID = 1001
+MAX_PAYLOAD = 1024
+# Seconds a frame may take to arrive once its header has; the Arduino writes
+# each frame whole, and the largest takes about 1.1 seconds at 9600 baud:
+FRAME_TIMEOUT = 1.5
+
+# Host -> Arduino
+MSG_HELLO = 0x01
+MSG_SET_BAUD = 0x03
+MSG_CANCEL = 0x05
+MSG_READ_REQUEST = 0x10
+MSG_SCAN_START = 0x14
+MSG_SCAN_STOP = 0x15
+MSG_WRITE_REQUEST = 0x20
+MSG_WRITE_PAYLOAD = 0x22
+# Arduino -> host
+MSG_HELLO_ACK = 0x02
+MSG_BAUD_ACK = 0x04
+MSG_TAG_UID = 0x11
+MSG_NDEF_RECORD = 0x12
+MSG_READ_DONE = 0x13
+MSG_SCAN_ACK = 0x16
+MSG_READY_FOR_PAYLOAD = 0x21
+MSG_WRITE_DONE = 0x23
+MSG_LOG = 0x7E
+MSG_ERROR = 0x7F
+
+# Flags in the optional payload byte of a SCAN_START. With UID_ONLY, each tag
+# is reported by its UID alone, and its NDEF records are not read. The
+# READ_DONE ending such a report carries the same flag in a second byte,
+# after the record count, so it can't be mistaken for the answer to a read:
+SCAN_UID_ONLY = 0x01
+
+# The status byte of a WRITE_DONE:
+WRITE_OK = 0
+WRITE_FAILED = 1
+# No tag was presented before the request timed out or was cancelled:
+WRITE_NO_TAG = 2
+
+# sync, version, device ID, message type, payload length:
+_HEADER = struct.Struct(">BBHBH")
+_CRC = struct.Struct(">H")
+
+
+__all__ = [
+    "crc16",
+    "encodeFrame",
+    "formatUid",
+    "requestTimeout",
+    "Frame",
+    "FrameParser",
+    "ProtocolError",
+]
+__author__ = 'astetson'
+
+
+def _makeCrcTable():
+    """Builds the lookup table for CRC-16/CCITT (polynomial 0x1021)."""
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+_CRC_TABLE = _makeCrcTable()
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def crc16(data, crc=0xFFFF):
+    """Computes the CRC-16/CCITT-FALSE checksum of some bytes.
+
+    Args:
+        data (bytes): The bytes to checksum.
+
+        crc (int): The starting value, for checksumming in pieces.
+
+    Returns:
+        int: The 16-bit checksum.
+
+    """
+    table = _CRC_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def encodeFrame(msgType, payload=b"", deviceId=DEVICE_ID):
+    """Packs a message into a binary frame, ready to be written to serial.
+
+    Args:
+        msgType (int): One of the MSG_* message types.
+
+        payload (bytes): The body of the message (optional).
+
+        deviceId (int): The device the message is addressed to or from.
+
+    Returns:
+        bytes: The encoded frame.
+
+    Raises:
+        ValueError: if the payload is too large for one frame.
+
+    """
+    if len(payload) > MAX_PAYLOAD:
+        msg = "Frame payload of {} bytes exceeds the {} byte maximum."
+        raise ValueError(msg.format(len(payload), MAX_PAYLOAD))
+    frame = bytearray(_HEADER.pack(
+        SYNC,
+        PROTOCOL_VERSION,
+        deviceId,
+        msgType,
+        len(payload)
+        ))
+    frame += payload
+    frame += _CRC.pack(crc16(memoryview(frame)[1:]))
+    return bytes(frame)
+
+
+def formatUid(uidBytes):
+    """Formats a tag UID the way the Arduino's PrintHex does.
+
+    This is the form nfcTagId values are stored in, such as
+    "0x04 0xBC 0xF9 0x0A 0x43 0x3D 0x80".
+
+    Args:
+        uidBytes (bytes): The raw UID.
+
+    Returns:
+        str: The formatted UID.
+
+    """
+    return " ".join("0x{:02X}".format(byte) for byte in uidBytes)
+
+
+def requestTimeout(payload):
+    """Reads the timeout a READ_REQUEST or WRITE_REQUEST may carry.
+
+    Args:
+        payload (bytes): The request's payload: the milliseconds to wait for
+            a tag, or nothing to wait forever.
+
+    Returns:
+        float: The timeout in seconds, or None to wait forever.
+
+    """
+    if len(payload) != 4:
+        return None
+    (milliseconds,) = struct.unpack(">I", payload)
+    return milliseconds / 1000.0 if milliseconds else None
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class ProtocolError(Exception):
+    """Raised when the Arduino reports an error, or breaks the protocol."""
+
+
+class Frame(object):
+    """One decoded message from the serial link.
+
+    Args:
+        msgType (int): One of the MSG_* message types.
+
+        payload (bytes): The body of the message.
+
+        deviceId (int): The device the message came from.
+
+        version (int): The protocol version the frame was encoded with.
+
+    """
+    __slots__ = ("msgType", "payload", "deviceId", "version")
+
+    def __init__(self, msgType, payload=b"", deviceId=DEVICE_ID,
+                 version=PROTOCOL_VERSION):
+        self.msgType = msgType
+        self.payload = payload
+        self.deviceId = deviceId
+        self.version = version
+
+    def __repr__(self):
+        return "Frame(msgType=0x{:02X}, deviceId={}, payload={!r})".format(
+            self.msgType,
+            self.deviceId,
+            self.payload
+            )
+
+    def __eq__(self, other):
+        return (isinstance(other, Frame) and
+                self.msgType == other.msgType and
+                self.payload == other.payload and
+                self.deviceId == other.deviceId)
+
+    def encode(self):
+        """Packs this frame for the wire.
+
+        Returns:
+            bytes: The encoded frame.
+
+        """
+        return encodeFrame(self.msgType, self.payload, self.deviceId)
+
+    @property
+    def text(self):
+        """str: The payload decoded as text, for LOG and ERROR messages."""
+        return self.payload.decode('utf-8', 'replace')
+
+
+class FrameParser(object):
+    """Incrementally pulls frames out of a stream of serial bytes.
+
+    Bytes can be fed in however they arrive; partial frames are held until the
+    rest shows up. Anything that isn't a valid frame, such as boot text or a
+    frame with a bad CRC, is skipped over and counted.
+
+    A partial frame is only held for frameTimeout seconds. After that, its
+    sync byte is taken to be a stray one, and the bytes after it are searched
+    again. The check is made whenever bytes are fed in, so a reader waiting
+    on frames should feed in b"" at stallDeadline() if nothing else arrives.
+
+    Args:
+        frameTimeout (float): Seconds to wait for the rest of a frame
+            (optional).
+
+    """
+    def __init__(self, frameTimeout=FRAME_TIMEOUT):
+        self.buffer = bytearray()
+        self.frameTimeout = frameTimeout
+        self.crcErrors = 0
+        self.stalledFrames = 0
+        self.discardedBytes = 0
+        # When the partial frame at the head of the buffer was first seen:
+        self._pendingSince = None
+
+    def stallDeadline(self):
+        """Reports when the partial frame being held will be given up on.
+
+        Returns:
+            float: The time.monotonic() deadline, or None if no frame is
+                partly received.
+
+        """
+        if self._pendingSince is None:
+            return None
+        return self._pendingSince + self.frameTimeout
+
+    def feed(self, data):
+        """Adds bytes from the serial link and returns any complete frames.
+
+        Args:
+            data (bytes): The bytes that just arrived.
+
+        Returns:
+            list: The Frame objects completed by these bytes, in order.
+
+        """
+        buf = self.buffer
+        buf += data
+        frames = []
+        while True:
+            start = buf.find(SYNC)
+            if start < 0:
+                self.discardedBytes += len(buf)
+                del buf[:]
+                break
+            if start:
+                self.discardedBytes += start
+                del buf[:start]
+            if len(buf) < _HEADER.size:
+                break
+            (_, version, deviceId, msgType, length) = _HEADER.unpack_from(buf)
+            if version != PROTOCOL_VERSION or length > MAX_PAYLOAD:
+                # Not a real frame start; resume the hunt past this byte.
+                self.discardedBytes += 1
+                del buf[:1]
+                continue
+            bodyEnd = _HEADER.size + length
+            frameSize = bodyEnd + _CRC.size
+            if len(buf) < frameSize:
+                now = time.monotonic()
+                if self._pendingSince is None:
+                    self._pendingSince = now
+                    break
+                if now - self._pendingSince < self.frameTimeout:
+                    break
+                # The rest never came, so this was a stray sync byte.
+                self._pendingSince = None
+                self.stalledFrames += 1
+                self.discardedBytes += 1
+                del buf[:1]
+                continue
+            self._pendingSince = None
+            (crc,) = _CRC.unpack_from(buf, bodyEnd)
+            if crc != crc16(memoryview(buf)[1:bodyEnd]):
+                self.crcErrors += 1
+                self.discardedBytes += 1
+                del buf[:1]
+                continue
+            payload = bytes(buf[_HEADER.size:bodyEnd])
+            frames.append(Frame(msgType, payload, deviceId, version))
+            del buf[:frameSize]
+        return frames
@@ -0,0 +1,370 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+instrumentation.py - Per-phase timings of reads, writes and lookups.
+
+When a scan feels slow on stage, this says where the time went: waiting for
+the RF field, moving bytes over the serial line, parsing NDEF data, the
+database, or printing and publishing. Each phase is timed into a Histogram,
+and notable events are counted, in one process-wide Registry.
+
+Nothing is recorded until enable() is called, and until then the hooks cost
+a flag check:
+
+    @instrumentation.timed("db.getByUuid")
+    def getByUuid(self, recordUuid):
+        ...
+
+    with instrumentation.phase("readTag.waitForTag"):
+        ...
+
+From the commandline, --stats prints a summary when the app finishes and
+--statsFile writes it out as JSON.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import contextlib
+import functools
+import json
+import math
+import threading
+import time
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+# Histogram buckets per doubling of duration; 8 keeps each within about 9%:
+BUCKETS_PER_DOUBLING = 8
+# The shortest duration told apart from zero, in seconds:
+MIN_DURATION = 1e-6
+# The percentiles reported:
+PERCENTILES = (0.50, 0.95, 0.99)
+
+_ENABLED = False
+# Handed out by phase() while disabled:
+_NULL_PHASE = contextlib.nullcontext()
+
+
+__all__ = [
+    "count",
+    "disable",
+    "enable",
+    "enabled",
+    "phase",
+    "record",
+    "timed",
+    "Histogram",
+    "Registry",
+    "REGISTRY",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def enable():
+    """Starts recording timings and counts."""
+    global _ENABLED
+    _ENABLED = True
+
+
+def disable():
+    """Stops recording timings and counts. What was recorded is kept."""
+    global _ENABLED
+    _ENABLED = False
+
+
+def enabled():
+    """Reports whether timings and counts are being recorded.
+
+    Returns:
+        bool: True if they are.
+
+    """
+    return _ENABLED
+
+
+def record(name, seconds):
+    """Adds one timing of a phase, if recording.
+
+    Args:
+        name (str): The phase, such as "readTag.waitForTag".
+
+        seconds (float): How long it took.
+
+    """
+    if _ENABLED:
+        REGISTRY.record(name, seconds)
+
+
+def count(name, amount=1):
+    """Counts an event, if recording.
+
+    Args:
+        name (str): The counter, such as "db.getByUuid.cacheHit".
+
+        amount (int): How much to add (optional).
+
+    """
+    if _ENABLED:
+        REGISTRY.count(name, amount)
+
+
+def phase(name):
+    """Times the enclosed block as one phase, if recording.
+
+    Args:
+        name (str): The phase.
+
+    Returns:
+        contextlib.AbstractContextManager: The timer, or a shared do-nothing
+            context while disabled.
+
+    """
+    if not _ENABLED:
+        return _NULL_PHASE
+    return _Phase(name)
+
+
+def timed(name):
+    """Decorator timing every call of a function as one phase.
+
+    Args:
+        name (str): The phase.
+
+    Returns:
+        callable: The decorator.
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                REGISTRY.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class _Phase(object):
+    """Context manager recording how long its block took.
+
+    Args:
+        name (str): The phase.
+
+    """
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        REGISTRY.record(self.name, time.perf_counter() - self.start)
+
+
+class Histogram(object):
+    """Durations of one phase, bucketed on a log scale.
+
+    Memory stays the same however many samples are added. Percentiles are
+    read off the buckets, so they are accurate to a bucket's width.
+
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, seconds):
+        """Adds one duration.
+
+        Args:
+            seconds (float): The duration.
+
+        """
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        bucket = 0
+        if seconds > MIN_DURATION:
+            bucket = int(math.log2(seconds / MIN_DURATION) *
+                         BUCKETS_PER_DOUBLING) + 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        """Estimates a percentile of the durations.
+
+        Args:
+            fraction (float): The percentile, from 0 to 1.
+
+        Returns:
+            float: The middle of the bucket holding that percentile, kept
+                within the shortest and longest durations seen, or None if
+                empty.
+
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(fraction * self.count)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        if bucket == 0:
+            return min(MIN_DURATION, self.max)
+        middle = MIN_DURATION * 2 ** (
+            (bucket - 0.5) / float(BUCKETS_PER_DOUBLING))
+        return max(self.min, min(middle, self.max))
+
+    def summary(self):
+        """Summarizes the durations.
+
+        Returns:
+            dict: The count, total, mean, min, max and percentiles, in
+                seconds.
+
+        """
+        summary = {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+        }
+        for fraction in PERCENTILES:
+            key = "p{}".format(int(fraction * 100))
+            summary[key] = self.percentile(fraction)
+        return summary
+
+
+class Registry(object):
+    """Every phase's Histogram and every counter, for one process."""
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        """Adds one timing of a phase.
+
+        Args:
+            name (str): The phase.
+
+            seconds (float): How long it took.
+
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, name, amount=1):
+        """Counts an event.
+
+        Args:
+            name (str): The counter.
+
+            amount (int): How much to add (optional).
+
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started = time.time()
+
+    def snapshot(self):
+        """Summarizes everything recorded so far.
+
+        Returns:
+            dict: "phases" (a summary per phase), "counters", and the
+                "started" and "taken" times.
+
+        """
+        with self._lock:
+            phases = dict(
+                (name, histogram.summary())
+                for (name, histogram) in self.histograms.items()
+                )
+            counters = dict(self.counters)
+        return {
+            "started": self.started,
+            "taken": time.time(),
+            "phases": phases,
+            "counters": counters,
+        }
+
+    def dump(self, path):
+        """Writes a snapshot to a JSON file.
+
+        Args:
+            path (str): The file to write.
+
+        """
+        with open(path, 'w') as statsFile:
+            json.dump(self.snapshot(), statsFile, indent=2, sort_keys=True)
+
+    def report(self):
+        """Formats a snapshot as a table for people to read.
+
+        Returns:
+            str: The table.
+
+        """
+        snapshot = self.snapshot()
+        lines = ["{:<32}{:>7}{:>10}{:>10}{:>10}{:>10}".format(
+            "phase", "count", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+        for (name, summary) in sorted(snapshot["phases"].items()):
+            row = "{:<32}{:>7}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}"
+            lines.append(row.format(
+                name,
+                summary["count"],
+                summary["p50"] * 1000,
+                summary["p95"] * 1000,
+                summary["p99"] * 1000,
+                summary["max"] * 1000,
+                ))
+        if snapshot["counters"]:
+            lines.append("")
+            lines.append("{:<32}{:>7}".format("counter", "count"))
+            for (name, value) in sorted(snapshot["counters"].items()):
+                lines.append("{:<32}{:>7}".format(name, value))
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
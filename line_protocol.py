@@ -0,0 +1,221 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+line_protocol.py - The original text protocol, parsed in bulk.
+
+Firmware that doesn't speak framing.py talks in lines of text:
+
+    nfc2py:1001:01
+    uid:0x04 0xBC 0xF9 0x0A 0x43 0x3D 0x80
+    num_ndef_records:1
+    payload:#name:Allen:
+    nfc2py:1001:02
+
+mixed in with whatever else the sketch prints along the way. Rather than a
+readline(), a decode and several splits per line, a LineParser takes the
+bytes in whatever chunks they arrive, finds line ends in one buffer, and
+decodes and splits each line exactly once into a Line. Lines that aren't
+protocol traffic go to a TextSink rather than to stdout.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import collections
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+SIGNAL_PREFIX = "nfc2py"
+
+# Transmission types of an "nfc2py:<device>:<type>" signal:
+SIGNAL_TAG_START = "01"
+SIGNAL_DONE = "02"
+SIGNAL_READY_FOR_PAYLOAD = "03"
+SIGNAL_SCAN_STOPPED = "04"
+
+# The kinds of Line:
+LINE_BLANK = 0
+LINE_SIGNAL = 1
+LINE_FIELD = 2
+LINE_TEXT = 3
+
+# The most recent device text lines a TextSink keeps:
+DEFAULT_SINK_LINES = 200
+# Whether new TextSinks print device text as well as keeping it:
+ECHO_DEVICE_TEXT = False
+
+
+__all__ = [
+    "Line",
+    "LineParser",
+    "TextSink",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class Line(object):
+    """One line of the text protocol, split up.
+
+    A signal ("nfc2py:1001:01") has its device ID in key and its
+    transmission type in value. A field ("uid:0x04 ...") has the text before
+    the first colon in key and the rest in value. Anything else is text.
+
+    Args:
+        kind (int): One of the LINE_* kinds.
+
+        text (str): The whole line, stripped of whitespace.
+
+        key (str): The device ID or field name (optional).
+
+        value (str): The transmission type or field value (optional).
+
+    """
+    __slots__ = ("kind", "text", "key", "value")
+
+    def __init__(self, kind, text, key=None, value=None):
+        self.kind = kind
+        self.text = text
+        self.key = key
+        self.value = value
+
+    def __repr__(self):
+        return "Line(kind={}, text={!r})".format(self.kind, self.text)
+
+    def isSignal(self, transmissionType=None):
+        """Checks whether this is an "nfc2py:" signal, optionally of a type.
+
+        Args:
+            transmissionType (str): The type to check for, such as "02"
+                (optional).
+
+        Returns:
+            bool: True if it is.
+
+        """
+        if self.kind != LINE_SIGNAL:
+            return False
+        return transmissionType is None or self.value == transmissionType
+
+
+def parseLine(text):
+    """Splits one line of text into a Line.
+
+    Args:
+        text (str): The line, stripped of whitespace.
+
+    Returns:
+        Line: The line.
+
+    """
+    if not text:
+        return Line(LINE_BLANK, text)
+    (key, colon, value) = text.partition(":")
+    if not colon:
+        return Line(LINE_TEXT, text)
+    if key == SIGNAL_PREFIX:
+        (deviceId, colon, transmissionType) = value.partition(":")
+        if colon:
+            return Line(LINE_SIGNAL, text, deviceId, transmissionType)
+        return Line(LINE_TEXT, text)
+    if " " in key:
+        # Prose with a colon in it, such as "  UID Value: 0x04 ..."
+        return Line(LINE_TEXT, text)
+    return Line(LINE_FIELD, text, key, value)
+
+
+class LineParser(object):
+    """Incrementally pulls Lines out of a stream of serial bytes.
+
+    Bytes can be fed in however they arrive. Complete lines are found in one
+    buffer and decoded straight from a view of it; a partial line is kept
+    until the rest shows up.
+
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.lineCount = 0
+
+    def feed(self, data):
+        """Adds bytes from the serial link and returns any complete lines.
+
+        Args:
+            data (bytes): The bytes that just arrived.
+
+        Returns:
+            list: The Line objects completed by these bytes, in order.
+
+        """
+        buf = self.buffer
+        searchFrom = len(buf)
+        buf += data
+        end = buf.find(b"\n", searchFrom)
+        if end < 0:
+            return []
+        lines = []
+        start = 0
+        view = memoryview(buf)
+        try:
+            while end >= 0:
+                text = str(view[start:end], 'utf-8', 'replace').strip()
+                lines.append(parseLine(text))
+                start = end + 1
+                end = buf.find(b"\n", start)
+        finally:
+            view.release()
+        del buf[:start]
+        self.lineCount += len(lines)
+        return lines
+
+
+class TextSink(object):
+    """Keeps the text the Arduino prints that isn't protocol traffic.
+
+    Boot banners, prompts and debug output are kept in a short ring of recent
+    lines, where they cost next to nothing, rather than printed as they
+    arrive. They are only printed if echo is on.
+
+    Args:
+        maxLines (int): The most recent lines to keep (optional).
+
+        echo (bool): Print each line as well (optional). Defaults to
+            ECHO_DEVICE_TEXT.
+
+    """
+    def __init__(self, maxLines=DEFAULT_SINK_LINES, echo=None):
+        self.recent = collections.deque(maxlen=maxLines)
+        self.count = 0
+        self.echo = ECHO_DEVICE_TEXT if echo is None else echo
+
+    def write(self, text):
+        """Takes one line of device text.
+
+        Args:
+            text (str): The line.
+
+        """
+        self.recent.append(text)
+        self.count += 1
+        if self.echo:
+            print(text)
+
+    def lines(self):
+        """Returns the lines kept, oldest first.
+
+        Returns:
+            list: The lines.
+
+        """
+        return list(self.recent)
@@ -27,10 +27,26 @@ which result in the update of the Callsheet.
 ###############################################################################
 # IMPORTS
 ###############################################################################
+# stdlib imports:
+import signal
+import threading
+
 # local imports:
 from . import records
+from . import callsheet_state
+from . import catalog
+from . import daemon
+from . import diagnostics
+from . import instrumentation
+from . import line_protocol
+from . import preload
+from . import publisher
+from . import reader_pool
+from . import scheduler
+from . import shoot
 from . import shellscript_base
 from . import serial_connection
+from . import tag_codec
 
 
 __all__ = [
@@ -66,7 +82,8 @@ def queryUserForData():
 ###############################################################################
 # CLASSES
 ###############################################################################
-class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
+class CallsheetCmdlineApp(diagnostics.DiagnosticsMixin,
+                          shellscript_base.BaseShellScript):
     """A simple implementation of software that can read/write NFC tags.
 
     In production, this would be a standalone GUI or potentially a plugin to
@@ -74,6 +91,15 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
     a prototype, a commandline interface is easiest for a proof of concept.
 
     """
+    def __init__(self):
+        super(CallsheetCmdlineApp, self).__init__()
+        # The running daemon to send requests to, if there is one:
+        self.client = None
+        # Where callsheet changes are sent once read, if anywhere:
+        self.publisher = None
+        # The props on the callsheet, so that only changes are published:
+        self.callsheet = callsheet_state.CallsheetState()
+
     def registerArgs(self):
         """Registers the commandline arguments for this tool."""
         self.parser.add_argument(
@@ -82,6 +108,61 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
             action='store_true',
             )
 
+        self.parser.add_argument(
+            '-scan',
+            help='read NFC tags continuously, pulling each record from DB',
+            action='store_true',
+            )
+
+        self.parser.add_argument(
+            '-debounce',
+            help='seconds within which a repeat scan of the same tag is '
+                 'ignored (default {})'.format(
+                     serial_connection.DEFAULT_DEBOUNCE),
+            type=float,
+            default=serial_connection.DEFAULT_DEBOUNCE,
+            )
+
+        self.parser.add_argument(
+            '-loadShoot',
+            help='scan in every prop for a shoot, then resolve them all at '
+                 'once into one callsheet manifest',
+            nargs='?',
+            const='',
+            metavar='NAME',
+            )
+
+        self.parser.add_argument(
+            '-manifest',
+            help='with -loadShoot, write the manifest to this JSON file',
+            metavar='PATH',
+            )
+
+        self.parser.add_argument(
+            '-fast',
+            help='with -scan, identify props by tag UID alone, only reading '
+                 'the whole tag when its UID is not on record',
+            action='store_true',
+            )
+
+        self.parser.add_argument(
+            '-fullTag',
+            help='with -create or -assign, write the whole record to the '
+                 'tag rather than just its uuid, sized for this type of tag '
+                 '(default {})'.format(tag_codec.DEFAULT_TAG_TYPE),
+            nargs='?',
+            const=tag_codec.DEFAULT_TAG_TYPE,
+            choices=sorted(tag_codec.TAG_CAPACITIES),
+            metavar='TAGTYPE',
+            )
+
+        self.parser.add_argument(
+            '-offline',
+            help='when reading or scanning, take records from tags that '
+                 'carry them whole, without the database',
+            action='store_true',
+            )
+
         self.parser.add_argument(
             '-create',
             help='create a new NFC Tags/DB Record',
@@ -100,6 +181,75 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
             action='store_true',
             )
 
+        self.parser.add_argument(
+            '-importCatalog',
+            help='bulk import prop records from a .csv or .jsonl file',
+            metavar='PATH',
+            )
+
+        self.parser.add_argument(
+            '-exportCatalog',
+            help='bulk export all prop records to a .csv or .jsonl file',
+            metavar='PATH',
+            )
+
+        self.parser.add_argument(
+            '-preload',
+            help='load every record for a stage location into memory at '
+                 'startup (defaults to {})'.format(records.DEFAULT_LOCATION),
+            nargs='?',
+            const=records.DEFAULT_LOCATION,
+            metavar='LOCATION',
+            )
+
+        self.parser.add_argument(
+            '-port',
+            help='the serial port the NFC reader is on (by default it is '
+                 'searched for)',
+            )
+
+        self.parser.add_argument(
+            '-capture',
+            help='record the traffic with the reader to a capture file, '
+                 'for replay.py',
+            metavar='PATH',
+            )
+
+        self.parser.add_argument(
+            '-readers',
+            help='with -scan, scan on several readers at once; with no '
+                 'ports, every reader plugged in is used',
+            nargs='*',
+            metavar='PORT[=NAME]',
+            )
+
+        self.parser.add_argument(
+            '-replace',
+            help='when importing, replace records whose uuid already exists',
+            action='store_true',
+            )
+
+        self.parser.add_argument(
+            '-daemon',
+            help='stay running, keeping the reader and database open, and '
+                 'serve read/create/update/assign requests from other runs',
+            action='store_true',
+            )
+
+        self.parser.add_argument(
+            '-socket',
+            help='the socket the daemon listens on (default {})'.format(
+                daemon.DEFAULT_SOCKET),
+            default=daemon.DEFAULT_SOCKET,
+            )
+
+        self.parser.add_argument(
+            '-publish',
+            help='send changes to the callsheet, as props are read or '
+                 'scanned, to the broker listening on this socket',
+            metavar='SOCKET',
+            )
+
     def run(self):
         """Runs the app.
 
@@ -111,8 +261,55 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
 
         The correct function is then called based on the current mode.
 
+        With -daemon, the app instead stays running and serves requests. When
+        a daemon is already running, reading, creating, updating and assigning
+        are sent to it rather than done here, so nothing has to be opened.
+        Options that only mean something in this process (-offline,
+        -preload, -port and -capture) keep the work here instead.
+
         """
-        super(CallsheetCmdlineApp, self).run()
+        if self.args.daemon:
+            self._startLocal()
+            print("I'm in Daemon Mode.")
+            daemon.serve(self.args.socket)
+            return
+        if self._usesDaemon():
+            self.client = daemon.connect(self.args.socket)
+        if self.client is None:
+            self._startLocal()
+        else:
+            self.printv("Using the daemon on {}".format(self.args.socket))
+        if self.args.publish:
+            self.publisher = publisher.Publisher(
+                publisher.SocketTransport(self.args.publish)
+                )
+            self.publisher.start()
+        try:
+            self._runMode()
+        finally:
+            if self.publisher is not None:
+                self.publisher.stop()
+                self.printv("Publisher: {}".format(self.publisher.counts))
+
+    def _usesDaemon(self):
+        """Reports whether the chosen mode may be handed to a running daemon.
+
+        Returns:
+            bool: True if a daemon should be looked for.
+
+        """
+        if (self.args.offline or self.args.preload or self.args.port
+                or self.args.capture):
+            # These would be silently ignored by a daemon.
+            return False
+        return bool(
+            self.args.create or self.args.update or self.args.assign or not (
+                self.args.importCatalog or self.args.exportCatalog
+                or self.args.scan or self.args.loadShoot is not None)
+            )
+
+    def _runMode(self):
+        """Calls the function for the mode chosen on the commandline."""
         if self.args.create:
             print("I'm in Create Mode")
             self.createTagAndRecord()
@@ -122,10 +319,37 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
         elif self.args.assign:
             print("I'm in Assign Mode.")
             self.assignNewTagtoRecord()
+        elif self.args.importCatalog:
+            print("I'm in Import Mode.")
+            catalog.importCatalog(
+                self.args.importCatalog,
+                replace=self.args.replace,
+                )
+        elif self.args.exportCatalog:
+            print("I'm in Export Mode.")
+            catalog.exportCatalog(self.args.exportCatalog)
+        elif self.args.scan:
+            print("I'm in Scan Mode")
+            self.scanTags()
+        elif self.args.loadShoot is not None:
+            print("I'm in Load Shoot Mode")
+            self.loadShoot()
         else:
             print("I'm in Read Mode")
             self.readTag()
 
+    def _startLocal(self):
+        """Opens the reader and preloads records, as asked, in this process."""
+        # Chatter from the reader's firmware is only shown when verbose:
+        line_protocol.ECHO_DEVICE_TEXT = self.verbose
+        if self.args.port or self.args.capture:
+            serial_connection.SerialConnection(
+                comPort=self.args.port,
+                capturePath=self.args.capture,
+                )
+        if self.args.preload:
+            preload.preloadStage(self.args.preload)
+
     def readTag(self):
         """Reads an NFC tag scanned by the user.
 
@@ -142,11 +366,189 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
         returns:
             dict: The record of keys and values that define this prop.
 
+        """
+        if self.client is not None:
+            record = records.CallsheetRecord(**self.client.request("read"))
+        else:
+            record = records.CallsheetRecord()
+            ndefData = scheduler.getScheduler().readTag().result()
+            record.populateFromTagData(ndefData, offline=self.args.offline)
+        self._printRecord(record)
+        self._publishRecord(record)
+        return record
+
+    def scanTags(self):
+        """Reads NFC tags continuously, as fast as the user can tap them.
+
+        The Arduino is put into scan mode, reporting each new tag on its own,
+        and every tag is resolved and printed in turn until the user presses
+        Ctrl+C.
+
+        """
+        if self.args.readers is not None:
+            self.scanTagsOnReaders()
+            return
+        commandScheduler = scheduler.getScheduler()
+        print("Tap tags on the reader. Press Ctrl+C to stop.")
+        for event in commandScheduler.scan(debounce=self.args.debounce,
+                                           uidOnly=self.args.fast):
+            record = self._resolveScan(commandScheduler, event)
+            if record is None:
+                continue
+            self._printRecord(record)
+            self._publishRecord(record)
+
+    def _resolveScan(self, reader, event):
+        """Turns a scanned tag into its record.
+
+        With -fast, a tag without a uuid is looked up by its UID. Only if
+        the UID isn't on record is the whole tag read, and only if the scan
+        reported the UID alone; a scan on the original text protocol has
+        already read it.
+
+        Args:
+            reader (scheduler.CommandScheduler): What is doing the scan, to
+                reread the tag with. An NfcSerialHandler will do, on the
+                thread doing the scan.
+
+            event (serial_connection.ScanEvent): The scan.
+
+        Returns:
+            records.CallsheetRecord: The record, or None if a UID-only tag
+                couldn't be identified.
+
         """
         record = records.CallsheetRecord()
-        record.populateFromTag()
-        record.populateFromDatabase()
+        ndefData = event.ndefData
+        if self.args.fast and 'uuid' not in ndefData:
+            if record.populateFromTagId(event.uid):
+                return record
+            if event.uidOnly:
+                ndefData = reader.rereadTag(event.uid)
+                if ndefData is None:
+                    print("Tag {} left the reader before it could be "
+                          "read.".format(event.uid))
+                    return None
+        record.populateFromTagData(ndefData, offline=self.args.offline)
+        return record
+
+    def scanTagsOnReaders(self):
+        """Reads NFC tags continuously from several readers at once.
 
+        Scans from every reader are resolved and printed in the order they
+        arrive, each marked with the reader that saw it, until the user
+        presses Ctrl+C.
+
+        """
+        readers = None
+        if self.args.readers:
+            readers = reader_pool.parseReaderSpecs(self.args.readers)
+        pool = reader_pool.ReaderPool(
+            readers=readers,
+            debounce=self.args.debounce,
+            uidOnly=self.args.fast,
+            resolve=self._resolvePoolScan,
+            )
+        with pool:
+            print("Tap tags on any reader. Press Ctrl+C to stop.")
+            for (event, record) in pool.events():
+                print("[{}]".format(event.readerId))
+                self._printRecord(record)
+                self._publishRecord(record)
+
+    def _resolvePoolScan(self, nfcSerialHandler, event):
+        """Turns a scan from one of a ReaderPool's readers into its record.
+
+        Runs on the reader's own thread, which can reread the tag.
+
+        Args:
+            nfcSerialHandler (serial_connection.NfcSerialHandler): The
+                handler doing the scan.
+
+            event (serial_connection.ScanEvent): The scan.
+
+        Returns:
+            tuple: The event and its records.CallsheetRecord, or None if a
+                UID-only tag couldn't be identified.
+
+        """
+        record = self._resolveScan(nfcSerialHandler, event)
+        if record is None:
+            return None
+        return (event, record)
+
+    def loadShoot(self):
+        """Scans in every prop for a shoot and builds its callsheet.
+
+        Tags are scanned continuously until the user presses Ctrl+C. Repeat
+        taps of the same prop are ignored. Every record is then resolved in
+        one step, and the manifest is printed, written to -manifest if given,
+        and published if publishing is turned on.
+
+        Returns:
+            dict: The shoot's manifest.
+
+        """
+        session = shoot.ShootSession(name=self.args.loadShoot or None)
+        done = threading.Event()
+        previousHandler = signal.signal(
+            signal.SIGINT,
+            lambda signalCode, frame: done.set()
+            )
+        commandScheduler = scheduler.getScheduler()
+        print("Tap every prop for the shoot. Press Ctrl+C when done.")
+        try:
+            for event in commandScheduler.scan(debounce=self.args.debounce,
+                                               stop=done):
+                if session.add(event):
+                    print("{:>4}: {}".format(len(session), event.uid))
+        finally:
+            signal.signal(signal.SIGINT, previousHandler)
+        if self.args.manifest:
+            manifest = session.writeManifest(self.args.manifest)
+            print("Manifest written to {}".format(self.args.manifest))
+        else:
+            manifest = session.manifest()
+        for record in manifest['props']:
+            self._printRecord(record)
+        self._publishDiff(self.callsheet.replace(manifest['props']))
+        for key in manifest['unknown']:
+            print("No record found for '{}'".format(key))
+        print("{} prop(s) loaded for the shoot.".format(
+            len(manifest['props'])))
+        return manifest
+
+    @instrumentation.timed("output.publish")
+    def _publishRecord(self, record):
+        """Puts a record on the callsheet, publishing the change if any.
+
+        Args:
+            record (dict): The resolved record.
+
+        """
+        self._publishDiff(self.callsheet.scan(record))
+
+    def _publishDiff(self, diff):
+        """Sends a callsheet diff on, if publishing is turned on.
+
+        Args:
+            diff (dict): The diff, or None if nothing changed.
+
+        """
+        if self.publisher is None or diff is None:
+            return
+        if not self.publisher.publishMessage(diff):
+            print("Publish queue full; callsheet change {} was not "
+                  "sent.".format(diff['sequence']))
+
+    @instrumentation.timed("output.print")
+    def _printRecord(self, record):
+        """Prints a record out for the user to read.
+
+        Args:
+            record (dict): The record to print.
+
+        """
         print("Record found:")
         print("---------- {} ----------".format(record['name']))
         for key in record.keys():
@@ -154,7 +556,6 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
                 continue
             print("{}: {}".format(key.rjust(13), record[key]))
         print("\n")
-        return record
 
     def createTagAndRecord(self):
         """Writes record data to an NFC tag.
@@ -166,9 +567,16 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
 
         """
         args = queryUserForData()
+        if self.client is not None:
+            self.client.request(
+                "create",
+                fields=args,
+                tagType=self.args.fullTag,
+                )
+            return
         record = records.CallsheetRecord(**args)
         record.writeToDatabase()
-        record.writeToTag()
+        record.writeToTag(tagType=self.args.fullTag)
 
     def updateRecordFromTag(self):
         """Allows a user to supplement an existing record with new data.
@@ -180,9 +588,17 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
         record = self.readTag()
         print("------")
         kwargs = queryUserForData()
-        record.update(kwargs)
-        record.writeToDatabase()
-        print("Update complete")
+        if self.client is not None:
+            result = self.client.request(
+                "update",
+                fields=kwargs,
+                uuid=record['uuid'],
+                )
+            changed = result["changed"]
+        else:
+            record.update(kwargs)
+            changed = record.saveToDatabase()
+        print("Update complete ({} field(s) changed)".format(len(changed)))
 
     def assignNewTagtoRecord(self):
         """Allows a user to copy a record from one tag to another.
@@ -213,7 +629,10 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
             name = input("Enter name of desired record: ")
             record = records.CallsheetRecord()
             record['name'] = name
-            record.populateFromDatabaseByName()
+            if self.client is not None:
+                record.update(self.client.request("lookup", name=name))
+            else:
+                record.populateFromDatabaseByName()
             print("Record for {} retrieved.".format(record['name']))
             self._updateRecordWithSwipedTag(record)
         else:
@@ -231,12 +650,16 @@ class CallsheetCmdlineApp(shellscript_base.BaseShellScript):
 
         """
         print("Swipe new tag to associate with this record.")
-        nfcSerialHandler = serial_connection.NfcSerialHandler()
-        newTagId = nfcSerialHandler.getTagIdFromTag()
-        kwargs = {"nfcTagId": newTagId}
-        record.update(**kwargs)
-        record.writeToDatabase()
-        record.writeToTag()
+        if self.client is not None:
+            self.client.request(
+                "assign",
+                uuid=record['uuid'],
+                tagType=self.args.fullTag,
+                )
+            return
+        record.populateTagIdFromTag()
+        record.saveToDatabase()
+        record.writeToTag(tagType=self.args.fullTag)
 
 
 ###############################################################################
@@ -16,87 +16,458 @@ PN532_I2C pn532_i2c(Wire);
 NfcAdapter nfcReader = NfcAdapter(pn532_i2c);
 
 
+// Binary framing, protocol version 1. The host side lives in framing.py:
+//   sync(0xA5) version deviceId(2) msgType length(2) payload crc16(2)
+// All multi-byte fields are big-endian. The CRC is CRC-16/CCITT-FALSE over
+// everything between the sync byte and the CRC itself.
+#define FRAME_SYNC        0xA5
+#define FRAME_VERSION     1
+#define DEVICE_ID         1001
+// Big enough for a whole record written to a tag: the tag writer takes at
+// most 255 bytes of data area, 13 of which go to the NDEF wrapping.
+#define FRAME_MAX_PAYLOAD 242
+// The most data area the tag writer can be given; it takes a one byte length.
+#define WRITER_MAX_DATA   255
+#define DEFAULT_BAUD      9600UL
+// 16MHz boards divide evenly into 250000; it is the fastest rate we offer.
+#define MAX_BAUD          250000UL
+// How long to wait for the host to confirm a baud rate change:
+#define BAUD_CONFIRM_MS   1000
+
+// Host -> Arduino
+#define MSG_HELLO             0x01
+#define MSG_SET_BAUD          0x03
+#define MSG_CANCEL            0x05
+#define MSG_READ_REQUEST      0x10
+#define MSG_WRITE_REQUEST     0x20
+#define MSG_WRITE_PAYLOAD     0x22
+#define MSG_SCAN_START        0x14
+#define MSG_SCAN_STOP         0x15
+// Arduino -> host
+#define MSG_HELLO_ACK         0x02
+#define MSG_BAUD_ACK          0x04
+#define MSG_TAG_UID           0x11
+#define MSG_NDEF_RECORD       0x12
+#define MSG_READ_DONE         0x13
+#define MSG_READY_FOR_PAYLOAD 0x21
+#define MSG_WRITE_DONE        0x23
+#define MSG_SCAN_ACK          0x16
+#define MSG_LOG               0x7E
+#define MSG_ERROR             0x7F
+
+// The status byte of a WRITE_DONE:
+#define WRITE_OK     0
+#define WRITE_FAILED 1
+#define WRITE_NO_TAG 2
+
+// Flags in the optional payload byte of a SCAN_START. A UID-only report ends
+// with a READ_DONE carrying the same flag after its record count:
+#define SCAN_UID_ONLY 0x01
+
+// How long to wait for the host's payload once we've said we're ready for it:
+#define PAYLOAD_TIMEOUT_MS 2000
+
 int incomingByte = 0;
-char serialBuffer[10];
+// Holds a command, or the "uuid:xxxxx" payload of a text protocol write:
+char serialBuffer[32];
 void readNFC(void);
+void reportTag(uint8_t success, uint8_t *uid, uint8_t uidLength,
+               bool uidOnly);
+void pollForTag(void);
 void writeNewRecord(void);
+void writeFramedPayload(uint16_t dataLength);
 void formatNewTag(void);
 
+// Once the host says hello with a binary frame, all of our replies are
+// framed too; until then we speak the original text shorthand.
+bool binaryMode = false;
+uint8_t frameType;
+uint16_t frameLength;
+uint8_t framePayload[FRAME_MAX_PAYLOAD + 1];
+
 String inputString = "";
 
+// In scan mode the reader keeps polling between commands and reports each
+// new tag that enters the field, without waiting for a read request.
+#define SCAN_POLL_MS 50
+bool scanMode = false;
+// With SCAN_UID_ONLY, scan mode reports each tag by its UID alone and skips
+// the slow NDEF read; the host asks for a full read if it needs one.
+bool scanUidOnly = false;
+// How long a binary read or write request waits for a tag, in ms. Zero waits
+// forever. A request may carry its own timeout as a 4-byte payload.
+unsigned long requestTimeoutMs = 0;
+// The tag seen by the previous poll, so a resting tag is only reported once:
+uint8_t lastUid[7];
+uint8_t lastUidLength = 0;
+
+void setScanMode(bool enabled) {
+  scanMode = enabled;
+  lastUidLength = 0;
+  if (!enabled) {
+    scanUidOnly = false;
+  }
+  if (binaryMode) {
+    uint8_t state = enabled ? 1 : 0;
+    sendFrame(MSG_SCAN_ACK, &state, 1);
+  } else if (enabled) {
+    Serial.println("Scanning.");
+  } else {
+    Serial.println("nfc2py:1001:04"); // signal that scanning has stopped
+  }
+  Serial.flush();
+}
+
+uint16_t crc16Update(uint16_t crc, uint8_t data) {
+  crc ^= (uint16_t)data << 8;
+  for (uint8_t i = 0; i < 8; i++) {
+    crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+  }
+  return crc;
+}
+
+void sendFrame(uint8_t msgType, const uint8_t *payload, uint16_t length) {
+  uint8_t header[6] = {
+    FRAME_VERSION,
+    (uint8_t)(DEVICE_ID >> 8), (uint8_t)(DEVICE_ID & 0xFF),
+    msgType,
+    (uint8_t)(length >> 8), (uint8_t)(length & 0xFF)
+  };
+  uint16_t crc = 0xFFFF;
+  Serial.write(FRAME_SYNC);
+  for (uint8_t i = 0; i < sizeof(header); i++) {
+    Serial.write(header[i]);
+    crc = crc16Update(crc, header[i]);
+  }
+  for (uint16_t i = 0; i < length; i++) {
+    Serial.write(payload[i]);
+    crc = crc16Update(crc, payload[i]);
+  }
+  Serial.write((uint8_t)(crc >> 8));
+  Serial.write((uint8_t)(crc & 0xFF));
+}
+
+void sendText(uint8_t msgType, const char *text) {
+  sendFrame(msgType, (const uint8_t *)text, strlen(text));
+}
+
+// Reports a message to the host: a LOG frame in binary mode, a line of text
+// otherwise.
+void logLine(const char *text) {
+  if (binaryMode) {
+    sendText(MSG_LOG, text);
+  } else {
+    Serial.println(text);
+  }
+}
+
+// Reports a failure to the host. Only binary mode has a way to say so; the
+// original text shorthand just prints it.
+void reportError(const char *text) {
+  if (binaryMode) {
+    sendText(MSG_ERROR, text);
+  } else {
+    Serial.println(text);
+  }
+}
+
+// Reads the rest of a frame whose sync byte was just consumed, filling
+// frameType, frameLength and framePayload. Returns false on a timeout, a bad
+// header or a CRC mismatch.
+bool readFrame(void) {
+  uint8_t header[6];
+  uint8_t crcBytes[2];
+  if (Serial.readBytes(header, sizeof(header)) != sizeof(header)) {
+    return false;
+  }
+  if (header[0] != FRAME_VERSION) {
+    return false;
+  }
+  frameType = header[3];
+  frameLength = ((uint16_t)header[4] << 8) | header[5];
+  if (frameLength > FRAME_MAX_PAYLOAD) {
+    return false;
+  }
+  if (Serial.readBytes(framePayload, frameLength) != frameLength) {
+    return false;
+  }
+  if (Serial.readBytes(crcBytes, 2) != 2) {
+    return false;
+  }
+  uint16_t crc = 0xFFFF;
+  for (uint8_t i = 0; i < sizeof(header); i++) {
+    crc = crc16Update(crc, header[i]);
+  }
+  for (uint16_t i = 0; i < frameLength; i++) {
+    crc = crc16Update(crc, framePayload[i]);
+  }
+  framePayload[frameLength] = 0;
+  return crc == (((uint16_t)crcBytes[0] << 8) | crcBytes[1]);
+}
+
+// Waits for the host to send something. Returns false if nothing arrives
+// within timeoutMs.
+bool waitForInput(unsigned long timeoutMs) {
+  unsigned long deadline = millis() + timeoutMs;
+  while (!Serial.available()) {
+    if ((long)(deadline - millis()) <= 0) {
+      return false;
+    }
+  }
+  return true;
+}
+
+// Waits for the next frame from the host, skipping anything that isn't one.
+// Returns false if no frame arrives within timeoutMs.
+bool waitForFrame(unsigned long timeoutMs) {
+  unsigned long deadline = millis() + timeoutMs;
+  while ((long)(deadline - millis()) > 0) {
+    if (Serial.available() && Serial.read() == FRAME_SYNC && readFrame()) {
+      return true;
+    }
+  }
+  return false;
+}
+
+void sendHelloAck(void) {
+  uint8_t payload[5] = {
+    FRAME_VERSION,
+    (uint8_t)(MAX_BAUD >> 24), (uint8_t)(MAX_BAUD >> 16),
+    (uint8_t)(MAX_BAUD >> 8), (uint8_t)(MAX_BAUD & 0xFF)
+  };
+  sendFrame(MSG_HELLO_ACK, payload, sizeof(payload));
+}
+
+// Acknowledges a baud rate change at the old rate, switches, then waits for
+// the host to say hello at the new rate. If it never does, fall back to the
+// default rate so that the host can still reach us.
+void changeBaud(void) {
+  if (frameLength != 4) {
+    reportError("Bad baud rate request.");
+    return;
+  }
+  unsigned long baud = ((unsigned long)framePayload[0] << 24) |
+                       ((unsigned long)framePayload[1] << 16) |
+                       ((unsigned long)framePayload[2] << 8) |
+                       (unsigned long)framePayload[3];
+  if (baud > MAX_BAUD) {
+    reportError("Baud rate not supported.");
+    return;
+  }
+  sendFrame(MSG_BAUD_ACK, framePayload, 4);
+  Serial.flush();
+  Serial.end();
+  Serial.begin(baud);
+  if (waitForFrame(BAUD_CONFIRM_MS) && frameType == MSG_HELLO) {
+    sendHelloAck();
+    return;
+  }
+  Serial.end();
+  Serial.begin(DEFAULT_BAUD);
+}
+
+// The timeout carried by a read or write request, if it has one.
+unsigned long payloadTimeout(void) {
+  if (frameLength != 4) {
+    return 0;
+  }
+  return ((unsigned long)framePayload[0] << 24) |
+         ((unsigned long)framePayload[1] << 16) |
+         ((unsigned long)framePayload[2] << 8) |
+         (unsigned long)framePayload[3];
+}
+
+// Waits for a tag to enter the field. In binary mode this polls, so that the
+// wait can end after requestTimeoutMs or when the host sends a CANCEL. The
+// original text protocol has no way to cancel, so it just waits.
+uint8_t waitForTag(uint8_t *uid, uint8_t *uidLength) {
+  if (!binaryMode) {
+    return nfc.readPassiveTargetID(PN532_MIFARE_ISO14443A, uid, uidLength);
+  }
+  unsigned long start = millis();
+  while (requestTimeoutMs == 0 || millis() - start < requestTimeoutMs) {
+    if (nfc.readPassiveTargetID(PN532_MIFARE_ISO14443A, uid, uidLength,
+                                SCAN_POLL_MS)) {
+      return 1;
+    }
+    if (Serial.available() && Serial.read() == FRAME_SYNC && readFrame()) {
+      if (frameType == MSG_CANCEL) {
+        return 0;
+      }
+      reportError("Busy; cancel the current request first.");
+    }
+  }
+  return 0;
+}
+
+void handleFrame(void) {
+  if (!readFrame()) {
+    if (binaryMode) {
+      reportError("Corrupt frame received.");
+    }
+    return;
+  }
+  switch (frameType) {
+    case MSG_HELLO:
+      binaryMode = true;
+      sendHelloAck();
+      break;
+    case MSG_SET_BAUD:
+      changeBaud();
+      break;
+    case MSG_READ_REQUEST:
+      requestTimeoutMs = payloadTimeout();
+      readNFC();
+      break;
+    case MSG_WRITE_REQUEST:
+      requestTimeoutMs = payloadTimeout();
+      writeNewRecord();
+      break;
+    case MSG_CANCEL:
+      // Nothing is waiting for a tag, so there is nothing to cancel.
+      break;
+    case MSG_SCAN_START:
+      scanUidOnly = frameLength >= 1 && (framePayload[0] & SCAN_UID_ONLY);
+      setScanMode(true);
+      break;
+    case MSG_SCAN_STOP:
+      setScanMode(false);
+      break;
+    default:
+      reportError("Unknown message type.");
+  }
+}
+
 void setup(void) {
-  Serial.begin(9600);
-  Serial.println("NFC Callsheet Python Interface launched. Awaiting command...");
+  Serial.begin(DEFAULT_BAUD);
   nfc.begin();
+  // The host waits for this banner before it says anything, so only print it
+  // once we're actually ready for commands.
+  Serial.println("NFC Callsheet Python Interface launched. Awaiting command...");
+  Serial.flush();
 }
 
 void loop(void) {
   if (Serial.available() > 0){
     incomingByte = Serial.read();
     //Serial.println(incomingByte, DEC);
-    if(incomingByte == 58){
+    if(incomingByte == FRAME_SYNC){
+      handleFrame();
+    } else if(incomingByte == 58){
       Serial.readBytesUntil(58, serialBuffer, 10);
       if(strcmp(serialBuffer,"read")==0){
         Serial.println("Read.");
-        delay(10);
         readNFC();
       } else if(strcmp(serialBuffer,"new")==0){
         Serial.println("New record.");
-        delay(10);
         writeNewRecord();
+      } else if(strcmp(serialBuffer,"scan")==0){
+        setScanMode(true);
+      } else if(strcmp(serialBuffer,"stop")==0){
+        setScanMode(false);
       }
       memset(serialBuffer, 0, sizeof(serialBuffer));
     }
+  } else if (scanMode) {
+    pollForTag();
   }
 }
 
+// One short scan-mode poll of the RF field. A tag is reported when it first
+// shows up; it has to leave the field before it will be reported again.
+void pollForTag(void) {
+  uint8_t uid[] = { 0, 0, 0, 0, 0, 0, 0 };
+  uint8_t uidLength;
+  if (!nfc.readPassiveTargetID(PN532_MIFARE_ISO14443A, uid, &uidLength,
+                               SCAN_POLL_MS)) {
+    lastUidLength = 0;
+    return;
+  }
+  if (uidLength == lastUidLength && memcmp(uid, lastUid, uidLength) == 0) {
+    return;
+  }
+  memcpy(lastUid, uid, uidLength);
+  lastUidLength = uidLength;
+  reportTag(1, uid, uidLength, scanUidOnly);
+}
+
 void readNFC(void) {
-  Serial.println("Ready to read. Place NFC tag on reader.");
+  logLine("Ready to read. Place NFC tag on reader.");
   Serial.flush();
-  delay(10);
   uint8_t success;
   uint8_t uid[] = { 0, 0, 0, 0, 0, 0, 0 };  // Buffer to store the returned UID
   uint8_t uidLength;                        // Length of the UID (4 or 7 bytes depending on ISO14443A card type)
 
   // Wait for an NTAG203 card.  When one is found 'uid' will be populated with
   // the UID, and uidLength will indicate the size of the UUID (normally 7)
-  success = nfc.readPassiveTargetID(PN532_MIFARE_ISO14443A, uid, &uidLength);
+  success = waitForTag(uid, &uidLength);
+  reportTag(success, uid, uidLength, false);
+}
+
+// Sends everything we know about a tag to the host: its UID and the payload
+// of each NDEF record, followed by the end of transmission signal. With
+// uidOnly (binary mode only), the NDEF records are left unread.
+void reportTag(uint8_t success, uint8_t *uid, uint8_t uidLength,
+               bool uidOnly) {
+  uidOnly = uidOnly && binaryMode;
+  uint8_t recordCount = 0;
   if (success) 
   {
-    // Display some basic information about the card
-    Serial.println("Found an ISO14443A card");
-    Serial.print("  UID Length: ");Serial.print(uidLength, DEC);Serial.println(" bytes");
-    Serial.print("  UID Value: ");
-    nfc.PrintHex(uid, uidLength);
-    Serial.println("");
-    Serial.flush();
+    if (!binaryMode) {
+      // Display some basic information about the card
+      Serial.println("Found an ISO14443A card");
+      Serial.print("  UID Length: ");Serial.print(uidLength, DEC);Serial.println(" bytes");
+      Serial.print("  UID Value: ");
+      nfc.PrintHex(uid, uidLength);
+      Serial.println("");
+      Serial.flush();
+    }
     
     if (uidLength == 7)
     {
       uint8_t data[32];  
       // We probably have an NTAG2xx card (though it could be Ultralight as well)
-      Serial.println("Seems to be an NTAG2xx tag (7 byte UID)");    
-      Serial.println("nfc2py:1001:01"); // signal the start of a data transmission
-      Serial.print("uid:");
-      nfc.PrintHex(uid, uidLength);
-      Serial.flush();
+      if (binaryMode) {
+        sendFrame(MSG_TAG_UID, uid, uidLength);
+      } else {
+        Serial.println("Seems to be an NTAG2xx tag (7 byte UID)");    
+        Serial.println("nfc2py:1001:01"); // signal the start of a data transmission
+        Serial.print("uid:");
+        nfc.PrintHex(uid, uidLength);
+        Serial.flush();
+      }
+
+      if (uidOnly) {
+        // The host resolves the tag by its UID; no need to read it.
+        uint8_t done[2] = { recordCount, SCAN_UID_ONLY };
+        sendFrame(MSG_READ_DONE, done, sizeof(done));
+        Serial.flush();
+        return;
+      }
 
       NfcTag tag = nfcReader.read();
       if (tag.hasNdefMessage()) // every tag won't have a message
       {
         NdefMessage message = tag.getNdefMessage();
-        // Report number of NDEF records:
-        Serial.print("num_ndef_records:");
-        Serial.println(message.getRecordCount());
+        recordCount = message.getRecordCount();
+        if (!binaryMode) {
+          // Report number of NDEF records:
+          Serial.print("num_ndef_records:");
+          Serial.println(recordCount);
+        }
         
         // cycle through the records, printing some info from each
-        int recordCount = message.getRecordCount();
         for (int i = 0; i < recordCount; i++)
         {
           NdefRecord record = message.getRecord(i);
           int payloadLength = record.getPayloadLength();
           byte payload[payloadLength];
           record.getPayload(payload);
+          if (binaryMode) {
+            // Raw bytes; the frame carries the length, so no escaping needed
+            sendFrame(MSG_NDEF_RECORD, payload, payloadLength);
+            continue;
+          }
           // Print the payload to the serial buffer
           String payloadAsString = "";
           for (int c = 0; c < payloadLength; c++) {
@@ -109,48 +480,61 @@ void readNFC(void) {
     } // UID length = 7
     else
     {
-      Serial.println("This doesn't seem to be an NTAG203 tag (UUID length != 7 bytes)!");
+      logLine("This doesn't seem to be an NTAG203 tag (UUID length != 7 bytes)!");
     }
   }
-  Serial.println("nfc2py:1001:02"); // signal the end of a data transmission
+  if (binaryMode) {
+    sendFrame(MSG_READ_DONE, &recordCount, 1); // end of the data transmission
+  } else {
+    Serial.println("nfc2py:1001:02"); // signal the end of a data transmission
+  }
   Serial.flush();
 }
 
 void writeNewRecord(void){
-  Serial.println("\nPlace a Mifare NDEF tag on the reader.");
+  logLine("\nPlace a Mifare NDEF tag on the reader.");
   uint8_t success;
   uint8_t uid[] = { 0, 0, 0, 0, 0, 0, 0 };  // Buffer to store the returned UID
   uint8_t uidLength;                        // Length of the UID (4 or 7 bytes depending on ISO14443A card type)
-  uint8_t dataLength;
+  uint16_t dataLength;
   bool loopMe;
   // 1.) Wait for an read tag
-  success = nfc.readPassiveTargetID(PN532_MIFARE_ISO14443A, uid, &uidLength);
+  success = waitForTag(uid, &uidLength);
+  if (!success && binaryMode) {
+    // Timed out or cancelled before a tag showed up
+    uint8_t status = WRITE_NO_TAG;
+    sendFrame(MSG_WRITE_DONE, &status, 1);
+    Serial.flush();
+    return;
+  }
   // It seems we found a valid ISO14443A Tag!
   if (success) 
   {
-    // 2.) Display some basic information about the card
-    Serial.println("Found an ISO14443A card");
-    Serial.print("  UID Length: ");Serial.print(uidLength, DEC);Serial.println(" bytes");
-    Serial.print("  UID Value: ");
-    nfc.PrintHex(uid, uidLength);
-    Serial.println("");
+    if (!binaryMode) {
+      // 2.) Display some basic information about the card
+      Serial.println("Found an ISO14443A card");
+      Serial.print("  UID Length: ");Serial.print(uidLength, DEC);Serial.println(" bytes");
+      Serial.print("  UID Value: ");
+      nfc.PrintHex(uid, uidLength);
+      Serial.println("");
+    }
     
     if (uidLength != 7)
     {
-      Serial.println("This doesn't seem to be an NTAG203 tag (UUID length != 7 bytes)!");
+      reportError("This doesn't seem to be an NTAG203 tag (UUID length != 7 bytes)!");
     }
     else
     {
       uint8_t data[32];
       // We probably have an NTAG2xx card (though it could be Ultralight as well)
-      Serial.println("Seems to be an NTAG2xx tag (7 byte UID)");    
+      logLine("Seems to be an NTAG2xx tag (7 byte UID)");    
       // 3.) Check if the NDEF Capability Container (CC) bits are already set
       // in OTP memory (page 3)
       memset(data, 0, 4);
       success = nfc.ntag2xx_ReadPage(3, data);
       if (!success)
       {
-        Serial.println("Unable to read the Capability Container (page 3)");
+        reportError("Unable to read the Capability Container (page 3)");
         return;
       }
       else
@@ -162,40 +546,54 @@ void writeNewRecord(void){
         // Byte 3 = Read/Write Access (0x00 for full read and write)
         if (!((data[0] == 0xE1) && (data[1] == 0x10)))
         {
-          Serial.println("This doesn't seem to be an NDEF formatted tag.");
-          Serial.println("Page 3 should start with 0xE1 0x10.");
+          reportError("This doesn't seem to be an NDEF formatted tag. "
+                      "Page 3 should start with 0xE1 0x10.");
         }
         else
         {
           // 4.) Determine and display the data area size
           dataLength = data[2]*8;
-          Serial.print("Tag is NDEF formatted. Data area size = ");
-          Serial.print(dataLength);
-          Serial.println(" bytes");
+          if (!binaryMode) {
+            Serial.print("Tag is NDEF formatted. Data area size = ");
+            Serial.print(dataLength);
+            Serial.println(" bytes");
           
+            Serial.print("Erasing previous data area ");
+          }
           // 5.) Erase the old data area
-          Serial.print("Erasing previous data area ");
-          for (uint8_t i = 4; i < (dataLength/4)+4; i++) 
+          for (uint16_t i = 4; i < (dataLength/4)+4; i++) 
           {
             memset(data, 0, 4);
             success = nfc.ntag2xx_WritePage(i, data);
-            Serial.print(".");
+            if (!binaryMode) {
+              Serial.print(".");
+            }
             if (!success)
             {
-              Serial.println(" ERROR!");
+              reportError(" ERROR!");
               return;
             }
           }
-          Serial.println(" Done erasing.");
+          logLine(" Done erasing.");
+
+          if (binaryMode) {
+            writeFramedPayload(dataLength);
+            return;
+          }
 
           // 6.) Send word to python lib that we are ready,
           // and need the message to write
           Serial.println("nfc2py:1001:03");
-          delay(1000);
+          Serial.flush();
           // 7.) Now listen for a reply, write what we hear
-          while (!Serial.available());
+          if (!waitForInput(PAYLOAD_TIMEOUT_MS)) {
+            Serial.println("ERROR- NO INPUT TO WRITE WAS RECEIVED.");
+            return;
+          }
           while (Serial.available()){
-          int numReceived = Serial.readBytesUntil(36, serialBuffer, 50);
+          memset(serialBuffer, 0, sizeof(serialBuffer));
+          int numReceived = Serial.readBytesUntil(36, serialBuffer,
+                                                  sizeof(serialBuffer) - 1);
           if (numReceived == 0){
             Serial.println("ERROR- NO INPUT TO WRITE WAS RECEIVED.");
           } else {
@@ -203,10 +601,10 @@ void writeNewRecord(void){
             Serial.println(numReceived);
           }
           uint8_t ndefprefix = NDEF_URIPREFIX_URN_NFC;
-          delay(10);
           Serial.print("wrote:");
           Serial.println(serialBuffer);
-          success = nfc.ntag2xx_WriteNDEFURI(ndefprefix, serialBuffer, dataLength);
+          success = nfc.ntag2xx_WriteNDEFURI(ndefprefix, serialBuffer,
+                                            min(dataLength, WRITER_MAX_DATA));
           if (success) 
           {
             Serial.println("Done writing.");
@@ -225,5 +623,33 @@ void writeNewRecord(void){
   } // Tag found
 }
 
-
-
+// Binary mode steps 6 and 7 of writeNewRecord: ask the host for the payload,
+// then write the payload frame it sends us to the tag as a URN URI.
+void writeFramedPayload(uint16_t dataLength){
+  sendFrame(MSG_READY_FOR_PAYLOAD, NULL, 0);
+  Serial.flush();
+  while (true) {
+    if (!waitForInput(PAYLOAD_TIMEOUT_MS)) {
+      reportError("No payload to write was received.");
+      return;
+    }
+    if (Serial.read() != FRAME_SYNC) {
+      continue;
+    }
+    if (!readFrame()) {
+      reportError("Corrupt frame received.");
+      continue;
+    }
+    if (frameType == MSG_WRITE_PAYLOAD) {
+      break;
+    }
+    reportError("Expected a write payload.");
+  }
+  // readFrame leaves the payload NUL terminated
+  uint8_t status = nfc.ntag2xx_WriteNDEFURI(
+    NDEF_URIPREFIX_URN_NFC, (char *)framePayload,
+    min(dataLength, WRITER_MAX_DATA)) ?
+    WRITE_OK : WRITE_FAILED;
+  sendFrame(MSG_WRITE_DONE, &status, 1);
+  Serial.flush();
+}
@@ -0,0 +1,276 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+preload.py - An in-memory index of every prop on one stage.
+
+A stage only ever scans its own props. Rather than looking each one up as it
+is scanned, every record for the stage's location can be pulled from the
+database in one streamed query at startup. Scans are then resolved from
+memory, by uuid or by NFC tag ID, with no trip to the database at all.
+
+The index can be refreshed incrementally. Only the rows modified since the
+last load are pulled, using the database's "modified" column. Records
+written through the database in this process are put straight into the
+index as they are written.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import threading
+import time
+
+# local imports
+from . import records
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+__all__ = [
+    "preloadStage",
+    "StageIndex",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def preloadStage(location=None, db=None, refreshInterval=None):
+    """Loads a stage's props and puts the shared database in front of them.
+
+    Once this has run, CallsheetDatabase.getByUuid and getByTagId answer from
+    the index for any prop at the location.
+
+    Args:
+        location (str): The stage location to preload (optional). Defaults to
+            the default location for new records.
+
+        db (database.CallsheetDatabase): The database to preload from and to
+            attach the index to (optional). Defaults to the shared database.
+
+        refreshInterval (float): Seconds between automatic incremental
+            refreshes (optional). By default the index is never refreshed
+            automatically.
+
+    Returns:
+        StageIndex: The loaded index.
+
+    """
+    db = db or records.CALLSHEET_DB
+    stageIndex = StageIndex(
+        location or records.DEFAULT_LOCATION,
+        db=db,
+        refreshInterval=refreshInterval,
+        )
+    stageIndex.load()
+    db.stageIndex = stageIndex
+    return stageIndex
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class StageIndex(object):
+    """Every record at one location, indexed in memory by uuid and tag ID.
+
+    Args:
+        location (str): The stage location whose records are indexed.
+
+        db (database.CallsheetDatabase): The database to load from
+            (optional). Defaults to the shared database.
+
+        refreshInterval (float): Seconds between automatic incremental
+            refreshes, checked on lookup (optional).
+
+    """
+    def __init__(self, location, db=None, refreshInterval=None):
+        self.location = location
+        self.db = db or records.CALLSHEET_DB
+        self.refreshInterval = refreshInterval
+        # The newest "modified" stamp seen; the next refresh starts here:
+        self.lastModified = None
+        self._lastRefresh = None
+        self._lock = threading.RLock()
+        self._byUuid = {}
+        self._byTagId = {}
+
+    def __len__(self):
+        return len(self._byUuid)
+
+    def __contains__(self, recordUuid):
+        return recordUuid in self._byUuid
+
+    def _add(self, record):
+        """Indexes one record, replacing any older copy of it.
+
+        Must be called with the lock held.
+
+        Args:
+            record (dict): The record data from the database.
+
+        """
+        self._remove(record['uuid'])
+        # Held as compact records; a whole stage of dicts adds up.
+        record = records.CallsheetRecord.fromRow(record)
+        self._byUuid[record['uuid']] = record
+        if record.get('nfcTagId'):
+            self._byTagId[record['nfcTagId']] = record
+        modified = record.get('modified')
+        if modified and (self.lastModified is None or
+                         modified > self.lastModified):
+            self.lastModified = modified
+
+    def _remove(self, recordUuid):
+        """Drops one record from the index, if it is there.
+
+        Must be called with the lock held.
+
+        Args:
+            recordUuid (str): The uuid of the record to drop.
+
+        """
+        record = self._byUuid.pop(recordUuid, None)
+        if record is None:
+            return
+        tagId = record.get('nfcTagId')
+        if tagId and self._byTagId.get(tagId) is record:
+            del self._byTagId[tagId]
+
+    def _refreshIfDue(self):
+        """Runs an incremental refresh if the refresh interval has passed."""
+        if self.refreshInterval is None or self._lastRefresh is None:
+            return
+        if time.monotonic() - self._lastRefresh >= self.refreshInterval:
+            self.refresh()
+
+    def load(self):
+        """Loads every record at the location, replacing the current index.
+
+        Returns:
+            int: The number of records loaded.
+
+        """
+        with self._lock:
+            self._byUuid = {}
+            self._byTagId = {}
+            self.lastModified = None
+            for record in self.db.iterRecords(location=self.location):
+                self._add(record)
+            self._lastRefresh = time.monotonic()
+        print("Preloaded {} records for {}".format(len(self), self.location))
+        return len(self)
+
+    def refresh(self):
+        """Pulls in only the records modified since the last load or refresh.
+
+        Records that were moved to another location are dropped from the
+        index.
+
+        Returns:
+            int: The number of changed records that were seen.
+
+        """
+        if self.lastModified is None:
+            return self.load()
+        count = 0
+        with self._lock:
+            for record in self.db.iterRecords(since=self.lastModified):
+                count += 1
+                if record['location'] == self.location:
+                    self._add(record)
+                else:
+                    self._remove(record['uuid'])
+            self._lastRefresh = time.monotonic()
+        return count
+
+    def put(self, record):
+        """Indexes a record that was just written, replacing any older copy.
+
+        A record written to some other location is dropped instead.
+
+        Args:
+            record (dict): The record data, as written to the database.
+
+        """
+        with self._lock:
+            if record.get('location') == self.location:
+                self._add(record)
+            else:
+                self._remove(record['uuid'])
+
+    def merge(self, changes, recordUuid, staleFields=()):
+        """Writes changed fields through to an indexed record.
+
+        If the record is not indexed, nothing happens; the next refresh
+        picks it up if it belongs here now.
+
+        Args:
+            changes (dict): The fields that were written.
+
+            recordUuid (str): The uuid of the record that was written.
+
+            staleFields (iterable): Fields that the write changed to values
+                the caller doesn't know, to be dropped from the indexed copy.
+
+        """
+        with self._lock:
+            record = self._byUuid.get(recordUuid)
+            if record is None:
+                return
+            record = dict(record)
+            record.update(changes)
+            for field in staleFields:
+                record.pop(field, None)
+            self.put(record)
+
+    def discard(self, recordUuid):
+        """Drops a record from the index until the next refresh.
+
+        Args:
+            recordUuid (str): The uuid of the record to drop.
+
+        """
+        with self._lock:
+            self._remove(recordUuid)
+
+    def get(self, recordUuid):
+        """Fetches a record by its uuid.
+
+        Args:
+            recordUuid (str): The uuid of the record.
+
+        Returns:
+            dict: A copy of the record, or None if it is not indexed.
+
+        """
+        self._refreshIfDue()
+        record = self._byUuid.get(recordUuid)
+        if record is None:
+            return None
+        return dict(record)
+
+    def getByTagId(self, nfcTagId):
+        """Fetches a record by the hardware ID of its NFC tag.
+
+        Args:
+            nfcTagId (str): The UID of the NFC tag, as reported by the reader.
+
+        Returns:
+            dict: A copy of the record, or None if it is not indexed.
+
+        """
+        self._refreshIfDue()
+        record = self._byTagId.get(nfcTagId)
+        if record is None:
+            return None
+        return dict(record)
@@ -0,0 +1,347 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+profiling.py - Profilers that can be wrapped around any function.
+
+shellscript_base.BaseShellScript wraps a script's run() in these when asked
+to on the commandline, so any script can be profiled without touching its
+code. Only the standard library is used, so BaseShellScript can import this
+as it needs it:
+
+    profiled(run)             cProfile; every call, at a cost to speed.
+    sampled(run)              Looks at every thread's stack now and then;
+                              cheap enough to leave on for a whole session.
+    allocationsTraced(run)    tracemalloc; where memory was allocated, and
+                              the peak.
+
+Each prints its report when the function returns, however it returns, or
+saves it to a file if given a path.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import collections
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+# What cProfile's report is sorted by, unless told otherwise:
+DEFAULT_SORT = "cumulative"
+# Functions listed in a profile report:
+DEFAULT_LIMIT = 30
+# Seconds between looks at the stacks, when sampling:
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# Lines listed in an allocation report:
+DEFAULT_ALLOC_LIMIT = 10
+# Frames kept per allocation traced:
+DEFAULT_ALLOC_FRAMES = 1
+
+
+__all__ = [
+    "allocationsTraced",
+    "profiled",
+    "sampled",
+    "SamplingProfiler",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def profiled(func, path=None, sortBy=DEFAULT_SORT, limit=DEFAULT_LIMIT):
+    """Wraps a function to run under cProfile.
+
+    Args:
+        func (callable): The function.
+
+        path (str): Save the stats here, for pstats or snakeviz, rather than
+            printing them (optional).
+
+        sortBy (str): The pstats sort key for the printed report (optional).
+
+        limit (int): Functions to print (optional).
+
+    Returns:
+        callable: The wrapped function.
+
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            if path:
+                profile.dump_stats(path)
+                print("Profile written to {}".format(path))
+            else:
+                stats = pstats.Stats(profile, stream=sys.stdout)
+                stats.sort_stats(sortBy).print_stats(limit)
+    return wrapper
+
+
+def sampled(func, path=None, interval=DEFAULT_SAMPLE_INTERVAL,
+            limit=DEFAULT_LIMIT):
+    """Wraps a function to run under a SamplingProfiler.
+
+    Args:
+        func (callable): The function.
+
+        path (str): Save the samples here as collapsed stacks, rather than
+            printing a report (optional).
+
+        interval (float): Seconds between samples (optional).
+
+        limit (int): Functions to print (optional).
+
+    Returns:
+        callable: The wrapped function.
+
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = SamplingProfiler(interval)
+        profiler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.stop()
+            if path:
+                profiler.dump(path)
+                print("Samples written to {}".format(path))
+            else:
+                print(profiler.report(limit))
+    return wrapper
+
+
+def allocationsTraced(func, limit=DEFAULT_ALLOC_LIMIT,
+                      frames=DEFAULT_ALLOC_FRAMES):
+    """Wraps a function to run with tracemalloc tracing its allocations.
+
+    The report lists the lines still holding the most memory when the
+    function returns, and the peak traced along the way.
+
+    Args:
+        func (callable): The function.
+
+        limit (int): Lines to list (optional).
+
+        frames (int): Frames of traceback kept per allocation (optional).
+
+    Returns:
+        callable: The wrapped function.
+
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        tracemalloc.start(frames)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(_allocationReport(snapshot, current, peak, limit))
+    return wrapper
+
+
+def _allocationReport(snapshot, current, peak, limit):
+    """Formats the lines holding the most memory in a tracemalloc snapshot.
+
+    Args:
+        snapshot (tracemalloc.Snapshot): The snapshot.
+
+        current (int): Bytes traced when the snapshot was taken.
+
+        peak (int): The most bytes traced at once.
+
+        limit (int): Lines to list.
+
+    Returns:
+        str: The report.
+
+    """
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+        ))
+    lines = ["Top {} allocations:".format(limit)]
+    for (index, stat) in enumerate(snapshot.statistics('lineno')[:limit]):
+        frame = stat.traceback[0]
+        lines.append("{:>3}. {}:{}: {:.1f} KiB in {} blocks".format(
+            index + 1,
+            frame.filename,
+            frame.lineno,
+            stat.size / 1024.0,
+            stat.count,
+            ))
+    lines.append("Traced memory: {:.1f} KiB current, {:.1f} KiB peak".format(
+        current / 1024.0,
+        peak / 1024.0,
+        ))
+    return "\n".join(lines)
+
+
+def _frameLabel(code):
+    """Names a function the way pstats does: "file:line(function)".
+
+    Args:
+        code (types.CodeType): The function's code.
+
+    Returns:
+        str: The label.
+
+    """
+    return "{}:{}({})".format(
+        os.path.basename(code.co_filename),
+        code.co_firstlineno,
+        code.co_name,
+        )
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class SamplingProfiler(object):
+    """Counts what every thread is doing by looking at its stack now and then.
+
+    Unlike cProfile, calls aren't hooked, so the code runs at nearly full
+    speed and a session can be profiled for hours. The counts only show
+    where time was spent in proportion, and very short calls may be missed.
+
+    Args:
+        interval (float): Seconds between samples (optional).
+
+    """
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        # Collapsed stack, root first, to the number of times it was seen:
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts sampling, on a background thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="sampling-profiler",
+            daemon=True,
+            )
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling. What was sampled is kept."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        """Samples until stopped."""
+        ownId = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample(ignore=ownId)
+
+    def sample(self, ignore=None):
+        """Records the stack of every thread, once.
+
+        Args:
+            ignore (int): A thread ident not to record (optional).
+
+        """
+        names = dict(
+            (thread.ident, thread.name) for thread in threading.enumerate()
+            )
+        frames = sys._current_frames()  #pylint: disable=protected-access
+        for (threadId, frame) in frames.items():
+            if threadId == ignore:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frameLabel(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(threadId, str(threadId)))
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+        self.samples += 1
+
+    def functions(self):
+        """Tallies the samples by function.
+
+        Returns:
+            tuple: Two collections.Counter, of the samples each function was
+                running in itself, and of the samples it was anywhere on the
+                stack.
+
+        """
+        selfCounts = collections.Counter()
+        totalCounts = collections.Counter()
+        for (stack, count) in self.stacks.items():
+            selfCounts[stack[-1]] += count
+            for label in set(stack[1:]):
+                totalCounts[label] += count
+        return (selfCounts, totalCounts)
+
+    def report(self, limit=DEFAULT_LIMIT):
+        """Formats the busiest functions as a table.
+
+        Args:
+            limit (int): Functions to list (optional).
+
+        Returns:
+            str: The table.
+
+        """
+        (selfCounts, totalCounts) = self.functions()
+        samples = max(self.samples, 1)
+        lines = [
+            "{} samples, {} ms apart".format(
+                self.samples, int(self.interval * 1000)),
+            "{:>7}{:>8}  {}".format("self%", "total%", "function"),
+            ]
+        for (label, count) in selfCounts.most_common(limit):
+            lines.append("{:>7.1f}{:>8.1f}  {}".format(
+                100.0 * count / samples,
+                100.0 * totalCounts[label] / samples,
+                label,
+                ))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Writes the samples out as collapsed stacks.
+
+        Each stack is one "a;b;c count" line, as read by flamegraph.pl and
+        speedscope.
+
+        Args:
+            path (str): The file to write.
+
+        """
+        with open(path, 'w') as sampleFile:
+            for (stack, count) in sorted(self.stacks.items()):
+                sampleFile.write("{} {}\n".format(";".join(stack), count))
@@ -0,0 +1,416 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+publisher.py - Sends resolved records on to the capture callsheet.
+
+Scanning must never wait on the network. Publisher.publish() only puts the
+record on a bounded queue and returns at once. A background thread takes
+records off that queue in batches and hands each batch to a transport. A
+batch closes once it holds BATCH_SIZE records, or once BATCH_WINDOW seconds
+have passed since its first record. A burst of scans therefore goes out as a
+few messages rather than one message per prop.
+
+When the queue is full, publish() returns False and the record is counted as
+dropped. It does not block the caller. A batch the transport fails to send is
+retried with exponential back-off. If it still fails, it is given up on and
+counted as failed.
+
+In production the transport would publish to RabbitMQ. Any object with
+send(messages) and close() methods will do, and two stand-ins ship here:
+
+    broker = LocalBroker()
+    with Publisher(LocalTransport(broker)) as pub:
+        pub.publish(record)
+    broker.batches.get()
+
+SocketBroker is the same thing on the other side of a Unix domain socket,
+for testing across processes. main.py -publish SOCKET sends every record it
+reads or scans to one.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+# local imports
+from . import daemon
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+# Records that may wait to be sent before publish() starts turning them away:
+DEFAULT_QUEUE_SIZE = 1024
+# The most records sent in one message:
+BATCH_SIZE = 64
+# Seconds a batch stays open for more records after its first one arrives:
+BATCH_WINDOW = 0.05
+# Attempts to send one batch before giving up on it:
+MAX_ATTEMPTS = 5
+# Seconds to wait before the first retry, doubling after each one:
+RETRY_BACKOFF = 0.1
+MAX_BACKOFF = 5.0
+
+_STOP = object()
+
+
+__all__ = [
+    "toMessage",
+    "LocalBroker",
+    "LocalTransport",
+    "Publisher",
+    "SocketBroker",
+    "SocketTransport",
+    "Transport",
+    "TransportError",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def toMessage(record, event=None):
+    """Builds the message sent to the callsheet for one record.
+
+    Args:
+        record (dict): The resolved record.
+
+        event (serial_connection.ScanEvent): The scan that produced it
+            (optional).
+
+    Returns:
+        dict: The message, ready to be serialized as JSON.
+
+    """
+    message = {"record": dict(record), "timestamp": time.time()}
+    if event is not None:
+        message["readerId"] = event.readerId
+        message["timestamp"] = event.timestamp
+    return message
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class TransportError(Exception):
+    """Raised by a transport when a batch could not be sent."""
+
+
+class Transport(object):
+    """Delivers batches of messages to the callsheet.
+
+    Subclasses implement send(). It should raise a TransportError on any
+    failure that is worth retrying.
+
+    """
+    def send(self, messages):
+        """Sends one batch.
+
+        Args:
+            messages (list): The messages, oldest first.
+
+        Raises:
+            TransportError: if the batch was not delivered.
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Releases anything the transport holds open."""
+
+
+class LocalBroker(object):
+    """An in-process stand-in for the message broker.
+
+    Every batch delivered to it is put on its batches queue, as a list of
+    messages, for a test or a consumer to take off.
+
+    """
+    def __init__(self):
+        self.batches = queue.Queue()
+
+    def deliver(self, messages):
+        """Accepts one batch.
+
+        Args:
+            messages (list): The messages.
+
+        """
+        self.batches.put(list(messages))
+
+
+class LocalTransport(Transport):
+    """Delivers batches straight to a LocalBroker.
+
+    Args:
+        broker (LocalBroker): The broker to deliver to.
+
+    """
+    def __init__(self, broker):
+        self.broker = broker
+
+    def send(self, messages):
+        self.broker.deliver(messages)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    """Receives batches from one publisher, acknowledging each one."""
+    def handle(self):
+        while True:
+            try:
+                message = daemon.receiveMessage(self.request)
+            except ValueError:
+                return
+            if message is None:
+                return
+            self.server.deliver(message.get("messages", []))
+            daemon.sendMessage(self.request, {"ok": True})
+
+
+class SocketBroker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer,
+                   LocalBroker):
+    """A stand-in for the message broker, listening on a Unix domain socket.
+
+    Batches arrive as length-prefixed JSON, in the same framing the daemon
+    uses, and are put on the batches queue just like a LocalBroker's.
+
+    Args:
+        path (str): The socket to listen on.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, path):
+        LocalBroker.__init__(self)
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, _BrokerHandler)
+        self.path = path
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class SocketTransport(Transport):
+    """Sends batches to a SocketBroker, waiting for each to be acknowledged.
+
+    The connection is opened on the first send, and opened again after any
+    failure.
+
+    Args:
+        path (str): The broker's socket.
+
+        timeout (float): Seconds to wait to connect or for an acknowledgement
+            (optional).
+
+    """
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+
+    def send(self, messages):
+        try:
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(self.path)
+            daemon.sendMessage(self.sock, {"messages": messages})
+            reply = daemon.receiveMessage(self.sock)
+        except (OSError, ValueError) as e:
+            self.close()
+            raise TransportError(str(e))
+        if reply is None or not reply.get("ok"):
+            self.close()
+            raise TransportError("The broker did not acknowledge the batch.")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class Publisher(object):
+    """Publishes records in batches from a background thread.
+
+    Args:
+        transport (Transport): Where batches are sent.
+
+        maxQueue (int): Records that may wait to be sent (optional).
+
+        batchSize (int): The most records sent in one message (optional).
+
+        batchWindow (float): Seconds a batch waits for more records
+            (optional).
+
+        maxAttempts (int): Attempts to send a batch before giving up on it
+            (optional).
+
+        backoff (float): Seconds before the first retry, doubling after each
+            one (optional).
+
+    """
+    def __init__(self, transport, maxQueue=DEFAULT_QUEUE_SIZE,
+                 batchSize=BATCH_SIZE, batchWindow=BATCH_WINDOW,
+                 maxAttempts=MAX_ATTEMPTS, backoff=RETRY_BACKOFF):
+        self.transport = transport
+        self.batchSize = batchSize
+        self.batchWindow = batchWindow
+        self.maxAttempts = maxAttempts
+        self.backoff = backoff
+        # What has happened to the records given to publish(), by outcome:
+        self.counts = {
+            "published": 0,
+            "batches": 0,
+            "retries": 0,
+            "dropped": 0,
+            "failed": 0,
+        }
+        self._queue = queue.Queue(maxsize=maxQueue)
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+
+    def start(self):
+        """Starts the thread that sends batches."""
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="callsheet-publisher",
+            daemon=True,
+            )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Sends whatever is still queued, then stops the thread.
+
+        Args:
+            timeout (float): The most seconds to wait (optional).
+
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        self.transport.close()
+
+    def publish(self, record, event=None):
+        """Queues a record to be sent, without waiting.
+
+        Args:
+            record (dict): The resolved record.
+
+            event (serial_connection.ScanEvent): The scan that produced it
+                (optional).
+
+        Returns:
+            bool: True if it was queued, False if the queue was full and it
+                was dropped.
+
+        """
+        return self.publishMessage(toMessage(record, event))
+
+    def publishMessage(self, message):
+        """Queues a ready-made message to be sent, without waiting.
+
+        Args:
+            message (dict): The message, such as a callsheet diff. It must
+                serialize as JSON.
+
+        Returns:
+            bool: True if it was queued, False if the queue was full and it
+                was dropped.
+
+        """
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.counts["dropped"] += 1
+            return False
+        return True
+
+    def _nextBatch(self):
+        """Waits for a record, then collects more until the batch closes.
+
+        Returns:
+            tuple: The messages in the batch, and whether the publisher has
+                been told to stop.
+
+        """
+        first = self._queue.get()
+        if first is _STOP:
+            return ([], True)
+        batch = [first]
+        deadline = time.monotonic() + self.batchWindow
+        while len(batch) < self.batchSize:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or self._stopping.is_set():
+                    message = self._queue.get_nowait()
+                else:
+                    message = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if message is _STOP:
+                return (batch, True)
+            batch.append(message)
+        return (batch, False)
+
+    def _send(self, batch):
+        """Sends one batch, retrying with back-off.
+
+        Args:
+            batch (list): The messages to send.
+
+        """
+        delay = self.backoff
+        for attempt in range(1, self.maxAttempts + 1):
+            try:
+                self.transport.send(batch)
+            except TransportError as e:
+                if attempt == self.maxAttempts:
+                    print("Giving up on {} record(s): {}".format(
+                        len(batch), e))
+                    self.counts["failed"] += len(batch)
+                    return
+                self.counts["retries"] += 1
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_BACKOFF)
+                continue
+            self.counts["published"] += len(batch)
+            self.counts["batches"] += 1
+            return
+
+    def _run(self):
+        """Sends batches until stopped, then flushes what is left."""
+        while True:
+            (batch, stopping) = self._nextBatch()
+            if batch:
+                self._send(batch)
+            if stopping:
+                return
@@ -0,0 +1,247 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+reader_pool.py - Several NFC readers feeding one stream of scans.
+
+On a large volume there is more than one place a prop gets scanned:
+stage-left, stage-right, the prop cage. A ReaderPool opens each of those
+readers and gives each one its own thread, which keeps it in continuous scan
+mode. Every tag any of them sees is put on one shared queue, in the order the
+scans arrived, and each ScanEvent carries the readerId of the reader that saw
+it. One slow reader never holds up another, so scans from N readers are taken
+in N at a time.
+
+    with ReaderPool() as pool:
+        for event in pool.events():
+            print(event.readerId, event.uid)
+
+A scan that needs the reader again, such as to reread a tag a UID-only scan
+reported, is resolved on its reader's thread, by the resolve callable given
+to the pool; events() then yields what it returns.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import concurrent.futures
+import queue
+import threading
+
+# extended imports
+import serial
+
+# local imports
+from . import discovery
+from . import framing
+from . import serial_connection
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+__all__ = [
+    "parseReaderSpecs",
+    "ReaderPool",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def parseReaderSpecs(specs):
+    """Parses readers given on the commandline as PORT or PORT=NAME.
+
+    Args:
+        specs (list): The PORT[=NAME] strings.
+
+    Returns:
+        dict: Reader names, keyed by port. A port given without a name is
+            named after itself.
+
+    """
+    readers = {}
+    for spec in specs:
+        (port, _, name) = spec.partition("=")
+        readers[port] = name or port
+    return readers
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class ReaderPool(object):
+    """A set of NFC readers, each scanned by its own worker thread.
+
+    Args:
+        readers (dict): Reader names, keyed by port (optional). By default
+            every reader that is plugged in is found and named after its
+            port.
+
+        baudrate (int): The fastest rate to negotiate up to with each
+            reader (optional).
+
+        debounce (float): Seconds within which a repeat of the same tag on
+            the same reader is ignored (optional).
+
+        uidOnly (bool): Have each reader report tags by their UID alone
+            (optional). See NfcSerialHandler.scan.
+
+        resolve (callable): Called with the reader's NfcSerialHandler and
+            each ScanEvent, on the reader's own thread while it is still
+            scanning, so it can use the reader, such as to reread a UID-only
+            tag (optional). Its return value is queued instead of the event,
+            unless it is None, which drops the scan.
+
+    """
+    def __init__(self, readers=None,
+                 baudrate=serial_connection.NEGOTIATED_BAUDRATE,
+                 debounce=serial_connection.DEFAULT_DEBOUNCE, uidOnly=False,
+                 resolve=None):
+        self.readers = readers
+        self.baudrate = baudrate
+        self.debounce = debounce
+        self.uidOnly = uidOnly
+        self.resolve = resolve
+        self.connections = []
+        # Scans taken by each reader, keyed by readerId:
+        self.counts = {}
+        self._events = queue.Queue()
+        self._stop = threading.Event()
+        self._workers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+
+    def _connect(self):
+        """Opens a connection to every reader, all at once.
+
+        Returns:
+            list: The ReaderConnection for each reader.
+
+        Raises:
+            SerialException: if no reader could be opened.
+
+        """
+        if self.readers is None:
+            probes = discovery.discoverReaders(
+                serial_connection.DEFAULT_BAUDRATE
+                )
+            openers = [
+                lambda probe=probe: serial_connection.ReaderConnection(
+                    baudrate=self.baudrate,
+                    probe=probe,
+                    )
+                for probe in probes
+                ]
+        else:
+            openers = [
+                lambda port=port, name=name:
+                serial_connection.ReaderConnection(
+                    comPort=port,
+                    baudrate=self.baudrate,
+                    readerId=name,
+                    )
+                for (port, name) in self.readers.items()
+                ]
+        connections = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, len(openers))) as executor:
+            futures = [executor.submit(opener) for opener in openers]
+            for future in futures:
+                try:
+                    connections.append(future.result())
+                except serial.SerialException as e:
+                    print("Skipping reader: {}".format(e))
+        if not connections:
+            raise serial.SerialException("No NFC readers could be opened.")
+        return connections
+
+    def _scanWorker(self, link):
+        """Keeps one reader scanning, queueing everything it sees.
+
+        Runs on the reader's own thread until the pool is stopped or the
+        reader fails. None is queued on the way out, so that events() knows
+        when every worker is done.
+
+        Args:
+            link (serial_connection.ReaderConnection): The reader to scan.
+
+        """
+        handler = serial_connection.NfcSerialHandler(link=link)
+        try:
+            for event in handler.scan(debounce=self.debounce,
+                                      stop=self._stop,
+                                      uidOnly=self.uidOnly):
+                self.counts[link.readerId] += 1
+                if self.resolve is not None:
+                    event = self.resolve(handler, event)
+                    if event is None:
+                        continue
+                self._events.put(event)
+        except (serial.SerialException, framing.ProtocolError) as e:
+            print("Reader {} stopped: {}".format(link.readerId, e))
+        finally:
+            self._events.put(None)
+
+    def start(self):
+        """Opens every reader and starts scanning on each of them."""
+        self._stop.clear()
+        self.connections = self._connect()
+        for link in self.connections:
+            self.counts[link.readerId] = 0
+            worker = threading.Thread(
+                target=self._scanWorker,
+                args=(link,),
+                name="reader-{}".format(link.readerId),
+                daemon=True,
+                )
+            self._workers.append(worker)
+            worker.start()
+        print("Scanning on {} reader(s).".format(len(self.connections)))
+
+    def stop(self):
+        """Stops scanning on every reader and closes them all."""
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        for link in self.connections:
+            link.close()
+        self.connections = []
+
+    def events(self, timeout=None):
+        """Yields scans from every reader, in the order they arrived.
+
+        Args:
+            timeout (float): Stop if no scan arrives for this many seconds
+                (optional). By default this waits until every reader stops.
+
+        Yields:
+            serial_connection.ScanEvent: One event per tag scanned, with the
+                readerId of the reader that saw it, or what resolve returned
+                for it.
+
+        """
+        running = len(self._workers)
+        while running:
+            try:
+                event = self._events.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if event is None:
+                running -= 1
+                continue
+            yield event
@@ -14,18 +14,40 @@ records.py - Object representing a DB record, a prop on the mocap stage.
 ###############################################################################
 # IMPORTS
 ###############################################################################
+# stdlib imports
+import collections.abc
+import sqlite3
 import time
 import uuid
 
 # local imports
 from . import database
-from . import serial_connection
+from . import instrumentation
+from . import scheduler
+from . import tag_codec
 
 
 ###############################################################################
 # GLOBALS
 ###############################################################################
 CALLSHEET_DB = database.CallsheetDatabase()
+# The stage a new record belongs to, unless told otherwise:
+DEFAULT_LOCATION = "mbsStage26"
+# The fields every record has, in the order they are listed:
+_FIELDS = (
+    "uuid",
+    "name",
+    "nfcTagId",
+    "recordType",
+    "scale",
+    "location",
+    "created",
+    "modified",
+)
+_FIELD_SET = frozenset(_FIELDS)
+# Slot markers: a default not made yet, and a field the record doesn't have.
+_LAZY = object()
+_ABSENT = object()
 
 
 __all__ = [
@@ -53,27 +75,140 @@ def create(**kwargs):
 ###############################################################################
 # CLASSES
 ###############################################################################
-class CallsheetRecord(dict):
+class CallsheetRecord(collections.abc.MutableMapping):
     """Object representing one record.
 
     Contains all expected attributes for a complete record, and fills some of
     those in with defaults.
 
+    The core fields are held in slots rather than in a dict, and anything
+    else (such as extra data read off a tag) goes in a small overflow dict,
+    made only when needed. A new record's uuid and created stamp are not
+    generated until something asks for them. Most records are about to be
+    overwritten from the database or from a tag, and never need them.
+
     Args:
         **kwargs: Arbitrary keyword arguments, to be added to this record.
 
     """
+    __slots__ = _FIELDS + ("_extra", "_born")
+
     def __init__(self, **kwargs):
-        super(CallsheetRecord, self).__init__()
-        # To appease Arduino byte limit, truncate ID to 5 characters:
-        self['uuid'] = str(uuid.uuid4())[:5]
-        self['name'] = ""
-        self['nfcTagId'] = ""
-        self['recordType'] = ""
-        self['scale'] = 1
-        self['location'] = "mbsStage26"
-        self['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
-        self.update(**kwargs)
+        self.uuid = _LAZY
+        self.name = ""
+        self.nfcTagId = ""
+        self.recordType = ""
+        self.scale = 1
+        self.location = DEFAULT_LOCATION
+        self.created = _LAZY
+        self.modified = _ABSENT
+        self._extra = None
+        self._born = time.time()
+        if kwargs:
+            self.update(kwargs)
+
+    @classmethod
+    def fromRow(cls, row):
+        """Builds a record straight from a database row.
+
+        No defaults are made and nothing goes through update(); every field
+        is taken from the row as it is.
+
+        Args:
+            row (dict): The record data from the database.
+
+        Returns:
+            CallsheetRecord: The record.
+
+        """
+        record = cls.__new__(cls)
+        record._extra = None
+        record._born = None
+        for field in _FIELDS:
+            setattr(record, field, row.get(field, _ABSENT))
+        for key in row:
+            if key not in _FIELD_SET:
+                record[key] = row[key]
+        return record
+
+    def _lazyDefault(self, field):
+        """Makes the default value of a field that was left to be made later.
+
+        Args:
+            field (str): "uuid" or "created".
+
+        Returns:
+            str: The default.
+
+        """
+        if field == "uuid":
+            # To appease Arduino byte limit, truncate ID to 5 characters:
+            return str(uuid.uuid4())[:5]
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self._born))
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is _LAZY:
+                value = self._lazyDefault(key)
+                setattr(self, key, value)
+            elif value is _ABSENT:
+                raise KeyError(key)
+            return value
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELD_SET:
+            if getattr(self, key) is _ABSENT:
+                raise KeyError(key)
+            setattr(self, key, _ABSENT)
+            return
+        if self._extra is None:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return getattr(self, key) is not _ABSENT
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for field in _FIELDS:
+            if getattr(self, field) is not _ABSENT:
+                yield field
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        count = sum(
+            1 for field in _FIELDS if getattr(self, field) is not _ABSENT
+            )
+        return count + len(self._extra or ())
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, dict(self))
+
+    def copy(self):
+        """Copies this record.
+
+        Returns:
+            CallsheetRecord: The copy.
+
+        """
+        record = type(self).fromRow({})
+        record.update(self)
+        return record
 
     def loadFromDBRecord(self, record):
         """Given a DB record, populate this object with its keys and values.
@@ -85,6 +220,7 @@ class CallsheetRecord(dict):
         for keyname in record.keys():
             self[keyname] = record[keyname]
 
+    @instrumentation.timed("record.populateFromDatabase")
     def populateFromDatabase(self):
         """Populate the attributes of this object by pulling up a DB entry.
 
@@ -92,6 +228,9 @@ class CallsheetRecord(dict):
 
         """
         recordData = CALLSHEET_DB.getByUuid(self['uuid'])
+        if recordData is None:
+            print("No record found for uuid '{}'".format(self['uuid']))
+            return
         self.update(recordData)
 
     def populateFromDatabaseByName(self):
@@ -103,29 +242,90 @@ class CallsheetRecord(dict):
         recordData = CALLSHEET_DB.getByName(self['name'])
         self.update(recordData)
 
+    @instrumentation.timed("record.populateFromTagId")
+    def populateFromTagId(self, nfcTagId):
+        """Populate the attrs of this object from the DB entry for a tag UID.
+
+        Args:
+            nfcTagId (str): The UID of the NFC tag, as reported by the reader.
+
+        Returns:
+            bool: True if a record was found for the tag.
+
+        """
+        recordData = CALLSHEET_DB.getByTagId(nfcTagId)
+        if recordData is None:
+            return False
+        self.update(recordData)
+        return True
+
     def populateTagIdFromTag(self):
         """Populates the nfcTagId attr of this object by reading an NFC tag."""
-        ndefData = serial_connection.NfcSerialHandler().readTag()
+        ndefData = scheduler.getScheduler().readTag().result()
         self['nfcTagId'] = ndefData['uid']
 
     def populateFromTag(self):
         """Populate the attributes of this object by reading an NFC tag."""
-        ndefData = serial_connection.NfcSerialHandler().readTag()
-        self['nfcTagId'] = ndefData['uid']
-        self.populateTagIdFromTag()
-        for key, value in ndefData:
-            if key == "nfcTagId":
-                pass
+        ndefData = scheduler.getScheduler().readTag().result()
+        self.populateFromNdefData(ndefData)
+
+    def populateFromNdefData(self, ndefData):
+        """Populate the attributes of this object from data read off a tag.
+
+        Args:
+            ndefData (dict): The tag data, as returned by
+                NfcSerialHandler.readTag. Its "uid" becomes the nfcTagId.
+
+        """
+        for (key, value) in ndefData.items():
+            if key == "uid":
+                continue
             self[key] = value
+        # The tag itself, over any nfcTagId copied onto it from another tag:
+        self['nfcTagId'] = ndefData['uid']
+
+    def populateFromTagData(self, ndefData, offline=False):
+        """Populate the attributes of this object from a tag, then the DB.
+
+        A tag written with the whole record (see tag_codec) can stand in for
+        the database: it is used alone when offline, or when the database
+        can't be reached.
 
-    def update(self, **kwargs):
+        Args:
+            ndefData (dict): The tag data, as returned by
+                NfcSerialHandler.readTag.
+
+            offline (bool): Don't consult the database for a tag that
+                carries its whole record (optional).
+
+        """
+        self.populateFromNdefData(ndefData)
+        if not tag_codec.carriesRecord(ndefData):
+            self.populateFromDatabase()
+            return
+        if offline:
+            return
+        try:
+            self.populateFromDatabase()
+        except sqlite3.Error as e:
+            print("Database unavailable ({}); using the record from the "
+                  "tag.".format(e))
+
+    def update(self, *args, **kwargs):
         """Update this object with new values, provided by the user.
 
+        Like dict.update, a mapping may be given positionally as well.
+
         Args:
+            *args: An optional dict of keys and values to add or update.
+
             **kwargs: Arbitrary keyword arguments, to be added or updated
                 within this record.
 
         """
+        for mapping in args:
+            for (key, value) in mapping.items():
+                self[key] = value
         for (key, value) in kwargs.items():
             self[key] = value
 
@@ -133,6 +333,47 @@ class CallsheetRecord(dict):
         """Write this record to the database."""
         CALLSHEET_DB.create(self)
 
-    def writeToTag(self):
-        """Write this record to an NFC tag."""
-        serial_connection.NfcSerialHandler().writeTag(self['uuid'])
+    def saveToDatabase(self):
+        """Write this record to the database, updating it if it exists.
+
+        Only the fields that differ from the stored record are written.
+
+        Returns:
+            list: The names of the fields that were written.
+
+        """
+        return CALLSHEET_DB.upsert(self)
+
+    def tagPayload(self, tagType=None):
+        """Gets what is written to an NFC tag for this record.
+
+        Args:
+            tagType (str): Encode the whole record to fit this type of tag
+                (one of tag_codec.TAG_CAPACITIES), rather than just its uuid
+                (optional).
+
+        Returns:
+            str: The payload.
+
+        Raises:
+            ValueError: if the record doesn't fit on that type of tag.
+
+        """
+        if tagType is None:
+            return self['uuid']
+        return tag_codec.encodeRecord(self, tagType=tagType)
+
+    def writeToTag(self, tagType=None):
+        """Write this record to an NFC tag.
+
+        Args:
+            tagType (str): Write the whole record, encoded to fit this type
+                of tag (one of tag_codec.TAG_CAPACITIES), rather than just
+                its uuid (optional).
+
+        Raises:
+            ValueError: if the record doesn't fit on that type of tag.
+
+        """
+        payload = self.tagPayload(tagType=tagType)
+        scheduler.getScheduler().writeTag(payload).result()
@@ -0,0 +1,634 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+replay.py - Plays a captured reader session back through NfcSerialHandler.
+
+A ReplayConnection stands in for the serial port, handing the host the bytes
+the Arduino sent in the capture (see capture.py). Each reply is held back
+until the host has sent whatever came before it in the capture, so the
+handler sees the session just as it happened. In real time, replies are
+also spaced out as they were; at full speed they are handed over as soon as
+the host asks, which makes a capture a repeatable benchmark of the protocol
+code, with no reader and no waiting on tags.
+
+A Replayer works out from what the host sent which reads, writes and scans
+to run, and runs them:
+
+    results = replay.replay("stage26.cap")
+
+or from the commandline:
+
+    python -m nfcCallsheet.replay -capture stage26.cap [-realtime]
+
+roundTrip() checks the two halves against each other: it captures a timed
+read, write and scan against a simulated reader, then replays them, and the
+replay must send what the host sent, byte for byte. From the commandline:
+
+    python -m nfcCallsheet.replay -roundTrip
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import os
+import re
+import sys
+import tempfile
+import time
+
+# local imports
+from . import capture
+from . import diagnostics
+from . import discovery
+from . import framing
+from . import serial_connection
+from . import shellscript_base
+from . import simulator
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+# The text protocol's commands, and a write's payload, as the host sends them:
+_TEXT_COMMAND = re.compile(rb":(read|new|scan|stop):")
+_TEXT_PAYLOAD = re.compile(rb"uuid:([^$]*)\$")
+# Bytes of what the host sends next looked at to tell what it is doing:
+_PEEK = 512
+# Added to a captured request's timeout, so that the replayed request packs
+# the same milliseconds despite the moment it takes to send:
+_TIMEOUT_MARGIN = 0.0005
+# Seconds each command of a round trip waits for a tag:
+ROUND_TRIP_TIMEOUT = 2.0
+
+
+__all__ = [
+    "openReplay",
+    "replay",
+    "roundTrip",
+    "CaptureExhausted",
+    "ReplayApp",
+    "ReplayConnection",
+    "Replayer",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def openReplay(connection):
+    """Makes a reader connection that talks to a ReplayConnection.
+
+    The reader is set up as it was when the capture started, without a
+    handshake.
+
+    Args:
+        connection (ReplayConnection): The replay.
+
+    Returns:
+        serial_connection.ReaderConnection: The connection.
+
+    """
+    info = connection.capture.info
+    deviceId = info.get("deviceId", framing.DEVICE_ID)
+    helloAck = None
+    if (info.get("protocol") == serial_connection.PROTOCOL_BINARY and
+            info.get("helloAck")):
+        helloAck = framing.Frame(
+            framing.MSG_HELLO_ACK,
+            bytes.fromhex(info["helloAck"]),
+            deviceId=deviceId,
+            )
+    probe = discovery.ReaderProbe(
+        connection.port,
+        connection,
+        deviceId,
+        helloAck,
+        0.0
+        )
+    return serial_connection.ReaderConnection(
+        probe=probe,
+        readerId=info.get("readerId") or connection.port,
+        )
+
+
+def _timeoutArgs(frame):
+    """Gets the timeout a captured read or write request was sent with.
+
+    Args:
+        frame (framing.Frame): The READ_REQUEST or WRITE_REQUEST.
+
+    Returns:
+        dict: The timeout keyword argument to replay the request with, or
+            nothing if it waited forever.
+
+    """
+    timeout = framing.requestTimeout(frame.payload)
+    if timeout is None:
+        return {}
+    return {"timeout": timeout + _TIMEOUT_MARGIN}
+
+
+def replay(path, realtime=False):
+    """Replays every read, write and scan in a capture file.
+
+    Args:
+        path (str): The capture file.
+
+        realtime (bool): Space the Arduino's replies out as they were
+            (optional). By default they come as fast as they are asked for.
+
+    Returns:
+        list: What each command returned, as Replayer.run.
+
+    """
+    return Replayer(capture.readCapture(path), realtime=realtime).run()
+
+
+def roundTrip(protocol, timeout=ROUND_TRIP_TIMEOUT):
+    """Captures timed commands against a simulated reader, then replays them.
+
+    A read, a write and a scan are run with a timeout, against a
+    simulator.SimulatedReader speaking the protocol; in the binary protocol
+    the scan is UID-only, and its tag is reread. The capture is then
+    replayed.
+
+    Args:
+        protocol (str): serial_connection.PROTOCOL_LEGACY or PROTOCOL_BINARY.
+
+        timeout (float): Seconds each command waits for a tag (optional).
+
+    Returns:
+        tuple: The (operation, result) tuples of the commands as they ran,
+            those of the replay, as Replayer.run, and the number of writes
+            the replay sent that differed from the capture.
+
+    """
+    binary = protocol == serial_connection.PROTOCOL_BINARY
+    with tempfile.TemporaryDirectory() as workDir:
+        path = os.path.join(workDir, "roundTrip.cap")
+        with simulator.SimulatedReader(tags=simulator.makeTags(3),
+                                       tagLatency=0.01, baudrate=None,
+                                       protocol=protocol) as reader:
+            link = reader.connect()
+            try:
+                link.startCapture(path)
+                handler = serial_connection.NfcSerialHandler(link=link)
+                ran = [
+                    ("readTag", handler.readTag(timeout=timeout)),
+                    ("writeTag", handler.writeTag("abcde", timeout=timeout)),
+                    ]
+                scanned = []
+                for event in handler.scan(debounce=0, uidOnly=binary):
+                    ndefData = event.ndefData
+                    if binary:
+                        ndefData = handler.rereadTag(
+                            event.uid,
+                            timeout=timeout
+                            )
+                    scanned.append(ndefData)
+                    break
+                ran.append(("scan", scanned))
+            finally:
+                link.close()
+        replayer = Replayer(capture.readCapture(path))
+        try:
+            replayed = replayer.run()
+        finally:
+            replayer.link.close()
+    return (ran, replayed, replayer.connection.mismatches)
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class CaptureExhausted(EOFError):
+    """Raised when a replayed read would wait forever.
+
+    Either the capture has ended, or it has the Arduino waiting for
+    something from the host that the host hasn't sent.
+
+    """
+
+
+class ReplayConnection(object):
+    """Stands in for a serial connection, answering from a capture.
+
+    Reads behave as pyserial's do, honouring the timeout. A read with no
+    timeout that would never be answered raises CaptureExhausted instead of
+    hanging. Writes are checked against what the host sent in the capture;
+    any that differ are counted in mismatches.
+
+    Args:
+        recorded (capture.Capture): The capture to replay.
+
+        realtime (bool): Space the replies out as they were (optional).
+
+    """
+    def __init__(self, recorded, realtime=False):
+        self.capture = recorded
+        self.realtime = realtime
+        self.port = "replay"
+        self.baudrate = (recorded.info.get("baudrate") or
+                         serial_connection.DEFAULT_BAUDRATE)
+        self.timeout = None
+        self.is_open = True
+        self.mismatches = 0
+        self._chunks = recorded.chunks
+        self._outbound = recorded.outbound()
+        # The next chunk, and how much of it has been read:
+        self._index = 0
+        self._offset = 0
+        # Bytes the host sent in the capture before the next chunk, and
+        # bytes it has sent in the replay:
+        self._expected = 0
+        self._written = 0
+        # Replies are timed from the last thing the host sent:
+        self._lastWrite = time.monotonic()
+        self._anchor = self._lastWrite
+        self._anchorTime = 0.0
+
+    def _current(self):
+        """Finds the next chunk from the Arduino that the host has earned.
+
+        Returns:
+            capture.Chunk: The chunk, or None if the capture has ended or is
+                waiting on the host.
+
+        """
+        while self._index < len(self._chunks):
+            chunk = self._chunks[self._index]
+            if chunk.direction == capture.DIRECTION_IN:
+                return chunk
+            if self._written < self._expected + len(chunk.data):
+                return None
+            self._expected += len(chunk.data)
+            self._index += 1
+            self._anchor = self._lastWrite
+            self._anchorTime = chunk.time
+        return None
+
+    def _untilDue(self, chunk):
+        """Seconds until a chunk from the Arduino should arrive.
+
+        Args:
+            chunk (capture.Chunk): The chunk.
+
+        Returns:
+            float: The seconds, 0 or less if it's due.
+
+        """
+        if not self.realtime:
+            return 0.0
+        due = self._anchor + (chunk.time - self._anchorTime)
+        return due - time.monotonic()
+
+    @property
+    def in_waiting(self):
+        """int: Bytes that can be read without waiting."""
+        chunk = self._current()
+        if chunk is None or self._untilDue(chunk) > 0:
+            return 0
+        return len(chunk.data) - self._offset
+
+    def read(self, size=1):
+        """Reads up to size bytes of the Arduino's next chunk.
+
+        Args:
+            size (int): The most bytes to read (optional).
+
+        Returns:
+            bytes: The bytes, or b"" if the timeout passed first.
+
+        Raises:
+            CaptureExhausted: if there is no timeout and nothing will come.
+
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            chunk = self._current()
+            if chunk is None:
+                if deadline is None:
+                    raise CaptureExhausted(self._exhaustedReason())
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                return b""
+            wait = self._untilDue(chunk)
+            if wait <= 0:
+                break
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return b""
+                wait = min(wait, remaining)
+            time.sleep(wait)
+        data = chunk.data[self._offset:self._offset + size]
+        self._offset += len(data)
+        if self._offset >= len(chunk.data):
+            self._index += 1
+            self._offset = 0
+        return data
+
+    def _exhaustedReason(self):
+        """Says why a read would never be answered.
+
+        Returns:
+            str: The reason.
+
+        """
+        if self._index >= len(self._chunks):
+            return "The capture has ended."
+        return "The capture is waiting for the host to send {!r}.".format(
+            self.pendingOutbound(32))
+
+    def write(self, data):
+        """Takes bytes from the host, checking them against the capture.
+
+        Args:
+            data (bytes): The bytes.
+
+        Returns:
+            int: The number of bytes written.
+
+        """
+        end = self._written + len(data)
+        if bytes(data) != self._outbound[self._written:end]:
+            self.mismatches += 1
+        self._written = end
+        self._lastWrite = time.monotonic()
+        return len(data)
+
+    def pendingOutbound(self, limit=_PEEK):
+        """Shows what the host sent next in the capture.
+
+        Args:
+            limit (int): The most bytes to show (optional).
+
+        Returns:
+            bytes: The bytes not yet sent in the replay.
+
+        """
+        return self._outbound[self._written:self._written + limit]
+
+    def close(self):
+        """Ends the replay."""
+        self.is_open = False
+
+
+class Replayer(object):
+    """Runs the commands of a captured session against its replay.
+
+    Which command the host ran next is told from the next bytes it sent.
+    Scans are replayed with no debounce, so that every tag the Arduino
+    reported comes out, however fast the replay goes.
+
+    Args:
+        recorded (capture.Capture): The capture to replay.
+
+        realtime (bool): Space the replies out as they were (optional).
+
+    """
+    def __init__(self, recorded, realtime=False):
+        self.capture = recorded
+        self.connection = ReplayConnection(recorded, realtime=realtime)
+        self.link = openReplay(self.connection)
+        self.handler = serial_connection.NfcSerialHandler(link=self.link)
+        self.binary = self.link.protocol == serial_connection.PROTOCOL_BINARY
+
+    def _nextFrame(self):
+        """Decodes the next frame the host sent, in the binary protocol.
+
+        Returns:
+            tuple: The framing.Frame, or None, and the frames after it.
+
+        """
+        frames = framing.FrameParser().feed(self.connection.pendingOutbound())
+        if not frames:
+            return (None, [])
+        return (frames[0], frames[1:])
+
+    def _nextCommand(self):
+        """Works out what the host did next, from what it sent next.
+
+        Returns:
+            tuple: The NfcSerialHandler operation ("readTag", "writeTag" or
+                "scan"), its arguments and its keyword arguments, such as
+                the timeout it was run with; or "skip" and the bytes the host
+                sent outside of any of them; or None if the host sent nothing
+                more.
+
+        """
+        pending = self.connection.pendingOutbound()
+        if not pending:
+            return None
+        if self.binary:
+            (frame, following) = self._nextFrame()
+            if frame is None:
+                return ("skip", (pending,), {})
+            if frame.msgType == framing.MSG_READ_REQUEST:
+                return ("readTag", (), _timeoutArgs(frame))
+            if frame.msgType == framing.MSG_WRITE_REQUEST:
+                recordUuid = ""
+                for payloadFrame in following:
+                    if payloadFrame.msgType == framing.MSG_WRITE_PAYLOAD:
+                        recordUuid = payloadFrame.payload.decode('ascii')
+                        break
+                return ("writeTag", (recordUuid,), _timeoutArgs(frame))
+            if frame.msgType == framing.MSG_SCAN_START:
+                flags = frame.payload[0] if frame.payload else 0
+                return ("scan", (bool(flags & framing.SCAN_UID_ONLY),), {})
+            return ("skip", (framing.encodeFrame(
+                frame.msgType,
+                frame.payload,
+                frame.deviceId
+                ),), {})
+        match = _TEXT_COMMAND.match(pending)
+        if match is None:
+            match = _TEXT_COMMAND.search(pending)
+            skipped = pending[:match.start()] if match else pending
+            return ("skip", (skipped,), {})
+        command = match.group(1)
+        if command == b"read":
+            return ("readTag", (), {})
+        if command == b"new":
+            payload = _TEXT_PAYLOAD.search(pending, match.end())
+            recordUuid = payload.group(1).decode('ascii') if payload else ""
+            return ("writeTag", (recordUuid,), {})
+        if command == b"scan":
+            return ("scan", (False,), {})
+        return ("skip", (match.group(0),), {})
+
+    def _rereadNext(self):
+        """Checks whether the host asked for a tag to be read in full next.
+
+        Returns:
+            dict: The keyword arguments to reread it with, such as its
+                timeout, or None if it didn't ask.
+
+        """
+        if not self.binary:
+            return None
+        (frame, _) = self._nextFrame()
+        if frame is None or frame.msgType != framing.MSG_READ_REQUEST:
+            return None
+        return _timeoutArgs(frame)
+
+    def _replayScan(self, uidOnly):
+        """Replays a scan, including any tags it read in full.
+
+        Args:
+            uidOnly (bool): Whether the scan was UID-only.
+
+        Returns:
+            list: The ndef data of each tag scanned.
+
+        """
+        scanned = []
+        scanner = self.handler.scan(debounce=0, uidOnly=uidOnly)
+        try:
+            for event in scanner:
+                ndefData = event.ndefData
+                rereadArgs = self._rereadNext() if uidOnly else None
+                if rereadArgs is not None:
+                    ndefData = self.handler.rereadTag(
+                        event.uid,
+                        **rereadArgs
+                        ) or ndefData
+                scanned.append(ndefData)
+        except CaptureExhausted:
+            # The scan ended where the host stopped it, or the capture did.
+            pass
+        finally:
+            scanner.close()
+        return scanned
+
+    def run(self):
+        """Replays every command in the capture.
+
+        Returns:
+            list: An (operation, result) tuple per command. A read's result
+                is its ndef data, a write's is whether it wrote, and a
+                scan's is a list of ndef data. A command cut short by the end
+                of the capture has None, and one the Arduino reported an
+                error for has the framing.ProtocolError.
+
+        """
+        results = []
+        while True:
+            command = self._nextCommand()
+            if command is None:
+                break
+            (operation, args, kwargs) = command
+            if operation == "skip":
+                self.connection.write(*args)
+                continue
+            try:
+                if operation == "scan":
+                    result = self._replayScan(*args)
+                else:
+                    result = getattr(self.handler, operation)(*args, **kwargs)
+            except CaptureExhausted:
+                result = None
+            except framing.ProtocolError as e:
+                result = e
+            results.append((operation, result))
+        return results
+
+
+class ReplayApp(diagnostics.DiagnosticsMixin,
+                shellscript_base.BaseShellScript):
+    """Replays a capture from the commandline."""
+    def registerArgs(self):
+        """Registers the commandline arguments for this tool."""
+        source = self.parser.add_mutually_exclusive_group(required=True)
+        source.add_argument(
+            '-capture',
+            help='the capture file to replay',
+            metavar='PATH',
+            )
+
+        source.add_argument(
+            '-roundTrip',
+            help='capture timed commands against the simulated reader in '
+                 'each protocol, and check that they replay the same',
+            action='store_true',
+            )
+
+        self.parser.add_argument(
+            '-realtime',
+            help='space the reader\'s replies out as they were captured',
+            action='store_true',
+            )
+
+        self.parser.add_argument(
+            '-rounds',
+            help='replay this many times, reporting how long each took',
+            type=int,
+            default=1,
+            )
+
+    def run(self):
+        """Replays the capture, printing what each command returned."""
+        if self.args.roundTrip:
+            self._roundTrip()
+            return
+        recorded = capture.readCapture(self.args.capture)
+        print("{}: {} chunks over {:.2f}s, {} protocol".format(
+            self.args.capture,
+            len(recorded),
+            recorded.duration,
+            recorded.info.get("protocol", "unknown"),
+            ))
+        for index in range(self.args.rounds):
+            replayer = Replayer(recorded, realtime=self.args.realtime)
+            start = time.perf_counter()
+            results = replayer.run()
+            elapsed = time.perf_counter() - start
+            if index == 0:
+                for (operation, result) in results:
+                    print("{}: {}".format(operation, result))
+            print("Round {}: {} commands in {:.1f} ms, {} mismatched "
+                  "writes".format(
+                      index + 1,
+                      len(results),
+                      elapsed * 1000,
+                      replayer.connection.mismatches,
+                      ))
+            replayer.link.close()
+
+    def _roundTrip(self):
+        """Runs roundTrip in each protocol, exiting non-zero on a failure."""
+        failed = False
+        for protocol in (serial_connection.PROTOCOL_LEGACY,
+                         serial_connection.PROTOCOL_BINARY):
+            (ran, replayed, mismatches) = roundTrip(protocol)
+            matched = ran == replayed and not mismatches
+            failed = failed or not matched
+            print("{}: {} commands, {} mismatched writes: {}".format(
+                protocol,
+                len(ran),
+                mismatches,
+                "OK" if matched else "FAILED",
+                ))
+            if ran != replayed:
+                print("  ran:      {}".format(ran))
+                print("  replayed: {}".format(replayed))
+        if failed:
+            sys.exit(1)
+
+
+###############################################################################
+# EXECUTE
+###############################################################################
+if __name__ == "__main__":
+    app = ReplayApp()
+    app.run()
@@ -0,0 +1,417 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+scheduler.py - One thread that owns the reader and runs commands in turn.
+
+A GUI, a publisher and the commandline can all want the reader at once.
+Rather than each of them talking to the serial port, they submit commands to
+a CommandScheduler and get a future back. A single I/O thread runs the
+commands one at a time, so bytes from two callers can never interleave.
+
+    future = getScheduler().readTag(timeout=10)
+    ndefData = future.result()
+
+Commands are run in priority order, and in the order they were submitted
+within a priority. By default reads are urgent and tag writes are background
+work, so a prop being scanned doesn't queue up behind a stack of stickers
+waiting to be programmed. A command that is already running is not
+interrupted for one with a higher priority; the Arduino is busy with it.
+
+A command waits DEFAULT_TIMEOUT seconds for a tag unless given a timeout of
+its own, and its future can be cancelled. A command still waiting its turn
+is simply dropped. One that is running gives up waiting for a tag, and the
+Arduino is told to stop waiting too.
+
+A continuous scan runs on the I/O thread as well, handing its events back as
+they come:
+
+    for event in getScheduler().scan():
+        ndefData = getScheduler().rereadTag(event.uid)
+
+It holds the reader for as long as it runs, but while it waits for tags the
+commands submitted in the meantime still run, in between its polls of the
+reader, with the Arduino left in scan mode.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import concurrent.futures
+import itertools
+import queue
+import threading
+
+# local imports
+from . import serial_connection
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 5
+PRIORITY_BACKGROUND = 10
+# Queued behind everything else, so that pending commands still run:
+_PRIORITY_SHUTDOWN = 100
+# Seconds a command waits for a tag, unless given a timeout of its own:
+DEFAULT_TIMEOUT = 60.0
+# Seconds a scan is given to take the Arduino out of scan mode once stopped:
+_SCAN_STOP_TIMEOUT = 2.0
+
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+__all__ = [
+    "getScheduler",
+    "setScheduler",
+    "CommandFuture",
+    "CommandScheduler",
+    "PRIORITY_URGENT",
+    "PRIORITY_NORMAL",
+    "PRIORITY_BACKGROUND",
+    "DEFAULT_TIMEOUT",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def getScheduler():
+    """Gets the scheduler for the shared reader, starting it if need be.
+
+    Returns:
+        CommandScheduler: The process-wide scheduler.
+
+    """
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = CommandScheduler()
+        return _SCHEDULER
+
+
+def setScheduler(commandScheduler):
+    """Makes a scheduler the one that getScheduler hands out.
+
+    For running against some reader other than the shared one, such as a
+    simulated reader.
+
+    Args:
+        commandScheduler (CommandScheduler): The scheduler, or None for
+            getScheduler to start one for the shared reader when next asked.
+
+    Returns:
+        CommandScheduler: The scheduler it replaces, or None.
+
+    """
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        (previous, _SCHEDULER) = (_SCHEDULER, commandScheduler)
+    return previous
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class CommandFuture(concurrent.futures.Future):
+    """The pending result of a command submitted to a CommandScheduler.
+
+    Unlike a plain Future, cancelling one that is already running asks the
+    command to stop. Its result is then a CancelledError, unless the command
+    had already got too far to stop, in which case it finishes normally.
+
+    """
+    def __init__(self):
+        super(CommandFuture, self).__init__()
+        self.stop = threading.Event()
+
+    def cancel(self):
+        """Cancels the command, stopping it if it is already running.
+
+        Returns:
+            bool: True if the command hadn't started and never will.
+
+        """
+        self.stop.set()
+        return super(CommandFuture, self).cancel()
+
+
+class CommandScheduler(object):
+    """Runs reader commands one at a time on a dedicated I/O thread.
+
+    Args:
+        link (serial_connection.ReaderConnection): The reader to own
+            (optional). Defaults to the shared SerialConnection.
+
+    """
+    def __init__(self, link=None):
+        self.handler = serial_connection.NfcSerialHandler(link=link)
+        # Ends the scan that is running, if one is:
+        self._scanStop = None
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="reader-io",
+            daemon=True,
+            )
+        self._thread.start()
+
+    def _run(self):
+        """Takes commands off the queue and runs them, until shut down."""
+        while True:
+            command = self._queue.get()
+            if command[0] == _PRIORITY_SHUTDOWN:
+                return
+            self._execute(command)
+
+    def _execute(self, command):
+        """Runs one command from the queue, settling its future.
+
+        Args:
+            command (tuple): The command, as queued by submit.
+
+        """
+        (_, _, future, operation, args, timeout) = command
+        if not future.set_running_or_notify_cancel():
+            return
+        if operation == "scan":
+            method = self._scan
+        else:
+            method = getattr(self.handler, operation)
+        try:
+            result = method(*args, timeout=timeout, stop=future.stop)
+        except Exception as e:  #pylint: disable=broad-except
+            future.set_exception(e)
+            return
+        if result is None or result is False:
+            if future.stop.is_set():
+                future.set_exception(concurrent.futures.CancelledError())
+                return
+            if timeout is not None:
+                msg = "{} timed out after {}s.".format(operation, timeout)
+                future.set_exception(concurrent.futures.TimeoutError(msg))
+                return
+        future.set_result(result)
+
+    def _scan(self, events, debounce, uidOnly, timeout=None, stop=None):
+        """Runs a continuous scan, putting its events on a queue.
+
+        Args:
+            events (queue.Queue): Gets each ScanEvent, then None once the
+                scan ends.
+
+            debounce (float): Seconds within which a repeat of the same tag
+                is ignored.
+
+            uidOnly (bool): Have each tag reported by its UID alone.
+
+            timeout (float): Unused; a scan runs until stopped.
+
+            stop (threading.Event): Ends the scan once set.
+
+        Returns:
+            bool: True once the scan has ended.
+
+        """
+        self._scanStop = stop
+        try:
+            for event in self.handler.scan(debounce=debounce, stop=stop,
+                                           uidOnly=uidOnly,
+                                           idle=self._runWaiting):
+                events.put(event)
+        finally:
+            self._scanStop = None
+            events.put(None)
+        return True
+
+    def _runWaiting(self):
+        """Runs the commands waiting their turn, from inside a running scan.
+
+        Another scan waits for this one to end. So does a shutdown, which
+        asks this one to stop.
+
+        """
+        deferred = []
+        while True:
+            try:
+                command = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if command[0] == _PRIORITY_SHUTDOWN:
+                self._scanStop.set()
+                deferred.append(command)
+            elif command[3] == "scan":
+                deferred.append(command)
+            else:
+                self._execute(command)
+        for command in deferred:
+            self._queue.put(command)
+
+    def submit(self, operation, *args, priority=PRIORITY_NORMAL,
+               timeout=DEFAULT_TIMEOUT):
+        """Queues a command to be run on the I/O thread.
+
+        Args:
+            operation (str): The name of the NfcSerialHandler method to run,
+                such as "readTag". It must accept timeout and stop keyword
+                arguments.
+
+            *args: Positional arguments for the method.
+
+            priority (int): Lower runs sooner (optional).
+
+            timeout (float): Seconds the command may wait for a tag once it
+                is running (optional). None waits forever.
+
+        Returns:
+            CommandFuture: The command's eventual result.
+
+        """
+        future = CommandFuture()
+        self._queue.put(
+            (priority, next(self._order), future, operation, args, timeout)
+            )
+        return future
+
+    def readTag(self, priority=PRIORITY_URGENT, timeout=DEFAULT_TIMEOUT):
+        """Queues a tag read.
+
+        Args:
+            priority (int): Lower runs sooner (optional).
+
+            timeout (float): Seconds to wait for a tag (optional).
+
+        Returns:
+            CommandFuture: Resolves to the ndef data read from the tag.
+
+        """
+        return self.submit("readTag", priority=priority, timeout=timeout)
+
+    def writeTag(self, recordUuid, priority=PRIORITY_BACKGROUND,
+                 timeout=DEFAULT_TIMEOUT):
+        """Queues a tag write.
+
+        Args:
+            recordUuid (str): The record ID to write to the tag.
+
+            priority (int): Lower runs sooner (optional).
+
+            timeout (float): Seconds to wait for a tag (optional).
+
+        Returns:
+            CommandFuture: Resolves to True once the tag is written.
+
+        """
+        return self.submit(
+            "writeTag",
+            recordUuid,
+            priority=priority,
+            timeout=timeout
+            )
+
+    def rereadTag(self, uid, timeout=serial_connection.REREAD_TIMEOUT):
+        """Reads the NDEF records of a tag just scanned by a UID-only scan.
+
+        Run ahead of everything else, and during a scan, as soon as the scan
+        next polls the reader. See NfcSerialHandler.rereadTag.
+
+        Args:
+            uid (str): The UID the tag was scanned with.
+
+            timeout (float): Seconds to wait for the tag (optional).
+
+        Returns:
+            dict: The ndef data read from the tag, or None if it wasn't read
+                in time, or the reader can't reread tags.
+
+        """
+        future = self.submit(
+            "rereadTag",
+            uid,
+            priority=PRIORITY_URGENT,
+            timeout=timeout
+            )
+        try:
+            return future.result()
+        except concurrent.futures.TimeoutError:
+            return None
+
+    def scan(self, debounce=serial_connection.DEFAULT_DEBOUNCE,
+             uidOnly=False, stop=None, priority=PRIORITY_NORMAL):
+        """Scans tags continuously on the I/O thread, yielding each one.
+
+        The scan runs once the commands ahead of it have, and until the
+        generator is closed or stop is set. While it waits for tags, the
+        commands submitted in the meantime run between its polls of the
+        reader; see NfcSerialHandler.scan.
+
+        Args:
+            debounce (float): Seconds within which a repeat of the same tag
+                is ignored (optional).
+
+            uidOnly (bool): Have each tag reported by its UID alone
+                (optional). See rereadTag.
+
+            stop (threading.Event): Ends the scan once set (optional).
+
+            priority (int): Lower starts sooner (optional).
+
+        Yields:
+            serial_connection.ScanEvent: One event per tag scanned.
+
+        Raises:
+            framing.ProtocolError: if the reader reports an error.
+
+        """
+        events = queue.Queue()
+        future = self.submit(
+            "scan",
+            events,
+            debounce,
+            uidOnly,
+            priority=priority,
+            timeout=None
+            )
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=serial_connection.STOP_POLL)
+                except queue.Empty:
+                    if future.cancelled():
+                        # Stopped before its turn came.
+                        return
+                    if stop is not None and stop.is_set():
+                        future.cancel()
+                    continue
+                if event is None:
+                    break
+                yield event
+            future.result()
+        finally:
+            future.cancel()
+            # Leave the Arduino out of scan mode before handing back.
+            concurrent.futures.wait([future], timeout=_SCAN_STOP_TIMEOUT)
+
+    def shutdown(self, wait=True):
+        """Stops the I/O thread once the commands already queued have run.
+
+        Args:
+            wait (bool): Whether to wait for the thread to finish.
+
+        """
+        self._queue.put(
+            (_PRIORITY_SHUTDOWN, next(self._order), None, None, (), None)
+            )
+        if wait:
+            self._thread.join()
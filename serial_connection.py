@@ -15,25 +15,69 @@ Through this connection, serial commands are sent to the Arduino, preparing it
 to read from or write to an NFC tag. The arduino then utilizes the serial
 connection in order to deliver records from those NFC tags after a scan.
 
+Unless a port is given, the reader is found with discovery.py. When the
+connection is opened, the Arduino is offered the binary framing protocol from
+framing.py and a faster baud rate. Firmware that doesn't answer is spoken to
+in the original text shorthand instead, read in bulk by line_protocol.py.
+
 """
 ###############################################################################
 # IMPORTS
 ###############################################################################
 # stdlib imports
+import collections
+import struct
 import sys
+import threading
 import time
 import signal
 
 # extended imports
 import serial
 
+# local imports
+from . import capture
+from . import discovery
+from . import framing
+from . import instrumentation
+from . import line_protocol
+from . import tag_codec
+
 
 ###############################################################################
 # GLOBALS
 ###############################################################################
+# The rate the Arduino boots at:
+DEFAULT_BAUDRATE = 9600
+# The rate asked for once the Arduino agrees to the binary protocol. The
+# Arduino may offer less, in which case its offer is used.
+NEGOTIATED_BAUDRATE = 115200
+# Seconds to wait for each reply during the handshake:
+HANDSHAKE_TIMEOUT = 1.0
+# Seconds to wait for a tag write to finish once the payload has been sent:
+WRITE_TIMEOUT = 5.0
+# Seconds within which a repeat scan of the same tag is ignored:
+DEFAULT_DEBOUNCE = 2.0
+# While an operation can be stopped or can time out, seconds between checks:
+STOP_POLL = 0.2
+# Seconds to wait for a full read of a tag just scanned by its UID alone:
+REREAD_TIMEOUT = 1.0
+# The longest payload the original firmware can write to a tag; its buffer
+# holds 32 characters, including the terminator:
+LEGACY_MAX_PAYLOAD = 31
+
+PROTOCOL_LEGACY = "legacy"
+PROTOCOL_BINARY = "binary"
+
+
 __all__ = [
+    "applyNdefLine",
+    "parseNdefLine",
+    "parseNdefPayload",
     "signalHandler",
     "NfcSerialHandler",
+    "ReaderConnection",
+    "ScanEvent",
     "SerialConnection"
 ]
 __author__ = 'astetson'
@@ -61,18 +105,487 @@ def signalHandler(signalCode, frame):  #pylint: disable=unused-argument
 signal.signal(signal.SIGINT, signalHandler)
 
 
+def _reportWriteTime(writeStart):
+    """Prints and records how long a tag write took.
+
+    That is from the payload being sent to the write being confirmed.
+
+    Args:
+        writeStart (float): The time.perf_counter() value when the payload
+            was sent.
+
+    """
+    elapsed = time.perf_counter() - writeStart
+    instrumentation.record("writeTag.write", elapsed)
+    print("Tag written in {:.0f} ms.".format(elapsed * 1000))
+
+
+def _deadline(timeout):
+    """Turns a timeout in seconds into a time.monotonic() deadline.
+
+    Args:
+        timeout (float): Seconds from now, or None for no deadline.
+
+    Returns:
+        float: The deadline, or None.
+
+    """
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+def _halted(stop, deadline):
+    """Checks whether an operation was stopped or has run out of time.
+
+    Args:
+        stop (threading.Event): Set when the operation should stop, or None.
+
+        deadline (float): The time.monotonic() deadline, or None.
+
+    Returns:
+        bool: True if the operation should give up.
+
+    """
+    if stop is not None and stop.is_set():
+        return True
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _timeoutPayload(deadline):
+    """Packs the time left before a deadline for a READ/WRITE_REQUEST.
+
+    The Arduino stops waiting for a tag after that many milliseconds, so it
+    doesn't sit waiting on a request the host has given up on.
+
+    Args:
+        deadline (float): The time.monotonic() deadline, or None.
+
+    Returns:
+        bytes: The milliseconds left, or nothing to wait forever.
+
+    """
+    if deadline is None:
+        return b""
+    remaining = max(1, int((deadline - time.monotonic()) * 1000))
+    return struct.pack(">I", remaining)
+
+
+def parseNdefLine(currentLine, ndefData):
+    """Parses one line of a text protocol tag transmission.
+
+    Args:
+        currentLine (str): The line, stripped of whitespace.
+
+        ndefData (dict): The ndef data collected so far, updated in place.
+
+    Returns:
+        bool: True once the end of transmission signal ("02") arrives.
+
+    """
+    return applyNdefLine(line_protocol.parseLine(currentLine), ndefData)
+
+
+def applyNdefLine(line, ndefData, textSink=None):
+    """Adds one already split line of a tag transmission to the tag data.
+
+    Args:
+        line (line_protocol.Line): The line.
+
+        ndefData (dict): The ndef data collected so far, updated in place.
+
+        textSink (line_protocol.TextSink): Where lines that aren't tag data
+            go (optional). By default they are printed.
+
+    Returns:
+        bool: True once the end of transmission signal ("02") arrives.
+
+    """
+    kind = line.kind
+    if kind == line_protocol.LINE_FIELD:
+        key = line.key
+        if key == "payload":
+            parseNdefPayload(line.value, ndefData)
+        elif key == "num_ndef_records":
+            msg = "Receiving {} records from the payload."
+            print(msg.format(line.value))
+        else:
+            ndefData[key] = line.value.partition(":")[0].strip()
+        return False
+    # Listen for end signal:
+    if kind == line_protocol.LINE_SIGNAL:
+        if line.value == line_protocol.SIGNAL_DONE:
+            # Finished with NDEF Data
+            print("--> Done receiving ndef data.")
+            return True
+        return False
+    if kind == line_protocol.LINE_TEXT:
+        if textSink is None:
+            msg = ("Unexpected data line received; no "
+                   "key/value delineation: {}")
+            print(msg.format(line.text))
+        else:
+            textSink.write(line.text)
+    #Skip over any blank lines
+    return False
+
+
+@instrumentation.timed("readTag.parsePayload")
+def parseNdefPayload(payload, ndefData):
+    """Unpacks the text of one NDEF record into a dict of tag data.
+
+    The records written by this tool are URN URIs, whose first byte is the
+    URI prefix code "#". The rest is either a "key:value" pair or, for a tag
+    written by CallsheetRecord.writeToTag, a bare record uuid or a whole
+    record encoded by tag_codec.
+
+    Args:
+        payload (str): The NDEF record's payload, as text.
+
+        ndefData (dict): The tag data to add the unpacked key and value to.
+
+    """
+    if payload.startswith("#"):
+        #Clean "#" from some ndef data
+        payload = payload[1:]
+    if tag_codec.isEncodedRecord(payload):
+        try:
+            ndefData.update(tag_codec.decodeRecord(payload))
+        except tag_codec.TagFormatError as e:
+            print("Unreadable record on tag: {}".format(e))
+        return
+    if not ":" in payload:
+        ndefData['uuid'] = payload.strip()
+        return
+    parts = payload.split(":")
+    ndefData[parts[0]] = parts[1].strip()
+
+
 ###############################################################################
 # CLASSES
 ###############################################################################
+class ScanEvent(object):
+    """One tag arriving at the reader during a continuous scan.
+
+    Args:
+        ndefData (dict): The data read from the tag, as returned by readTag.
+
+        deviceId (int): The device ID the reader reported.
+
+        readerId (str): Which reader saw the tag (optional). Every reader
+            runs the same firmware, so the device ID alone can't tell them
+            apart.
+
+        uidOnly (bool): The scan was UID-only, so the tag's NDEF records may
+            not have been read (optional). A scan on the original text
+            protocol always reads them, even when asked not to.
+
+    """
+    __slots__ = ("ndefData", "deviceId", "readerId", "timestamp", "uidOnly")
+
+    def __init__(self, ndefData, deviceId=framing.DEVICE_ID, readerId=None,
+                 uidOnly=False):
+        self.ndefData = ndefData
+        self.deviceId = deviceId
+        self.readerId = readerId
+        self.uidOnly = uidOnly
+        self.timestamp = time.time()
+
+    def __repr__(self):
+        return "ScanEvent(uid={!r}, deviceId={}, readerId={!r})".format(
+            self.uid,
+            self.deviceId,
+            self.readerId
+            )
+
+    @property
+    def uid(self):
+        """str: The hardware ID of the tag that was scanned."""
+        return self.ndefData.get('uid')
+
+
 class NfcSerialHandler(object):
     """Object with methods to interact with the callsheet and the NFC reader.
 
+    Args:
+        link (ReaderConnection): The reader to talk to (optional). Defaults
+            to the shared SerialConnection.
+
     """
-    def __init__(self):
+    def __init__(self, link=None):
         print("Starting serial connection.")
-        self.serialConnection = SerialConnection().connection
+        if link is None:
+            link = SerialConnection()
+        self.link = link
+        # Tags scanned while rereadTag was waiting for a different one:
+        self._pendingScans = collections.deque()
+
+    @property
+    def serialConnection(self):
+        """serial.Serial: The link's port, as it is now.
+
+        Looked up at each use, since the link can change its connection,
+        such as when a capture is started.
+
+        """
+        return self.link.connection
+
+    def _handleUnexpectedFrame(self, frame):
+        """Deals with a frame that the current operation wasn't waiting for.
+
+        Args:
+            frame (framing.Frame): The frame that arrived.
+
+        Raises:
+            framing.ProtocolError: if the frame reports an error.
+
+        """
+        if frame.msgType == framing.MSG_LOG:
+            #if the message isn't intended for us, I still like to print it:
+            print(frame.text)
+        elif frame.msgType == framing.MSG_ERROR:
+            raise framing.ProtocolError(frame.text)
+        else:
+            msg = "Unexpected Transmission Type: '0x{:02X}'"
+            print(msg.format(frame.msgType))
+
+    def _readTagFramed(self, stop=None, deadline=None):
+        """Requests a tag read in binary mode and collects the tag data.
+
+        Args:
+            stop (threading.Event): Cancels the read once set (optional).
 
-    def _monitorNfcForTagRead(self):
+            deadline (float): The time.monotonic() by which a tag must be
+                read (optional).
+
+        Returns:
+            dict: The ndef data (data from the NFC tag) defining a record, or
+                None if no tag was read.
+
+        """
+        self.link.sendFrame(
+            framing.MSG_READ_REQUEST,
+            _timeoutPayload(deadline)
+            )
+        while True:
+            (ndefData, uidOnly) = self._collectFramedReport(stop, deadline)
+            if not uidOnly:
+                return ndefData
+            # Reported by a UID-only scan the read came in the middle of;
+            # it's kept for the scan, and the read's own answer still comes.
+            self._pendingScans.append(ndefData)
+
+    def _cancelRequest(self):
+        """Tells the Arduino to stop waiting for a tag.
+
+        Returns:
+            float: The time.monotonic() by which it should have confirmed.
+
+        """
+        self.link.sendFrame(framing.MSG_CANCEL)
+        return time.monotonic() + HANDSHAKE_TIMEOUT
+
+    def _collectFramedTag(self, stop=None, deadline=None):
+        """Collects the frames describing one tag, up to the end of the read.
+
+        If the read is stopped or runs out of time, the Arduino is told to
+        cancel it, and its end of the read is still waited for so that no
+        stray frames are left behind for the next operation.
+
+        Args:
+            stop (threading.Event): Cancels the read once set (optional).
+
+            deadline (float): The time.monotonic() by which a tag must be
+                read (optional).
+
+        Returns:
+            dict: The ndef data (data from the NFC tag) defining a record, or
+                None if no tag was read.
+
+        """
+        return self._collectFramedReport(stop, deadline)[0]
+
+    def _collectFramedReport(self, stop=None, deadline=None):
+        """Collects the frames describing one tag, and how it was read.
+
+        See _collectFramedTag.
+
+        Args:
+            stop (threading.Event): Cancels the read once set (optional).
+
+            deadline (float): The time.monotonic() by which a tag must be
+                read (optional).
+
+        Returns:
+            tuple: The ndef data, or None if no tag was read, and whether
+                the Arduino reported the tag by its UID alone, as it does
+                during a UID-only scan.
+
+        """
+        ndefData = {}
+        timeout = None
+        if stop is not None or deadline is not None:
+            timeout = STOP_POLL
+        cancelDeadline = None
+        phaseStart = time.perf_counter()
+        while True:
+            frame = self.link.readFrame(timeout=timeout)
+            if frame is None:
+                if cancelDeadline is None:
+                    if _halted(stop, deadline):
+                        cancelDeadline = self._cancelRequest()
+                elif time.monotonic() >= cancelDeadline:
+                    print("WARNING: Reader did not confirm the cancel.")
+                    return (None, False)
+                continue
+            if frame.msgType == framing.MSG_TAG_UID:
+                now = time.perf_counter()
+                instrumentation.record("readTag.waitForTag", now - phaseStart)
+                phaseStart = now
+                print("--> receiving ndef data")
+                ndefData['uid'] = framing.formatUid(frame.payload)
+            elif frame.msgType == framing.MSG_NDEF_RECORD:
+                parseNdefPayload(frame.payload.decode('latin-1'), ndefData)
+            elif frame.msgType == framing.MSG_READ_DONE:
+                if 'uid' not in ndefData:
+                    print("--> No tag was read.")
+                    return (None, False)
+                instrumentation.record(
+                    "readTag.transfer",
+                    time.perf_counter() - phaseStart
+                    )
+                print("--> Done receiving ndef data.")
+                flags = frame.payload[1] if len(frame.payload) > 1 else 0
+                return (ndefData, bool(flags & framing.SCAN_UID_ONLY))
+            else:
+                self._handleUnexpectedFrame(frame)
+
+    def _writeTagFramed(self, recordUuid, stop=None, deadline=None):
+        """Requests a tag write in binary mode and sends the record uuid.
+
+        Only the wait for a tag can be stopped. Once the Arduino has asked
+        for the payload, the write goes ahead.
+
+        Args:
+            recordUuid (str): The record ID to write to the tag.
+
+            stop (threading.Event): Cancels the write once set (optional).
+
+            deadline (float): The time.monotonic() by which a tag must be
+                presented (optional).
+
+        Returns:
+            bool: True if the tag was written, False if no tag was presented.
+
+        Raises:
+            framing.ProtocolError: if the Arduino could not write the tag.
+
+        """
+        self.link.sendFrame(
+            framing.MSG_WRITE_REQUEST,
+            _timeoutPayload(deadline)
+            )
+        interruptible = stop is not None or deadline is not None
+        waitStart = time.perf_counter()
+        writeStart = None
+        cancelDeadline = None
+        while True:
+            # The write itself gets WRITE_TIMEOUT; the wait for a tag is
+            # open-ended unless it can be stopped.
+            if writeStart is not None:
+                timeout = WRITE_TIMEOUT
+            elif interruptible:
+                timeout = STOP_POLL
+            else:
+                timeout = None
+            frame = self.link.readFrame(timeout=timeout)
+            if frame is None:
+                if writeStart is not None:
+                    raise framing.ProtocolError(
+                        "Timed out waiting for the tag write to finish."
+                        )
+                if cancelDeadline is None:
+                    if _halted(stop, deadline):
+                        cancelDeadline = self._cancelRequest()
+                elif time.monotonic() >= cancelDeadline:
+                    print("WARNING: Reader did not confirm the cancel.")
+                    return False
+                continue
+            if frame.msgType == framing.MSG_READY_FOR_PAYLOAD:
+                writeStart = time.perf_counter()
+                instrumentation.record(
+                    "writeTag.waitForTag",
+                    writeStart - waitStart
+                    )
+                print("<-- writing ndef data")
+                print("  {}".format(recordUuid))
+                self.link.sendFrame(
+                    framing.MSG_WRITE_PAYLOAD,
+                    recordUuid.encode('ascii')
+                    )
+            elif frame.msgType == framing.MSG_WRITE_DONE:
+                status = frame.payload[0] if frame.payload else None
+                if status == framing.WRITE_NO_TAG:
+                    print("No tag was presented; nothing was written.")
+                    return False
+                if status != framing.WRITE_OK:
+                    raise framing.ProtocolError("Tag write failed.")
+                print("DONE: You may remove the tag from the reader.")
+                if writeStart is not None:
+                    _reportWriteTime(writeStart)
+                return True
+            else:
+                self._handleUnexpectedFrame(frame)
+
+    def _readLine(self, stop=None, deadline=None):
+        """Reads one line of text from the Arduino.
+
+        Args:
+            stop (threading.Event): Gives up waiting once this is set
+                (optional). By default this waits forever.
+
+            deadline (float): Gives up waiting at this time.monotonic()
+                (optional).
+
+        Returns:
+            line_protocol.Line: The line, or None if stopped or out of time
+                first.
+
+        """
+        if stop is None and deadline is None:
+            return self.link.readLine()
+        while True:
+            line = self.link.readLine(timeout=STOP_POLL)
+            if line is not None:
+                return line
+            if _halted(stop, deadline):
+                return None
+
+    def _waitForSignal(self, stop=None, deadline=None):
+        """Waits for the next "nfc2py:" signal from the Arduino.
+
+        Anything else is passed to the reader's text sink.
+
+        Args:
+            stop (threading.Event): Gives up waiting once this is set
+                (optional).
+
+            deadline (float): Gives up waiting at this time.monotonic()
+                (optional).
+
+        Returns:
+            line_protocol.Line: The signal, or None if stopped or out of
+                time first.
+
+        """
+        while True:
+            line = self._readLine(stop, deadline)
+            if line is None or line.kind == line_protocol.LINE_SIGNAL:
+                return line
+            if line.kind != line_protocol.LINE_BLANK:
+                self.link.textSink.write(line.text)
+
+    def _monitorNfcForTagRead(self, stop=None, deadline=None):
         """Monitor the serial connection for tag information.
 
         The attached device could send potentially unwanted messages over the
@@ -83,27 +596,41 @@ class NfcSerialHandler(object):
         transmission type is "01". If that is the case, the ndef data is then
         collected. Otherwise, we just keep listening.
 
+        The original firmware has no way to cancel a read, so if this stops
+        early, the Arduino carries on waiting for a tag.
+
+        Args:
+            stop (threading.Event): Stops listening once this is set
+                (optional).
+
+            deadline (float): Stops listening at this time.monotonic()
+                (optional).
+
+        Returns:
+            dict: The ndef data, or None if stopped before a tag arrived.
+
         """
+        waitStart = time.perf_counter()
         while True:
-            currentLine = self.serialConnection.readline().decode('utf-8')
-            currentLine = currentLine.strip()
-            if currentLine.startswith("nfc2py:"):
-                print("--> Signal Received")
-                (_, transmissionType) = currentLine.split(":")[1:]
-                if transmissionType == "01":
-                    # Receiving NDEF Data
-                    print("--> receiving ndef data")
-                    break
-                else:
-                    msg = "Unexpected Transmission Type: '{}'"
-                    print(msg.format(transmissionType))
-            else:
-                #if the serial data isn't intended for us, I still like to print it:
-                print(currentLine)
-        ndefData = self._collectNdefData(self.serialConnection)
+            signal = self._waitForSignal(stop, deadline)
+            if signal is None:
+                return None
+            print("--> Signal Received")
+            if signal.value == line_protocol.SIGNAL_TAG_START:
+                # Receiving NDEF Data
+                print("--> receiving ndef data")
+                break
+            msg = "Unexpected Transmission Type: '{}'"
+            print(msg.format(signal.value))
+        instrumentation.record(
+            "readTag.waitForTag",
+            time.perf_counter() - waitStart
+            )
+        with instrumentation.phase("readTag.transfer"):
+            ndefData = self._collectNdefData()
         return ndefData
 
-    def _monitorNfcForTagWrite(self, recordUuid):
+    def _monitorNfcForTagWrite(self, recordUuid, stop=None, deadline=None):
         """Monitors serial connection for a write command then writes a record.
 
         The attached device could send potentially unwanted messages over the
@@ -116,39 +643,60 @@ class NfcSerialHandler(object):
         monitored until a code of "02" arrives, indicating that the write is
         finished.
 
+        Only the wait for a tag can be stopped, and only on this side; the
+        original firmware carries on waiting.
+
         Args:
             recordUuid (str): The ID of the tag
 
+            stop (threading.Event): Stops waiting for a tag once this is set
+                (optional).
+
+            deadline (float): Stops waiting for a tag at this
+                time.monotonic() (optional).
+
+        Returns:
+            bool: True if the tag was written, False if stopped first.
+
         """
+        waitStart = time.perf_counter()
+        writeStart = None
+        writeDeadline = None
         while True:
-            currentLine = self.serialConnection.readline().decode('utf-8')
-            currentLine = currentLine.strip()
-            if currentLine.startswith("nfc2py:"):
-                print("--> Signal Received")
-                #TODO: Maybe useful to have a serial parsing object that
-                #  extracts prefix, deviceID, and transmissionType in addition
-                #  to payload...
-                (_, transmissionType) = currentLine.split(":")[1:]
-                if transmissionType == "03":
-                    # The serial bus gets overwhelmed easily, let it flush:
-                    time.sleep(0.1)
-                    # Ready to write data
-                    print("<-- writing ndef data")
-                    print("  {}".format(recordUuid))
-                    self.serialConnection.write(
-                        ("uuid:{}$".format(recordUuid)).encode('ascii')
+            if writeStart is None:
+                signal = self._waitForSignal(stop, deadline)
+                if signal is None:
+                    return False
+            else:
+                signal = self._waitForSignal(deadline=writeDeadline)
+                if signal is None:
+                    raise framing.ProtocolError(
+                        "Timed out waiting for the tag write to finish."
                         )
-                elif transmissionType == "02":
-                    print("DONE: You may remove the tag from the reader.")
-                    break
-                else:
-                    msg = "Unexpected Transmission Type: '{}'"
-                    print(msg.format(transmissionType))
+            print("--> Signal Received")
+            if signal.value == line_protocol.SIGNAL_READY_FOR_PAYLOAD:
+                # Ready to write data; the Arduino waits for it.
+                writeStart = time.perf_counter()
+                instrumentation.record(
+                    "writeTag.waitForTag",
+                    writeStart - waitStart
+                    )
+                print("<-- writing ndef data")
+                print("  {}".format(recordUuid))
+                self.serialConnection.write(
+                    ("uuid:{}$".format(recordUuid)).encode('ascii')
+                    )
+                writeDeadline = time.monotonic() + WRITE_TIMEOUT
+            elif signal.value == line_protocol.SIGNAL_DONE:
+                print("DONE: You may remove the tag from the reader.")
+                if writeStart is not None:
+                    _reportWriteTime(writeStart)
+                return True
             else:
-                #if the serial data isn't intended for us, I still like to print it:
-                print(currentLine)
+                msg = "Unexpected Transmission Type: '{}'"
+                print(msg.format(signal.value))
 
-    def _collectNdefData(self, serialConnection):
+    def _collectNdefData(self):
         """
         Monitors serial bus until information from an NFC tag is broadcast.
 
@@ -167,57 +715,234 @@ class NfcSerialHandler(object):
 
         That data is then returned.
 
-        Args:
-            serialConnection (SerialConnection): The serial connection to
-                monitor.
-
         Returns:
             dict: The ndef data (data from the NFC tag) defining a record.
 
         """
         ndefData = {}
-        numNdefRecords = 0
+        textSink = self.link.textSink
+        while not applyNdefLine(self.link.readLine(), ndefData, textSink):
+            pass
+        return ndefData
+
+    def _startScanning(self, uidOnly=False):
+        """Puts the Arduino into continuous scan mode.
+
+        Args:
+            uidOnly (bool): Have each tag reported by its UID alone.
+
+        """
+        if self.link.protocol == PROTOCOL_BINARY:
+            flags = framing.SCAN_UID_ONLY if uidOnly else 0
+            self.link.sendFrame(
+                framing.MSG_SCAN_START,
+                struct.pack(">B", flags)
+                )
+        else:
+            self.serialConnection.write(b":scan:")
+
+    def _stopScanning(self):
+        """Takes the Arduino out of scan mode, and waits for it to agree.
+
+        Anything the Arduino sent before it stopped is discarded, so that the
+        next operation starts clean.
+
+        """
+        if self.link.protocol == PROTOCOL_BINARY:
+            self.link.sendFrame(framing.MSG_SCAN_STOP)
+            while True:
+                frame = self.link.readFrame(timeout=HANDSHAKE_TIMEOUT)
+                if frame is None:
+                    print("WARNING: Reader did not confirm end of scan.")
+                    return
+                if (frame.msgType == framing.MSG_SCAN_ACK and
+                        frame.payload == b"\x00"):
+                    return
+        self.serialConnection.write(b":stop:")
         while True:
-            currentLineBytes = serialConnection.readline()
-            currentLine = currentLineBytes.decode('utf-8').strip()
-            # Listen for end signal:
-            if currentLine.startswith("nfc2py:"):
-                (_, transmissionType) = currentLine.split(":")[1:]
-                if transmissionType == "02":
-                    # Finished with NDEF Data
-                    print("--> Done receiving ndef data.")
-                    break
-            # Process incoming serial (ndef) data
-            else:
-                if not currentLine.strip():
-                    #Skip over any blank lines
-                    continue
-                if not ":" in currentLine:
-                    msg = ("Unexpected data line received; no "
-                           "key/value delineation: {}")
-                    print(msg.format(currentLine))
+            line = self.link.readLine(timeout=HANDSHAKE_TIMEOUT)
+            if line is None:
+                print("WARNING: Reader did not confirm end of scan.")
+                return
+            if line.isSignal(line_protocol.SIGNAL_SCAN_STOPPED):
+                return
+
+    def _nextScannedTag(self, stop=None, idle=None):
+        """Waits for the next tag reported by the Arduino in scan mode.
+
+        Args:
+            stop (threading.Event): Stops waiting once this is set
+                (optional).
+
+            idle (callable): Called whenever STOP_POLL seconds pass with no
+                tag (optional). See scan.
+
+        Returns:
+            dict: The ndef data (data from the NFC tag) defining a record, or
+                None if stop was set before a tag arrived.
+
+        """
+        if self._pendingScans:
+            return self._pendingScans.popleft()
+        if self.link.protocol == PROTOCOL_BINARY:
+            timeout = None
+            if stop is not None or idle is not None:
+                timeout = STOP_POLL
+            while True:
+                frame = self.link.readFrame(timeout=timeout)
+                if frame is None:
+                    if stop is not None and stop.is_set():
+                        return None
+                    if idle is not None:
+                        idle()
+                        if self._pendingScans:
+                            return self._pendingScans.popleft()
                     continue
-                if currentLine.split(":")[0] == "num_ndef_records":
-                    numNdefRecords = int(currentLine.split(":")[1])
-                    msg = "Receiving {} records from the payload."
-                    print(msg.format(numNdefRecords))
-                elif currentLine.split(":")[0] == "payload":
-                    try:
-                        key = currentLine.split(":")[1]
-                        val = currentLine.split(":")[2]
-                    except IndexError:
-                        msg = ("WARNING: Malformed payload encountered; "
-                               "skipping: {}").format(currentLine)
-                        print(msg)
+                if frame.msgType == framing.MSG_TAG_UID:
+                    # Put it back for the collector, which starts at the UID
+                    self.link.pushFrame(frame)
+                    return self._collectFramedTag()
+                if frame.msgType != framing.MSG_SCAN_ACK:
+                    self._handleUnexpectedFrame(frame)
+        if idle is None:
+            return self._monitorNfcForTagRead(stop)
+        while True:
+            ndefData = self._monitorNfcForTagRead(
+                stop,
+                time.monotonic() + STOP_POLL
+                )
+            if ndefData is not None or (stop is not None and stop.is_set()):
+                return ndefData
+            idle()
+            if self._pendingScans:
+                return self._pendingScans.popleft()
+
+    def scan(self, debounce=DEFAULT_DEBOUNCE, stop=None, uidOnly=False,
+             idle=None):
+        """Scans tags continuously, yielding each one as it is tapped.
+
+        Rather than requesting one read at a time, the Arduino is told to keep
+        polling and to report every new tag on its own. The same tag showing
+        up again within the debounce window, such as a sticker being fumbled
+        on the reader, is ignored.
+
+        Scanning stops when the generator is closed:
+
+            for event in handler.scan():
+                if done:
+                    break
+
+        or, from another thread, when the stop event is set.
+
+        Args:
+            debounce (float): Seconds within which a repeat of the same tag
+                is ignored.
+
+            stop (threading.Event): Ends the scan once set (optional).
+
+            uidOnly (bool): Have the Arduino report only each tag's UID,
+                skipping the slow read of its NDEF records (optional). The
+                events then carry just the uid; use rereadTag for a tag whose
+                UID isn't enough. The original text protocol can't do this,
+                and always reads the whole tag.
+
+            idle (callable): Called with no arguments whenever STOP_POLL
+                seconds pass with no tag, on the scanning thread, while the
+                Arduino stays in scan mode (optional). It may use the reader
+                through this handler, such as to read or write a tag; a
+                read takes the next tag tapped.
+
+        Yields:
+            ScanEvent: One event per tag scanned.
+
+        """
+        print("-> Scanning continuously for NDEF data.")
+        lastSeen = {}
+        # The reader is ours until the scan ends.
+        with self.link.lock:
+            uidOnly = uidOnly and self.link.protocol == PROTOCOL_BINARY
+            self._pendingScans.clear()
+            self._startScanning(uidOnly)
+            try:
+                while True:
+                    # Tags can keep coming, so the stop isn't only checked
+                    # while waiting for one.
+                    if stop is not None and stop.is_set():
+                        return
+                    ndefData = self._nextScannedTag(stop, idle)
+                    if ndefData is None:
+                        return
+                    uid = ndefData.get('uid')
+                    if uid is None:
                         continue
-                    if key.startswith("#"):
-                        #Clean "#" from some ndef data
-                        key = key[1:]
-                    ndefData[key] = val
-                else:
-                    ndefData[currentLine.split(":")[0]] = \
-                    currentLine.split(":")[1]
-        return ndefData
+                    now = time.monotonic()
+                    if now - lastSeen.get(uid, -debounce) < debounce:
+                        lastSeen[uid] = now
+                        continue
+                    lastSeen[uid] = now
+                    yield ScanEvent(
+                        ndefData,
+                        deviceId=self.link.deviceId,
+                        readerId=self.link.readerId,
+                        uidOnly=uidOnly,
+                        )
+            finally:
+                self._stopScanning()
+
+    def rereadTag(self, uid, timeout=REREAD_TIMEOUT, stop=None):
+        """Reads the NDEF records of a tag that was just scanned.
+
+        For use during a UID-only scan, when a tag's UID alone isn't enough to
+        identify it. The tag should still be on the reader. Any other tag
+        reported in the meantime is kept for the scan to yield next, and if
+        the read itself finds a different tag, the read is asked for again.
+        A UID-only report of the same tag, still on its way from the scan,
+        is not taken for the answer.
+
+        Args:
+            uid (str): The UID the tag was scanned with.
+
+            timeout (float): Seconds to wait for the tag (optional). None
+                waits until it is read.
+
+            stop (threading.Event): Cancels the read once set (optional).
+
+        Returns:
+            dict: The ndef data (data from the NFC tag) defining a record, or
+                None if the tag was not read in time.
+
+        """
+        if self.link.protocol != PROTOCOL_BINARY:
+            # Scans on the text protocol always carry the whole tag.
+            return None
+        deadline = _deadline(timeout)
+        with self.link.lock:
+            self.link.sendFrame(
+                framing.MSG_READ_REQUEST,
+                _timeoutPayload(deadline)
+                )
+            while True:
+                (ndefData, uidOnly) = self._collectFramedReport(
+                    stop,
+                    deadline
+                    )
+                if ndefData is None:
+                    return None
+                if uidOnly:
+                    # Scan traffic; the read hasn't been answered yet.
+                    if ndefData['uid'] != uid:
+                        self._pendingScans.append(ndefData)
+                    continue
+                if ndefData['uid'] == uid:
+                    return ndefData
+                # The read found some other tag. Keep it, and read again.
+                self._pendingScans.append(ndefData)
+                if _halted(stop, deadline):
+                    return None
+                self.link.sendFrame(
+                    framing.MSG_READ_REQUEST,
+                    _timeoutPayload(deadline)
+                    )
 
     def getTagIdFromTag(self):
         """Reads an NFC tag to derive its ID.
@@ -229,7 +954,8 @@ class NfcSerialHandler(object):
         ndefData = self.readTag()
         return ndefData['uid']
 
-    def readTag(self):
+    @instrumentation.timed("readTag")
+    def readTag(self, timeout=None, stop=None):
         """Informs serial bus that we're waiting for NFC tag read, then wait.
 
         When a read signal is received, the data from that serial signal is
@@ -237,76 +963,482 @@ class NfcSerialHandler(object):
         broadcast to a RabbitMQ message queue to be picked up on and used by
         the callsheet software.
 
+        Only one operation uses the reader at a time; this waits for any other
+        to finish first.
+
+        Args:
+            timeout (float): Seconds to wait for a tag (optional). By default
+                this waits forever.
+
+            stop (threading.Event): Cancels the read once set, such as from
+                another thread (optional).
+
         Returns:
-            dict: The ndef data (data from the UFC tag).
+            dict: The ndef data (data from the UFC tag), or None if no tag was
+                read before the timeout or the stop.
 
         """
         print("-> Listening for NDEF data.")
-        # Signal for a tag Read
-        startListening = b":read:"
-        self.serialConnection.write(startListening)
-        ndefData = self._monitorNfcForTagRead()
+        deadline = _deadline(timeout)
+        with self.link.lock:
+            if self.link.protocol == PROTOCOL_BINARY:
+                ndefData = self._readTagFramed(stop, deadline)
+            else:
+                # Signal for a tag Read
+                startListening = b":read:"
+                self.serialConnection.write(startListening)
+                ndefData = self._monitorNfcForTagRead(stop, deadline)
+        if ndefData is None:
+            return None
         msg = "-> NDEF data retrieved from {} with payload {}"
         msg = msg.format(ndefData['uid'], ndefData.keys())
         print(msg)
         return ndefData
 
-    def writeTag(self, recordUuid):
+    @instrumentation.timed("writeTag")
+    def writeTag(self, recordUuid, timeout=None, stop=None):
         """Inform the serial connection that we desire to write a new tag.
 
         The serial connection (the attached Arduino) will switch into a write
         mode, awaiting the scan of an NFC tag. Once scanned, the UUID for the
         record is written to the tag.
 
+        Only one operation uses the reader at a time; this waits for any other
+        to finish first.
+
         Args:
-            recordUuid (str): The record ID to write to the tag.
+            recordUuid (str): The record ID, or a whole record encoded by
+                tag_codec, to write to the tag.
+
+            timeout (float): Seconds to wait for a tag (optional). By default
+                this waits forever.
+
+            stop (threading.Event): Cancels the write once set, if no tag has
+                been presented yet (optional).
+
+        Returns:
+            bool: True if the tag was written, False if no tag was presented
+                before the timeout or the stop.
+
+        Raises:
+            framing.ProtocolError: if the payload is too long for the
+                original firmware.
 
         """
-        # Signal for a tag Read
-        writeSignal = b":new:"
-        self.serialConnection.write(writeSignal)
-        self._monitorNfcForTagWrite(recordUuid)
+        deadline = _deadline(timeout)
+        with self.link.lock:
+            if self.link.protocol == PROTOCOL_BINARY:
+                return self._writeTagFramed(recordUuid, stop, deadline)
+            if len(recordUuid) > LEGACY_MAX_PAYLOAD:
+                raise framing.ProtocolError(
+                    "The reader's firmware can only write {} characters to "
+                    "a tag; update it to write whole records.".format(
+                        LEGACY_MAX_PAYLOAD)
+                    )
+            # Signal for a tag Write
+            writeSignal = b":new:"
+            self.serialConnection.write(writeSignal)
+            return self._monitorNfcForTagWrite(recordUuid, stop, deadline)
 
 
-class SerialConnection:
-    """A singleton serial connection to the attached Arduino.
+class ReaderConnection(object):
+    """A serial connection to one Arduino reader.
 
-    This defaults to COM port 2. Baud rate is 9600 to accommodate Arduino.
+    SerialConnection shares one of these across the process. A ReaderPool
+    holds one per reader.
 
     Args:
-        comPort (int): The COM port over which to establish a serial connection
-            (optional).
+        comPort (str): The COM port over which to establish a serial
+            connection (optional). By default the reader is searched for.
+
+        baudrate (int): The fastest rate to negotiate up to (optional).
+
+        probe (discovery.ReaderProbe): A reader already found by discovery
+            (optional). Its open connection is used instead of opening one.
+
+        readerId (str): A name for the reader, carried by its scan events
+            (optional). Defaults to the port name.
+
+        capturePath (str): Record the traffic with the reader to this
+            capture file, once connected (optional). See capture.py.
 
     Raises:
         SerialException: if a connection could not be established.
 
     """
-    # pylint: disable=invalid-name
-    class __SerialConnection:
-        """The singleton object to be issued once and only once."""
-        def __init__(self, comPort=2):
-            self.comPort = comPort
+    def __init__(self, comPort=None, baudrate=NEGOTIATED_BAUDRATE,
+                 probe=None, readerId=None, capturePath=None):
+        self.comPort = comPort
+        self.readyTime = None
+        self.protocol = PROTOCOL_LEGACY
+        self.deviceId = framing.DEVICE_ID
+        # The reader's reply to HELLO, if it speaks the binary protocol:
+        self.helloAck = None
+        # Where the traffic is being recorded, if anywhere:
+        self.capture = None
+        self.parser = framing.FrameParser()
+        self._frames = collections.deque()
+        # The text protocol's counterparts:
+        self.lineParser = line_protocol.LineParser()
+        self._lines = collections.deque()
+        # Where text from the Arduino that isn't protocol traffic goes:
+        self.textSink = line_protocol.TextSink()
+        # Held by whichever NfcSerialHandler operation is using the reader:
+        self.lock = threading.RLock()
+        if probe is None and comPort is None:
+            probe = discovery.discoverReader(DEFAULT_BAUDRATE)
+        if probe is not None:
+            self.comPort = probe.port
+            self.readyTime = probe.readyTime
+            self.connection = probe.connection
+            self._negotiate(baudrate, probe=probe)
+        else:
             self.connection = self._startSerialConnection()
+            self._negotiate(baudrate)
+        self.readerId = readerId or str(self.comPort)
+        if capturePath:
+            self.startCapture(capturePath)
 
-        def _startSerialConnection(self):
-            try:
-                serialConnection = serial.Serial(self.comPort, baudrate=9600)
-            except serial.SerialException as e:
-                msg = "No Serial connection found. Is the NFC Reader plugged in?\n"\
-                      "Is it being used by another program?"
-                raise type(e)(str(e) + msg).with_traceback(sys.exc_info()[2])
-            time.sleep(2)
-            return serialConnection
-
-        def __del__(self):
+    def _negotiate(self, baudrate, probe=None):
+        """Offers the Arduino the binary protocol and a faster baud rate.
+
+        If the Arduino doesn't answer, it is running the original
+        firmware, and the connection stays in the text protocol. If it
+        can't be reached at the faster rate, both sides fall back to the
+        default rate but keep the binary protocol.
+
+        Args:
+            baudrate (int): The fastest rate to ask for.
+
+            probe (discovery.ReaderProbe): The discovery probe that found
+                this reader (optional). Its reply to the identifying
+                HELLO stands in for asking again.
+
+        """
+        hello = struct.pack(">B", framing.PROTOCOL_VERSION)
+        if probe is None:
+            reply = self._request(framing.MSG_HELLO, hello,
+                                  framing.MSG_HELLO_ACK)
+        else:
+            reply = probe.helloAck
+        if reply is None:
+            print("Reader speaks the original text protocol.")
+            return
+        self.protocol = PROTOCOL_BINARY
+        self.helloAck = reply
+        self.deviceId = reply.deviceId
+        (_, maxBaudrate) = struct.unpack(">BI", reply.payload[:5])
+        baudrate = min(baudrate, maxBaudrate)
+        if baudrate > self.connection.baudrate:
+            reply = self._request(framing.MSG_SET_BAUD,
+                                  struct.pack(">I", baudrate),
+                                  framing.MSG_BAUD_ACK)
+            if reply is not None:
+                self.connection.baudrate = baudrate
+                reply = self._request(framing.MSG_HELLO, hello,
+                                      framing.MSG_HELLO_ACK)
+                if reply is None:
+                    print("Reader unreachable at {} baud; falling back "
+                          "to {}.".format(baudrate, DEFAULT_BAUDRATE))
+                    self.connection.baudrate = DEFAULT_BAUDRATE
+        print("Reader {} speaks the binary protocol at {} baud.".format(
+            self.deviceId,
+            self.connection.baudrate
+            ))
+
+    def _request(self, msgType, payload, replyType,
+                 timeout=HANDSHAKE_TIMEOUT):
+        """Sends a frame and waits a limited time for a particular reply.
+
+        Args:
+            msgType (int): The type of frame to send.
+
+            payload (bytes): The body of the frame to send.
+
+            replyType (int): The type of frame to wait for.
+
+            timeout (float): Seconds to wait for the reply.
+
+        Returns:
+            framing.Frame: The reply, or None if it didn't arrive in time.
+
+        """
+        self.sendFrame(msgType, payload)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            frame = self.readFrame(timeout=remaining)
+            if frame is None:
+                return None
+            if frame.msgType == replyType:
+                return frame
+
+    def sendFrame(self, msgType, payload=b""):
+        """Writes one binary frame to the Arduino.
+
+        Args:
+            msgType (int): One of the framing.MSG_* message types.
+
+            payload (bytes): The body of the message (optional).
+
+        """
+        self.connection.write(
+            framing.encodeFrame(msgType, payload, self.deviceId)
+            )
+
+    def feed(self, data):
+        """Parses bytes read from the Arduino, buffering any frames in them.
+
+        Args:
+            data (bytes): The bytes that were read.
+
+        """
+        self._frames.extend(self.parser.feed(data))
+
+    def bufferedFrame(self):
+        """Takes the next frame that has already been received, if any.
+
+        Returns:
+            framing.Frame: The frame, or None if none is buffered.
+
+        """
+        if self._frames:
+            return self._frames.popleft()
+        return None
+
+    def feedText(self, data):
+        """Parses text protocol bytes read from the Arduino, buffering lines.
+
+        Args:
+            data (bytes): The bytes that were read.
+
+        """
+        self._lines.extend(self.lineParser.feed(data))
+
+    def bufferedLine(self):
+        """Takes the next line that has already been received, if any.
+
+        Returns:
+            line_protocol.Line: The line, or None if none is buffered.
+
+        """
+        if self._lines:
+            return self._lines.popleft()
+        return None
+
+    def pushFrame(self, frame):
+        """Puts a frame back, to be returned by the next readFrame.
+
+        Args:
+            frame (framing.Frame): The frame to put back.
+
+        """
+        self._frames.appendleft(frame)
+
+    def _fill(self, queue, parser, timeout):
+        """Reads from the Arduino until a parser has produced something.
+
+        Whatever has arrived is drained in one read, rather than a byte or a
+        line at a time.
+
+        Args:
+            queue (collections.deque): Where the parser's output is kept.
+
+            parser (object): A FrameParser or LineParser.
+
+            timeout (float): Seconds to wait, or None to wait forever.
+
+        Returns:
+            bool: True if the queue has something in it.
+
+        """
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while not queue:
+            wait = None
+            if timeout is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return False
+            if parser is self.parser:
+                # Wake up in time to give up on a stalled partial frame.
+                stall = parser.stallDeadline()
+                if stall is not None:
+                    untilStall = max(0, stall - time.monotonic())
+                    if wait is None or untilStall < wait:
+                        wait = untilStall
+            waiting = self.connection.in_waiting
+            if not waiting:
+                # Bytes already waiting are read without blocking, so the
+                # timeout only matters when there are none.
+                self._setReadTimeout(wait)
+            data = self.connection.read(max(1, waiting))
+            instrumentation.count("serial.bytesIn", len(data))
+            queue.extend(parser.feed(data))
+        return True
+
+    def _setReadTimeout(self, wait):
+        """Sets the serial port's read timeout, only when it has to change.
+
+        Setting it reconfigures the port, at the cost of a system call, so
+        the timeout already set is kept while it doesn't outlast the wait
+        and is at least half of it. A read that times out early is simply
+        made again.
+
+        Args:
+            wait (float): The most seconds to block, or None to block until
+                something arrives.
+
+        """
+        current = self.connection.timeout
+        if wait is None:
+            if current is not None:
+                self.connection.timeout = None
+        elif current is None or not wait / 2 <= current <= wait:
+            self.connection.timeout = wait
+
+    def readFrame(self, timeout=None):
+        """Waits for the next binary frame from the Arduino.
+
+        Args:
+            timeout (float): Seconds to wait (optional). By default this
+                waits forever.
+
+        Returns:
+            framing.Frame: The next frame, or None if the timeout passed.
+
+        """
+        if not self._fill(self._frames, self.parser, timeout):
+            return None
+        return self._frames.popleft()
+
+    def readLine(self, timeout=None):
+        """Waits for the next line of the text protocol from the Arduino.
+
+        Args:
+            timeout (float): Seconds to wait (optional). By default this
+                waits forever.
+
+        Returns:
+            line_protocol.Line: The next line, or None if the timeout passed.
+
+        """
+        if not self._fill(self._lines, self.lineParser, timeout):
+            return None
+        return self._lines.popleft()
+
+    def startCapture(self, path):
+        """Starts recording the traffic with the reader to a capture file.
+
+        Any capture already running is stopped first. Handlers already made
+        for this reader are recorded from here on, as well as new ones.
+
+        Args:
+            path (str): The capture file to write.
+
+        """
+        self.stopCapture()
+        helloAck = None
+        if self.helloAck is not None:
+            helloAck = self.helloAck.payload.hex()
+        self.capture = capture.CaptureWriter(path, {
+            "protocol": self.protocol,
+            "deviceId": self.deviceId,
+            "baudrate": self.connection.baudrate,
+            "helloAck": helloAck,
+            "comPort": str(self.comPort),
+            "readerId": self.readerId,
+        })
+        self.connection = capture.CapturingConnection(
+            self.connection,
+            self.capture
+            )
+        print("Capturing reader traffic to {}".format(path))
+
+    def stopCapture(self):
+        """Stops recording the traffic with the reader, if it is."""
+        if self.capture is None:
+            return
+        self.connection = self.connection.connection
+        self.capture.close()
+        self.capture = None
+
+    def _startSerialConnection(self):
+        try:
+            serialConnection = serial.Serial(
+                self.comPort,
+                baudrate=DEFAULT_BAUDRATE
+                )
+        except serial.SerialException as e:
+            msg = "No Serial connection found. Is the NFC Reader plugged in?\n"\
+                  "Is it being used by another program?"
+            raise type(e)(str(e) + msg).with_traceback(sys.exc_info()[2])
+        self._waitForBoot(serialConnection)
+        return serialConnection
+
+    def _waitForBoot(self, serialConnection):
+        """Waits for the Arduino to announce that it is ready.
+
+        Opening the port resets the Arduino. Rather than sleeping for a
+        fixed time, the boot banner is watched for, giving up after
+        discovery.BOOT_TIMEOUT seconds.
+
+        Args:
+            serialConnection (serial.Serial): The newly opened port.
+
+        """
+        start = time.perf_counter()
+        if not discovery.waitForBoot(serialConnection):
+            print("No boot banner from the reader; continuing.")
+        self.readyTime = time.perf_counter() - start
+        print("Reader ready in {:.2f}s.".format(self.readyTime))
+
+    def close(self):
+        """Closes the serial connection, if it is still open."""
+        if self.connection.is_open:
             print("Closing serial connection.")
             self.connection.close()
 
+    def __del__(self):
+        self.close()
+
+
+class SerialConnection:
+    """A singleton serial connection to the attached Arduino.
+
+    By default the reader's port is discovered. The connection opens at 9600
+    baud to accommodate Arduino, then offers the binary protocol and a faster
+    rate.
+
+    Args:
+        comPort (str): The COM port over which to establish a serial
+            connection (optional). By default the reader is searched for.
+
+        baudrate (int): The fastest rate to negotiate up to (optional).
+
+        capturePath (str): Record the traffic with the reader to this
+            capture file (optional). If the connection is already open, the
+            capture starts on it, unless it is already recording there.
+
+    Raises:
+        SerialException: if a connection could not be established.
+
+    """
     instance = None
-    def __init__(self, comPort=2):
+    def __init__(self, comPort=None, baudrate=NEGOTIATED_BAUDRATE,
+                 capturePath=None):
         if not SerialConnection.instance:
-            SerialConnection.instance = \
-                SerialConnection.__SerialConnection(comPort=comPort)
+            SerialConnection.instance = ReaderConnection(
+                comPort=comPort,
+                baudrate=baudrate,
+                capturePath=capturePath
+                )
+        elif capturePath is not None:
+            current = SerialConnection.instance.capture
+            if current is None or current.path != capturePath:
+                SerialConnection.instance.startCapture(capturePath)
 
     def __getattr__(self, name):
         """Allow access to the singleton's attributes."""
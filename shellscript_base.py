@@ -24,6 +24,10 @@ class BaseShellScript(object):
     debug level printing, and a default parser to which subclasses can
     add their own commandline arguments.
 
+    Every script can also be profiled without changing it: --profile,
+    --profileSample and --traceAlloc wrap run() in the profilers from
+    profiling.py, which is only imported when they are asked for.
+
     """
     def __init__(self):
         """
@@ -58,6 +62,40 @@ class BaseShellScript(object):
             default='0',
             help='debug output level',
             )
+        self.parser.add_argument(
+            '--profile',
+            nargs='?',
+            const='',
+            metavar='PATH',
+            help='profile the script with cProfile, printing the busiest '
+                 'functions when finished, or saving the stats to PATH',
+            )
+        self.parser.add_argument(
+            '--profileSort',
+            metavar='KEY',
+            help='what the printed profile is sorted by, such as tottime '
+                 'or cumulative',
+            )
+        self.parser.add_argument(
+            '--profileSample',
+            nargs='?',
+            const=0.0,
+            type=float,
+            metavar='SECONDS',
+            help='profile by sampling every thread\'s stack this often '
+                 'rather than with cProfile; cheap enough for a long '
+                 'session. With --profile PATH, the samples are saved as '
+                 'collapsed stacks for a flame graph',
+            )
+        self.parser.add_argument(
+            '--traceAlloc', '--trace-alloc',
+            nargs='?',
+            const=0,
+            type=int,
+            metavar='N',
+            help='trace memory allocations, printing the N lines holding '
+                 'the most and the peak when finished',
+            )
 
     def registerArgs(self):
         """
@@ -77,6 +115,47 @@ class BaseShellScript(object):
         self.args = self.parser.parse_args()
         self.verbose = self.args.verbose
         self.debug = self.args.debug
+        self.run = self._wrapRun(self.run)
+
+    def _wrapRun(self, run):
+        """
+        Wraps the subclass's run() in whatever profilers the args asked for.
+
+        Subclasses can extend this to wrap run() in something of their own.
+
+        Args:
+            run (callable): The run() to wrap.
+
+        Returns:
+            callable: The wrapped run(), or run() itself if nothing was
+                asked for.
+
+        """
+        args = self.args
+        if (args.profile is None and args.profileSample is None and
+                args.traceAlloc is None):
+            return run
+        from . import profiling  #pylint: disable=import-outside-toplevel
+        profilePath = args.profile or None
+        if args.profileSample is not None:
+            run = profiling.sampled(
+                run,
+                path=profilePath,
+                interval=(args.profileSample or
+                          profiling.DEFAULT_SAMPLE_INTERVAL),
+                )
+        elif args.profile is not None:
+            run = profiling.profiled(
+                run,
+                path=profilePath,
+                sortBy=args.profileSort or profiling.DEFAULT_SORT,
+                )
+        if args.traceAlloc is not None:
+            run = profiling.allocationsTraced(
+                run,
+                limit=args.traceAlloc or profiling.DEFAULT_ALLOC_LIMIT,
+                )
+        return run
 
     def run(self):
         """
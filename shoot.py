@@ -0,0 +1,172 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+shoot.py - Loading every prop for a shoot in one pass.
+
+Before each shoot the callsheet is cleared and rebuilt with dozens of props.
+Rather than one run per prop, a ShootSession collects every tag tapped in
+one continuous scan. A prop tapped more than once is only counted once. When
+the scan ends, every record is fetched together: from the stage index or the
+cache where possible, and the rest in a single "WHERE uuid IN (...)" query.
+The result is a manifest of the whole shoot.
+
+    session = ShootSession("Scene 12")
+    for event in handler.scan(stop=done):
+        session.add(event)
+    manifest = session.manifest()
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import collections
+import datetime
+import json
+
+# local imports
+from . import records
+from . import tag_codec
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+__all__ = [
+    "ShootSession",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class ShootSession(object):
+    """The props scanned in for one shoot.
+
+    Args:
+        name (str): What the shoot is called (optional).
+
+        db (database.CallsheetDatabase): The database to resolve records from
+            (optional). Defaults to the shared database.
+
+    """
+    def __init__(self, name=None, db=None):
+        self.name = name
+        self.db = db or records.CALLSHEET_DB
+        self.started = datetime.datetime.now()
+        # Each prop's first scan, keyed by uuid (or, for a tag with no uuid
+        # on it, by its UID), in the order they arrived:
+        self.scans = collections.OrderedDict()
+        # How many times each prop was tapped, keyed the same way:
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return len(self.scans)
+
+    def add(self, event):
+        """Adds a scanned tag to the shoot.
+
+        Args:
+            event (serial_connection.ScanEvent): The scan.
+
+        Returns:
+            bool: True if the prop is new to this shoot, False if it had
+                already been scanned.
+
+        """
+        key = self._key(event)
+        self.counts[key] += 1
+        if key in self.scans:
+            return False
+        self.scans[key] = event
+        return True
+
+    @staticmethod
+    def _key(event):
+        """Picks what a scan is told apart from other scans by.
+
+        This is the uuid written on the tag. A blank tag, or one scanned by
+        its UID alone, has none, and is known by its UID instead. A record's
+        default uuid is never used, since a new one is made up every time.
+
+        Args:
+            event (serial_connection.ScanEvent): The scan.
+
+        Returns:
+            str: The key.
+
+        """
+        return event.ndefData.get('uuid') or event.uid
+
+    def resolve(self):
+        """Looks up the record for every prop in the shoot, all at once.
+
+        Tags with no uuid on them are looked up by their UID instead.
+
+        Returns:
+            tuple: The records found, in the order the props were first
+                scanned, and the keys (uuids, or UIDs for tags with no uuid)
+                for which no record was found.
+
+        """
+        found = self.db.getByUuids(
+            event.ndefData['uuid'] for event in self.scans.values()
+            if event.ndefData.get('uuid')
+            )
+        resolved = []
+        unknown = []
+        for (key, event) in self.scans.items():
+            if event.ndefData.get('uuid'):
+                recordData = found.get(key)
+            else:
+                recordData = self.db.getByTagId(event.uid)
+            if (recordData is None and
+                    not tag_codec.carriesRecord(event.ndefData)):
+                unknown.append(key)
+                continue
+            record = records.CallsheetRecord()
+            record.populateFromNdefData(event.ndefData)
+            if recordData is not None:
+                record.update(recordData)
+            resolved.append(record)
+        return (resolved, unknown)
+
+    def manifest(self):
+        """Builds the callsheet manifest for the whole shoot.
+
+        Returns:
+            dict: The shoot's name and start time, its "props" (one record
+                each, in scan order), and the uuids (or UIDs) of any tags
+                that are "unknown" to the database.
+
+        """
+        (resolved, unknown) = self.resolve()
+        return {
+            "shoot": self.name,
+            "started": self.started.strftime("%Y-%m-%d %H:%M:%S"),
+            "props": [dict(record) for record in resolved],
+            "unknown": unknown,
+        }
+
+    def writeManifest(self, path):
+        """Writes the manifest to a JSON file.
+
+        Args:
+            path (str): The file to write.
+
+        Returns:
+            dict: The manifest that was written.
+
+        """
+        manifest = self.manifest()
+        with open(path, 'w') as manifestFile:
+            json.dump(manifest, manifestFile, indent=2)
+        return manifest
@@ -0,0 +1,916 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+simulator.py - A software stand-in for the Arduino reader.
+
+A SimulatedReader plays the part of nfcPyInterface.ino on the far end of a
+Linux pseudo-terminal. The host opens the pty like any other serial port and
+can't tell the difference: ":read:", ":new:", ":scan:" and ":stop:" are
+answered with the same "nfc2py:1001:0x" signals, "uid:"/"num_ndef_records:"/
+"payload:" lines and chatter the sketch prints.
+
+By default the original firmware is simulated, which ignores binary frames.
+With protocol=PROTOCOL_BINARY, the current firmware is simulated instead: it
+answers HELLO, and from then on speaks in frames (see framing.py), including
+the baud rate change, reads and writes that can time out or be cancelled,
+and UID-only scans with rereads.
+
+Tags come from a population of SimulatedTags, handed out in turn. How long
+the RF field takes to find a tag, the serial line's speed and how long a tag
+write takes can all be set, and faults (dropped, corrupted and noise lines)
+can be injected, so scan performance can be measured and regression tested
+without the PN532 shield.
+
+    with SimulatedReader(tags=makeTags(20)) as reader:
+        handler = serial_connection.NfcSerialHandler(link=reader.connect())
+        ndefData = handler.readTag()
+
+    with SimulatedReader(protocol=serial_connection.PROTOCOL_BINARY) as reader:
+        ...
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+# extended imports
+import serial
+
+# local imports
+from . import discovery
+from . import framing
+from . import serial_connection
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+BOOT_BANNER = "NFC Callsheet Python Interface launched. Awaiting command..."
+# Seconds for the RF field to find a tag that is already on the reader:
+DEFAULT_TAG_LATENCY = 0.05
+# Seconds to erase and write an NTAG213:
+DEFAULT_WRITE_LATENCY = 0.15
+# Seconds between tags presented in scan mode:
+DEFAULT_SCAN_INTERVAL = 0.1
+# How long the sketch waits for the host's payload once it has asked:
+PAYLOAD_TIMEOUT = 2.0
+# The fastest rate the current firmware offers in its HELLO_ACK:
+MAX_BAUDRATE = 250000
+# How long the sketch waits for a HELLO at a new baud rate:
+BAUD_CONFIRM_TIMEOUT = 1.0
+# How long the sketch waits for the rest of a frame, as Serial.readBytes does:
+FRAME_READ_TIMEOUT = 1.0
+# The sketch's command buffer; longer payloads are cut short:
+SERIAL_BUFFER_SIZE = 32
+# The NDEF data area of an NTAG213, as reported on its capability container:
+DATA_AREA_SIZE = 144
+# Lines a chatty sketch might print while debugging:
+NOISE_LINES = (
+    "DEBUG: polling RF field",
+    "DEBUG: PN532 firmware 1.6",
+    "DEBUG: free RAM 812 bytes",
+)
+
+
+__all__ = [
+    "makeTags",
+    "FaultInjector",
+    "SimulatedReader",
+    "SimulatedTag",
+]
+__author__ = 'astetson'
+
+_SYNC = bytes([framing.SYNC])
+# sync, version, device ID, message type, payload length:
+_FRAME_HEADER = struct.Struct(">BBHBH")
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def makeTags(count, seed=0, withRecords=True):
+    """Makes a population of tags, each written with a record uuid.
+
+    Args:
+        count (int): The number of tags.
+
+        seed (int): Seeds the UIDs and uuids, so that the same population
+            can be made again (optional).
+
+        withRecords (bool): Write a uuid to each tag (optional). Otherwise
+            the tags are blank.
+
+    Returns:
+        list: The SimulatedTags.
+
+    """
+    rand = random.Random(seed)
+    tags = []
+    for _ in range(count):
+        uid = bytes([0x04] + [rand.randrange(256) for _ in range(6)])
+        payloads = []
+        if withRecords:
+            payloads.append("#{:05x}".format(rand.randrange(0x100000)))
+        tags.append(SimulatedTag(uid, payloads))
+    return tags
+
+
+def _printHex(data):
+    """Formats bytes the way the Adafruit library's PrintHex does.
+
+    Args:
+        data (bytes): The bytes.
+
+    Returns:
+        str: The bytes, each as " 0xXX".
+
+    """
+    return "".join(" 0x{:02X}".format(byte) for byte in data)
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class SimulatedTag(object):
+    """An NTAG213 sticker, as far as the reader can tell.
+
+    Args:
+        uid (bytes): The tag's 7 byte hardware ID.
+
+        payloads (list): The text of each NDEF record on the tag, including
+            the URI prefix code, such as "#3f2a1" (optional).
+
+    """
+    __slots__ = ("uid", "payloads")
+
+    def __init__(self, uid, payloads=None):
+        self.uid = uid
+        self.payloads = list(payloads or ())
+
+    def __repr__(self):
+        return "SimulatedTag(uid={!r}, payloads={!r})".format(
+            framing.formatUid(self.uid),
+            self.payloads
+            )
+
+    @property
+    def nfcTagId(self):
+        """str: The UID as the host stores it."""
+        return framing.formatUid(self.uid)
+
+
+class FaultInjector(object):
+    """Decides which lines sent to the host go wrong, and how.
+
+    Args:
+        dropRate (float): The chance of a line never being sent (optional).
+
+        corruptRate (float): The chance of one byte of a line being garbled
+            (optional).
+
+        noiseRate (float): The chance of a line of debug chatter being sent
+            ahead of a line (optional).
+
+        seed (int): Seeds the faults, so that a run can be repeated
+            (optional).
+
+    """
+    def __init__(self, dropRate=0.0, corruptRate=0.0, noiseRate=0.0,
+                 seed=0):
+        self.dropRate = dropRate
+        self.corruptRate = corruptRate
+        self.noiseRate = noiseRate
+        self.random = random.Random(seed)
+        self.counts = {"dropped": 0, "corrupted": 0, "noise": 0}
+
+    def apply(self, line):
+        """Passes one line, or frame, through the faults.
+
+        Args:
+            line (bytes): The line, with its line ending, or the frame.
+
+        Returns:
+            list: The lines to actually send, in order.
+
+        """
+        rand = self.random
+        lines = []
+        if self.noiseRate and rand.random() < self.noiseRate:
+            self.counts["noise"] += 1
+            noise = rand.choice(NOISE_LINES)
+            lines.append(noise.encode('ascii') + b"\r\n")
+        if self.dropRate and rand.random() < self.dropRate:
+            self.counts["dropped"] += 1
+            return lines
+        if self.corruptRate and rand.random() < self.corruptRate and \
+                len(line) > 2:
+            self.counts["corrupted"] += 1
+            garbled = bytearray(line)
+            garbled[rand.randrange(len(line) - 2)] = rand.randrange(0x20, 0x7F)
+            line = bytes(garbled)
+        lines.append(line)
+        return lines
+
+
+class SimulatedReader(object):
+    """The Arduino and its NFC shield, simulated on a pseudo-terminal.
+
+    Args:
+        tags (list): The SimulatedTags that will be put on the reader, in
+            turn (optional). By default a population of ten is made.
+
+        tagLatency (float): Seconds for each tag to be found once the
+            reader is waiting for one (optional).
+
+        writeLatency (float): Seconds to write a tag (optional).
+
+        scanInterval (float): Seconds between tags in scan mode (optional).
+
+        baudrate (int): The serial rate to simulate; each byte sent takes
+            as long as it would at this rate (optional). None sends at full
+            speed.
+
+        faults (FaultInjector): Faults to inject into what is sent to the
+            host (optional).
+
+        chatty (bool): Print the sketch's informational lines, as the real
+            one does (optional). Otherwise only protocol lines are sent.
+
+        protocol (str): The firmware to simulate (optional).
+            serial_connection.PROTOCOL_LEGACY is the original, which only
+            speaks text; PROTOCOL_BINARY is the current one, which answers
+            HELLO and speaks in frames from then on.
+
+        maxBaudrate (int): The fastest rate offered to the host, with
+            PROTOCOL_BINARY (optional).
+
+    """
+    def __init__(self, tags=None, tagLatency=DEFAULT_TAG_LATENCY,
+                 writeLatency=DEFAULT_WRITE_LATENCY,
+                 scanInterval=DEFAULT_SCAN_INTERVAL,
+                 baudrate=serial_connection.DEFAULT_BAUDRATE, faults=None,
+                 chatty=True, protocol=serial_connection.PROTOCOL_LEGACY,
+                 maxBaudrate=MAX_BAUDRATE):
+        self.tags = list(tags) if tags is not None else makeTags(10)
+        self.tagLatency = tagLatency
+        self.writeLatency = writeLatency
+        self.scanInterval = scanInterval
+        self.baudrate = baudrate
+        self.faults = faults
+        self.chatty = chatty
+        self.protocol = protocol
+        self.maxBaudrate = maxBaudrate
+        self.scanMode = False
+        self.scanUidOnly = False
+        # Whether the host has said HELLO, so that replies are framed:
+        self.binaryMode = False
+        self.counts = {"reads": 0, "writes": 0, "scans": 0}
+        self._nextTag = 0
+        # The rate being simulated right now, once the host has changed it:
+        self._rate = baudrate
+        # The tag last found in scan mode, which is still on the reader:
+        self._fieldTag = None
+        self._masterFd = None
+        self._slaveFd = None
+        self._input = bytearray()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    @property
+    def port(self):
+        """str: The device path the host should open."""
+        return os.ttyname(self._slaveFd)
+
+    def start(self):
+        """Opens the pseudo-terminal and boots the simulated sketch."""
+        (self._masterFd, self._slaveFd) = os.openpty()
+        tty.setraw(self._slaveFd)
+        self.binaryMode = False
+        self._rate = self.baudrate
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="SimulatedReader",
+            daemon=True,
+            )
+        self._thread.start()
+
+    def connect(self, baudrate=serial_connection.NEGOTIATED_BAUDRATE):
+        """Opens the host's side of the simulated reader.
+
+        The port is opened the way discovery hands over a reader. The
+        original firmware would never answer a HELLO, so none is sent to it;
+        the current firmware is said HELLO to, as discovery does, and the
+        connection then negotiates its baud rate.
+
+        Args:
+            baudrate (int): The fastest rate to negotiate up to, with
+                PROTOCOL_BINARY (optional).
+
+        Returns:
+            serial_connection.ReaderConnection: The connection.
+
+        """
+        connection = serial.Serial(
+            self.port,
+            baudrate=serial_connection.DEFAULT_BAUDRATE
+            )
+        helloAck = None
+        if self.protocol == serial_connection.PROTOCOL_BINARY:
+            helloAck = discovery.sayHello(connection)
+        probe = discovery.ReaderProbe(
+            self.port,
+            connection,
+            framing.DEVICE_ID,
+            helloAck,
+            0.0
+            )
+        return serial_connection.ReaderConnection(
+            baudrate=baudrate,
+            probe=probe,
+            readerId="simulated"
+            )
+
+    def close(self):
+        """Stops the simulated sketch and closes the pseudo-terminal."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._masterFd, self._slaveFd):
+            if fd is not None:
+                os.close(fd)
+        self._masterFd = None
+        self._slaveFd = None
+
+    def _write(self, data):
+        """Sends bytes to the host, through any faults, at the serial rate.
+
+        Args:
+            data (bytes): A line, with its line ending, or a frame.
+
+        """
+        chunks = [data]
+        if self.faults is not None:
+            chunks = self.faults.apply(data)
+        for chunk in chunks:
+            if self._rate:
+                # Ten bits on the wire per byte:
+                time.sleep(len(chunk) * 10.0 / self._rate)
+            os.write(self._masterFd, chunk)
+
+    def _send(self, text):
+        """Sends one line to the host, as Serial.println does.
+
+        Args:
+            text (str): The line, without a line ending.
+
+        """
+        self._write(text.encode('latin-1') + b"\r\n")
+
+    def _sendFrame(self, msgType, payload=b""):
+        """Sends one binary frame to the host, as sendFrame does.
+
+        Args:
+            msgType (int): One of the framing.MSG_* message types.
+
+            payload (bytes): The body of the message (optional).
+
+        """
+        self._write(framing.encodeFrame(msgType, payload))
+
+    def _log(self, text):
+        """Sends an informational LOG frame, if the sketch is being chatty.
+
+        Args:
+            text (str): The message.
+
+        """
+        if self.chatty:
+            self._sendFrame(framing.MSG_LOG, text.encode('latin-1'))
+
+    def _error(self, text):
+        """Reports a failure to the host, as reportError does.
+
+        Args:
+            text (str): The message.
+
+        """
+        if self.binaryMode:
+            self._sendFrame(framing.MSG_ERROR, text.encode('latin-1'))
+        else:
+            self._send(text)
+
+    def _info(self, text):
+        """Sends an informational line, if the sketch is being chatty.
+
+        Args:
+            text (str): The line.
+
+        """
+        if self.chatty:
+            self._send(text)
+
+    def _receive(self, timeout):
+        """Waits for bytes from the host and buffers them.
+
+        Args:
+            timeout (float): Seconds to wait.
+
+        Returns:
+            bool: True if anything arrived.
+
+        """
+        (readable, _, _) = select.select([self._masterFd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            data = os.read(self._masterFd, 1024)
+        except OSError:
+            return False
+        self._input += data
+        return bool(data)
+
+    def _readUntil(self, terminator, timeout):
+        """Reads from the host up to a terminator, as readBytesUntil does.
+
+        Args:
+            terminator (bytes): The byte to stop at; it is consumed but not
+                returned.
+
+            timeout (float): Seconds to wait for it.
+
+        Returns:
+            bytes: What came before the terminator, or None on a timeout.
+
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            end = self._input.find(terminator)
+            if end >= 0:
+                data = bytes(self._input[:end])
+                del self._input[:end + 1]
+                return data
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                return None
+            self._receive(remaining)
+
+    def _waitForInput(self, size, deadline):
+        """Waits for at least some number of bytes from the host.
+
+        Args:
+            size (int): The bytes wanted in the input buffer.
+
+            deadline (float): The time.monotonic() to give up at.
+
+        Returns:
+            bool: True if they arrived.
+
+        """
+        while len(self._input) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                return False
+            self._receive(remaining)
+        return True
+
+    def _readFrame(self, timeout=FRAME_READ_TIMEOUT):
+        """Reads the frame at the start of the input, as readFrame does.
+
+        Args:
+            timeout (float): Seconds to wait for the rest of the frame.
+
+        Returns:
+            framing.Frame: The frame, or None if it was cut short, had a bad
+                header or failed its CRC. The bytes read are consumed either
+                way.
+
+        """
+        deadline = time.monotonic() + timeout
+        if not self._waitForInput(_FRAME_HEADER.size, deadline):
+            del self._input[:]
+            return None
+        (_, version, _, _, length) = _FRAME_HEADER.unpack_from(self._input)
+        if version != framing.PROTOCOL_VERSION or \
+                length > framing.MAX_PAYLOAD:
+            del self._input[:_FRAME_HEADER.size]
+            return None
+        size = _FRAME_HEADER.size + length + 2
+        if not self._waitForInput(size, deadline):
+            del self._input[:]
+            return None
+        frames = framing.FrameParser().feed(bytes(self._input[:size]))
+        del self._input[:size]
+        return frames[0] if frames else None
+
+    def _waitForFrame(self, timeout):
+        """Waits for the next frame, skipping anything that isn't one.
+
+        Args:
+            timeout (float): Seconds to wait.
+
+        Returns:
+            framing.Frame: The frame, or None if none arrived in time.
+
+        """
+        deadline = time.monotonic() + timeout
+        while not self._stop.is_set():
+            start = self._input.find(_SYNC)
+            if start >= 0:
+                del self._input[:start]
+                frame = self._readFrame()
+                if frame is not None:
+                    return frame
+                continue
+            del self._input[:]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._receive(remaining)
+        return None
+
+    def _commandStart(self):
+        """Finds where the next command from the host starts.
+
+        Returns:
+            int: The offset of the ":" of a text command or, when the
+                current firmware is simulated, the sync byte of a frame; -1
+                if there is neither.
+
+        """
+        colon = self._input.find(b":")
+        if self.protocol != serial_connection.PROTOCOL_BINARY:
+            return colon
+        sync = self._input.find(_SYNC)
+        if colon < 0 or 0 <= sync < colon:
+            return sync
+        return colon
+
+    def _takeTag(self, timeout=None, cancellable=False):
+        """Waits for the next tag of the population to be put on the reader.
+
+        Args:
+            timeout (float): Seconds to wait, when cancellable (optional).
+
+            cancellable (bool): Wait as the current firmware does for a
+                request, which gives up after the timeout or on a CANCEL
+                from the host (optional).
+
+        Returns:
+            SimulatedTag: The tag, or None if the reader has no tags, or the
+                wait timed out or was cancelled.
+
+        """
+        tag = None
+        if self.tags:
+            tag = self.tags[self._nextTag % len(self.tags)]
+        tag = self._present(tag, timeout, cancellable)
+        if tag is not None:
+            self._nextTag += 1
+        return tag
+
+    def _present(self, tag, timeout=None, cancellable=False):
+        """Waits for the RF field to find a tag.
+
+        Args:
+            tag (SimulatedTag): The tag on the reader, or None if there is
+                none.
+
+            timeout (float): Seconds to wait, when cancellable (optional).
+
+            cancellable (bool): Give up after the timeout or on a CANCEL,
+                reporting any other frame as busy (optional).
+
+        Returns:
+            SimulatedTag: The tag, or None if it wasn't found.
+
+        """
+        if not cancellable:
+            if tag is not None and self.tagLatency:
+                time.sleep(self.tagLatency)
+            return tag
+        now = time.monotonic()
+        found = None if tag is None else now + self.tagLatency
+        expires = None if timeout is None else now + timeout
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if found is not None and now >= found:
+                return tag
+            if expires is not None and now >= expires:
+                return None
+            waits = [at - now for at in (found, expires) if at is not None]
+            frame = self._waitForFrame(min(waits) if waits else 0.05)
+            if frame is None:
+                continue
+            if frame.msgType == framing.MSG_CANCEL:
+                return None
+            self._error("Busy; cancel the current request first.")
+        return None
+
+    def _run(self):
+        """The sketch's loop(): waits for ":command:", or a frame, from the
+        host."""
+        self._send(BOOT_BANNER)
+        while not self._stop.is_set():
+            timeout = self.scanInterval if self.scanMode else 0.05
+            if self._commandStart() < 0 and not self._receive(timeout):
+                if self.scanMode:
+                    self._scanTag()
+                continue
+            start = self._commandStart()
+            if start < 0:
+                # Anything else the sketch ignores; to the original
+                # firmware, that includes binary frames.
+                del self._input[:]
+                continue
+            if self._input[start] == framing.SYNC:
+                del self._input[:start]
+                frame = self._readFrame()
+                if frame is not None:
+                    self._handleFrame(frame)
+                elif self.binaryMode:
+                    self._error("Corrupt frame received.")
+                continue
+            del self._input[:start + 1]
+            command = self._readUntil(b":", 1.0)
+            if command is None:
+                continue
+            command = command[:10].decode('latin-1')
+            if command == "read":
+                self._info("Read.")
+                self._readTag()
+            elif command == "new":
+                self._info("New record.")
+                self._writeTag()
+            elif command == "scan":
+                self._setScanMode(True)
+            elif command == "stop":
+                self._setScanMode(False)
+
+    def _handleFrame(self, frame):
+        """handleFrame(): carries out a command framed by the host.
+
+        Args:
+            frame (framing.Frame): The command.
+
+        """
+        msgType = frame.msgType
+        if msgType == framing.MSG_HELLO:
+            self.binaryMode = True
+            self._sendHelloAck()
+        elif msgType == framing.MSG_SET_BAUD:
+            self._changeBaud(frame.payload)
+        elif msgType == framing.MSG_READ_REQUEST:
+            self._readTag(framing.requestTimeout(frame.payload))
+        elif msgType == framing.MSG_WRITE_REQUEST:
+            self._writeTag(framing.requestTimeout(frame.payload))
+        elif msgType == framing.MSG_CANCEL:
+            # Nothing is waiting for a tag, so there is nothing to cancel.
+            pass
+        elif msgType == framing.MSG_SCAN_START:
+            self.scanUidOnly = bool(
+                frame.payload and frame.payload[0] & framing.SCAN_UID_ONLY
+                )
+            self._setScanMode(True)
+        elif msgType == framing.MSG_SCAN_STOP:
+            self._setScanMode(False)
+        else:
+            self._error("Unknown message type.")
+
+    def _sendHelloAck(self):
+        """Answers a HELLO with the protocol version and fastest rate."""
+        self._sendFrame(
+            framing.MSG_HELLO_ACK,
+            struct.pack(">BI", framing.PROTOCOL_VERSION, self.maxBaudrate)
+            )
+
+    def _changeBaud(self, payload):
+        """changeBaud(): switches rate, then waits for a HELLO at the new one.
+
+        If no HELLO comes, the sketch goes back to the rate it booted at.
+
+        Args:
+            payload (bytes): The SET_BAUD payload, holding the new rate.
+
+        """
+        if len(payload) != 4:
+            self._error("Bad baud rate request.")
+            return
+        (baudrate,) = struct.unpack(">I", payload)
+        if baudrate > self.maxBaudrate:
+            self._error("Baud rate not supported.")
+            return
+        self._sendFrame(framing.MSG_BAUD_ACK, payload)
+        if self.baudrate:
+            self._rate = baudrate
+        frame = self._waitForFrame(BAUD_CONFIRM_TIMEOUT)
+        if frame is not None and frame.msgType == framing.MSG_HELLO:
+            self._sendHelloAck()
+            return
+        self._rate = self.baudrate
+
+    def _setScanMode(self, enabled):
+        """setScanMode(): starts or stops reporting tags on their own.
+
+        Args:
+            enabled (bool): Start scanning.
+
+        """
+        self.scanMode = enabled
+        self._fieldTag = None
+        if not enabled:
+            self.scanUidOnly = False
+        if self.binaryMode:
+            self._sendFrame(framing.MSG_SCAN_ACK, struct.pack(">B", enabled))
+        elif enabled:
+            self._info("Scanning.")
+        else:
+            self._send("nfc2py:1001:04")
+
+    def _scanTag(self):
+        """Reports the next tag in scan mode."""
+        tag = self._takeTag()
+        if tag is not None:
+            self.counts["scans"] += 1
+            self._fieldTag = tag
+            self._reportTag(tag, uidOnly=self.scanUidOnly)
+
+    def _readTag(self, timeout=None):
+        """readNFC(): waits for a tag, then reports it.
+
+        In scan mode, the tag last scanned is still on the reader, so a read
+        finds it again, as a reread during a UID-only scan expects.
+
+        Args:
+            timeout (float): Seconds to wait for the tag, with the current
+                firmware (optional).
+
+        """
+        if not self.binaryMode:
+            self._info("Ready to read. Place NFC tag on reader.")
+            tag = self._takeTag()
+            if tag is None:
+                return
+            self.counts["reads"] += 1
+            self._reportTag(tag)
+            return
+        self._log("Ready to read. Place NFC tag on reader.")
+        if self.scanMode and self._fieldTag is not None:
+            tag = self._present(self._fieldTag, timeout, cancellable=True)
+        else:
+            tag = self._takeTag(timeout, cancellable=True)
+        if tag is not None:
+            self.counts["reads"] += 1
+        self._reportTag(tag)
+
+    def _foundCard(self, tag):
+        """Prints what the sketch says about any card it finds.
+
+        Args:
+            tag (SimulatedTag): The tag.
+
+        """
+        self._info("Found an ISO14443A card")
+        self._info("  UID Length: {} bytes".format(len(tag.uid)))
+        self._info("  UID Value: {}".format(_printHex(tag.uid)))
+        self._info("")
+
+    def _reportTag(self, tag, uidOnly=False):
+        """reportTag(): sends a tag's UID and NDEF records to the host.
+
+        Args:
+            tag (SimulatedTag): The tag, or None if none was found, which
+                only the current firmware reports.
+
+            uidOnly (bool): Send the UID alone, leaving the NDEF records
+                unread, with the current firmware (optional).
+
+        """
+        if self.binaryMode:
+            if tag is None:
+                self._sendFrame(framing.MSG_READ_DONE, b"\x00")
+                return
+            self._sendFrame(framing.MSG_TAG_UID, tag.uid)
+            if uidOnly:
+                self._sendFrame(
+                    framing.MSG_READ_DONE,
+                    struct.pack(">BB", 0, framing.SCAN_UID_ONLY)
+                    )
+                return
+            for payload in tag.payloads:
+                self._sendFrame(
+                    framing.MSG_NDEF_RECORD,
+                    payload.encode('latin-1')
+                    )
+            self._sendFrame(
+                framing.MSG_READ_DONE,
+                struct.pack(">B", len(tag.payloads))
+                )
+            return
+        self._foundCard(tag)
+        self._info("Seems to be an NTAG2xx tag (7 byte UID)")
+        self._send("nfc2py:1001:01")
+        self._send("uid:{}".format(_printHex(tag.uid)))
+        if tag.payloads:
+            self._send("num_ndef_records:{}".format(len(tag.payloads)))
+            for payload in tag.payloads:
+                self._send("payload:{}".format(payload))
+        self._send("nfc2py:1001:02")
+
+    def _writeTag(self, timeout=None):
+        """writeNewRecord(): waits for a tag, then writes the host's payload.
+
+        The payload, everything the host sent up to its "$", is written to
+        the tag as a URN URI, just as the sketch writes it.
+
+        Args:
+            timeout (float): Seconds to wait for the tag, with the current
+                firmware (optional).
+
+        """
+        if self.binaryMode:
+            self._writeTagFramed(timeout)
+            return
+        self._send("")
+        self._send("Place a Mifare NDEF tag on the reader.")
+        tag = self._takeTag()
+        if tag is None:
+            return
+        self._foundCard(tag)
+        self._info("Seems to be an NTAG2xx tag (7 byte UID)")
+        self._info("Tag is NDEF formatted. Data area size = {} "
+                   "bytes".format(DATA_AREA_SIZE))
+        self._info("Erasing previous data area " + "." * (DATA_AREA_SIZE // 4)
+                   + " Done erasing.")
+        self._send("nfc2py:1001:03")
+        payload = self._readUntil(b"$", PAYLOAD_TIMEOUT)
+        if not payload:
+            self._send("ERROR- NO INPUT TO WRITE WAS RECEIVED.")
+            return
+        payload = payload[:SERIAL_BUFFER_SIZE - 1].decode('latin-1')
+        self._info("Received # of Bytes: {}".format(len(payload)))
+        self._info("wrote:{}".format(payload))
+        if self.writeLatency:
+            time.sleep(self.writeLatency)
+        tag.payloads = ["#" + payload]
+        self.counts["writes"] += 1
+        self._info("Done writing.")
+        self._send("nfc2py:1001:02")
+
+    def _writeTagFramed(self, timeout=None):
+        """writeNewRecord() and writeFramedPayload(), with the host framing.
+
+        Args:
+            timeout (float): Seconds to wait for the tag (optional).
+
+        """
+        self._log("\nPlace a Mifare NDEF tag on the reader.")
+        tag = self._takeTag(timeout, cancellable=True)
+        if tag is None:
+            self._sendFrame(
+                framing.MSG_WRITE_DONE,
+                struct.pack(">B", framing.WRITE_NO_TAG)
+                )
+            return
+        self._log("Seems to be an NTAG2xx tag (7 byte UID)")
+        self._log(" Done erasing.")
+        self._sendFrame(framing.MSG_READY_FOR_PAYLOAD)
+        while True:
+            frame = self._waitForFrame(PAYLOAD_TIMEOUT)
+            if frame is None:
+                self._error("No payload to write was received.")
+                return
+            if frame.msgType == framing.MSG_WRITE_PAYLOAD:
+                break
+            self._error("Expected a write payload.")
+        if self.writeLatency:
+            time.sleep(self.writeLatency)
+        tag.payloads = ["#" + frame.payload.decode('latin-1')]
+        self.counts["writes"] += 1
+        self._sendFrame(
+            framing.MSG_WRITE_DONE,
+            struct.pack(">B", framing.WRITE_OK)
+            )
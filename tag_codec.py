@@ -0,0 +1,478 @@
+###############################################################################
+# Copyright (c) 2019 Allen Stetson, allen.stetson@gmail.com
+# All rights reserved. No duplication allowed.
+#
+# This file is part of nfcCallsheet.
+#
+# This software may not be copied and/or distributed without the express
+# permission of Allen Stetson.
+###############################################################################
+"""
+tag_codec.py - A compact encoding of a whole record, for writing to a tag.
+
+Normally only a record's uuid is written to its tag, and everything else is
+looked up in the database. A tag can instead carry the whole record, so that
+a scan can be resolved with no database at all. The record is packed as:
+
+    offset  size  field
+    0       1     format version (high nibble) and flags (low nibble)
+    1       n     fields, deflated if FLAG_COMPRESSED is set
+
+and each field as:
+
+    1       field ID (high 5 bits) and value kind (low 3 bits)
+    [v]     for field ID 0 only: the length and UTF-8 text of the field name
+    v       the value, per its kind
+
+where v is an unsigned LEB128 varint. Known fields are named by their ID in
+FIELD_IDS; anything else is written with its name. The packed bytes are then
+base64url encoded behind TAG_MARKER, so that the tag still holds a plain
+text URN URI, which both serial protocols already carry.
+
+"""
+###############################################################################
+# IMPORTS
+###############################################################################
+# stdlib imports
+import base64
+import calendar
+import struct
+import time
+import zlib
+
+# local imports
+from . import framing
+
+
+###############################################################################
+# GLOBALS
+###############################################################################
+TAG_FORMAT_VERSION = 1
+# Starts the text of a tag that carries a whole record. It can't begin a bare
+# uuid (hex digits and dashes) or a "key:value" pair's key, and isn't in the
+# base64url alphabet.
+TAG_MARKER = "!"
+# Set in the low nibble of the first byte when the fields are deflated:
+FLAG_COMPRESSED = 0x01
+
+# User memory of the NTAG2xx tags the reader writes, in bytes:
+TAG_CAPACITIES = {
+    "ntag213": 144,
+    "ntag215": 504,
+    "ntag216": 888,
+}
+DEFAULT_TAG_TYPE = "ntag213"
+# Bytes of a tag's memory used by the NDEF wrapping around a URI record, as
+# allowed for by the Arduino's tag writer:
+NDEF_OVERHEAD = 13
+# The writer takes the URI's length in one byte:
+MAX_URI_LENGTH = 242
+
+# Field IDs. They are part of the format; never renumber one.
+FIELD_IDS = {
+    "uuid": 1,
+    "name": 2,
+    "nfcTagId": 3,
+    "recordType": 4,
+    "scale": 5,
+    "location": 6,
+    "created": 7,
+}
+_FIELD_NAMES = dict((fieldId, name) for (name, fieldId) in FIELD_IDS.items())
+# The ID of a field written with its name:
+_NAMED_FIELD = 0
+# Fields a tag must carry to stand in for the database record:
+REQUIRED_FIELDS = ("uuid", "name", "recordType", "location")
+# Fields kept by the database itself, which mean nothing on a tag:
+_SKIPPED_FIELDS = ("modified",)
+
+# Value kinds:
+KIND_NONE = 0
+KIND_INT = 1
+KIND_TEXT = 2
+KIND_UID = 3
+KIND_TIMESTAMP = 4
+KIND_FLOAT = 5
+# The form of a created stamp. It is packed as seconds, with no time zone,
+# and unpacked the same way:
+_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+_FLOAT = struct.Struct(">d")
+
+
+__all__ = [
+    "TagFormatError",
+    "carriesRecord",
+    "decodeRecord",
+    "encodeRecord",
+    "isEncodedRecord",
+    "maxPayloadLength",
+]
+__author__ = 'astetson'
+
+
+###############################################################################
+# FUNCTIONS
+###############################################################################
+def maxPayloadLength(tagType=DEFAULT_TAG_TYPE):
+    """Works out the longest tag text that fits on a type of tag.
+
+    Args:
+        tagType (str): One of the TAG_CAPACITIES keys.
+
+    Returns:
+        int: The most characters of URI text the tag can hold.
+
+    Raises:
+        ValueError: if the tag type is not known.
+
+    """
+    if tagType not in TAG_CAPACITIES:
+        raise ValueError("Unknown tag type: {}".format(tagType))
+    return min(TAG_CAPACITIES[tagType] - NDEF_OVERHEAD, MAX_URI_LENGTH)
+
+
+def _packVarint(value, out):
+    """Appends an unsigned varint to a buffer.
+
+    Args:
+        value (int): The value, zero or more.
+
+        out (bytearray): The buffer to append to.
+
+    """
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _unpackVarint(data, offset):
+    """Reads an unsigned varint from a buffer.
+
+    Args:
+        data (bytes): The buffer.
+
+        offset (int): Where the varint starts.
+
+    Returns:
+        tuple: The value, and the offset just past it.
+
+    Raises:
+        TagFormatError: if the buffer ends partway through the varint.
+
+    """
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise TagFormatError("Tag data ends partway through a value.")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return (value, offset)
+        shift += 7
+
+
+def _packBytes(value, out):
+    """Appends a length-prefixed run of bytes to a buffer.
+
+    Args:
+        value (bytes): The bytes.
+
+        out (bytearray): The buffer to append to.
+
+    """
+    _packVarint(len(value), out)
+    out += value
+
+
+def _unpackBytes(data, offset):
+    """Reads a length-prefixed run of bytes from a buffer.
+
+    Args:
+        data (bytes): The buffer.
+
+        offset (int): Where the length starts.
+
+    Returns:
+        tuple: The bytes, and the offset just past them.
+
+    Raises:
+        TagFormatError: if the buffer ends partway through the bytes.
+
+    """
+    (length, offset) = _unpackVarint(data, offset)
+    end = offset + length
+    if end > len(data):
+        raise TagFormatError("Tag data ends partway through a value.")
+    return (bytes(data[offset:end]), end)
+
+
+def _parseUid(value):
+    """Turns an nfcTagId back into the raw UID it was formatted from.
+
+    Args:
+        value (str): The nfcTagId, such as "0x04 0xBC 0xF9".
+
+    Returns:
+        bytes: The raw UID, or None if the value isn't in that form.
+
+    """
+    parts = value.split()
+    if not parts or not all(part[:2] == "0x" for part in parts):
+        return None
+    try:
+        uidBytes = bytes(int(part, 16) for part in parts)
+    except ValueError:
+        return None
+    if framing.formatUid(uidBytes) != value:
+        return None
+    return uidBytes
+
+
+def _parseTimestamp(value):
+    """Turns a created stamp into seconds, if it is in the usual form.
+
+    Args:
+        value (str): The stamp, such as "2019-05-01 14:03:22".
+
+    Returns:
+        int: The stamp as seconds, or None if it isn't in that form.
+
+    """
+    try:
+        parsed = time.strptime(value, _TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+    seconds = calendar.timegm(parsed)
+    if seconds < 0 or time.strftime(_TIMESTAMP_FORMAT, parsed) != value:
+        return None
+    return seconds
+
+
+def _packValue(value, out):
+    """Picks the most compact kind for a value, and packs it.
+
+    Args:
+        value (object): The value.
+
+        out (bytearray): The buffer to append the packed value to.
+
+    Returns:
+        int: The kind the value was packed as.
+
+    Raises:
+        TypeError: if the value is of a type a tag can't hold.
+
+    """
+    if value is None:
+        return KIND_NONE
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        # Zigzag, so that small negatives stay small:
+        _packVarint(value * 2 if value >= 0 else -value * 2 - 1, out)
+        return KIND_INT
+    if isinstance(value, float):
+        out += _FLOAT.pack(value)
+        return KIND_FLOAT
+    if not isinstance(value, str):
+        msg = "Can't write a {} to a tag.".format(type(value).__name__)
+        raise TypeError(msg)
+    uidBytes = _parseUid(value)
+    if uidBytes is not None:
+        _packBytes(uidBytes, out)
+        return KIND_UID
+    seconds = _parseTimestamp(value)
+    if seconds is not None:
+        _packVarint(seconds, out)
+        return KIND_TIMESTAMP
+    _packBytes(value.encode('utf-8'), out)
+    return KIND_TEXT
+
+
+def _unpackValue(kind, data, offset):
+    """Reads a value of a given kind from a buffer.
+
+    Args:
+        kind (int): One of the KIND_* value kinds.
+
+        data (bytes): The buffer.
+
+        offset (int): Where the value starts.
+
+    Returns:
+        tuple: The value, and the offset just past it.
+
+    Raises:
+        TagFormatError: if the value can't be read.
+
+    """
+    if kind == KIND_NONE:
+        return (None, offset)
+    if kind == KIND_INT:
+        (value, offset) = _unpackVarint(data, offset)
+        return ((value >> 1) ^ -(value & 1), offset)
+    if kind == KIND_FLOAT:
+        if offset + _FLOAT.size > len(data):
+            raise TagFormatError("Tag data ends partway through a value.")
+        (value,) = _FLOAT.unpack_from(data, offset)
+        return (value, offset + _FLOAT.size)
+    if kind == KIND_TIMESTAMP:
+        (seconds, offset) = _unpackVarint(data, offset)
+        stamp = time.strftime(_TIMESTAMP_FORMAT, time.gmtime(seconds))
+        return (stamp, offset)
+    if kind in (KIND_TEXT, KIND_UID):
+        (value, offset) = _unpackBytes(data, offset)
+        if kind == KIND_UID:
+            return (framing.formatUid(value), offset)
+        try:
+            return (value.decode('utf-8'), offset)
+        except UnicodeDecodeError:
+            raise TagFormatError("Tag text is not valid UTF-8.")
+    raise TagFormatError("Unknown value kind {} on tag.".format(kind))
+
+
+def _packFields(record):
+    """Packs the fields of a record, uncompressed.
+
+    Args:
+        record (dict): The record.
+
+    Returns:
+        bytearray: The packed fields.
+
+    """
+    out = bytearray()
+    for (key, value) in record.items():
+        if key in _SKIPPED_FIELDS:
+            continue
+        packed = bytearray()
+        kind = _packValue(value, packed)
+        fieldId = FIELD_IDS.get(key, _NAMED_FIELD)
+        out.append((fieldId << 3) | kind)
+        if fieldId == _NAMED_FIELD:
+            _packBytes(key.encode('utf-8'), out)
+        out += packed
+    return out
+
+
+def encodeRecord(record, tagType=DEFAULT_TAG_TYPE):
+    """Packs a whole record into text to write to a tag.
+
+    The fields are deflated as well, if that makes them shorter.
+
+    Args:
+        record (dict): The record, such as a CallsheetRecord. Its
+            "modified" stamp is left out.
+
+        tagType (str): The type of tag it is to be written to, one of the
+            TAG_CAPACITIES keys (optional).
+
+    Returns:
+        str: The text to write to the tag.
+
+    Raises:
+        ValueError: if the record doesn't fit on that type of tag.
+
+    """
+    fields = _packFields(record)
+    flags = 0
+    compressed = zlib.compress(bytes(fields), 9)[2:-4]
+    if len(compressed) < len(fields):
+        fields = compressed
+        flags |= FLAG_COMPRESSED
+    data = bytes(bytearray([(TAG_FORMAT_VERSION << 4) | flags])) + fields
+    text = TAG_MARKER + base64.urlsafe_b64encode(data).decode('ascii')
+    text = text.rstrip("=")
+    limit = maxPayloadLength(tagType)
+    if len(text) > limit:
+        msg = ("Record is {} characters encoded; a {} tag holds "
+               "{}.").format(len(text), tagType, limit)
+        raise ValueError(msg)
+    return text
+
+
+def isEncodedRecord(text):
+    """Reports whether tag text holds a whole record, from encodeRecord.
+
+    Args:
+        text (str): The text of a tag's NDEF record, less its URI prefix.
+
+    Returns:
+        bool: True if the text should be read with decodeRecord.
+
+    """
+    return text.startswith(TAG_MARKER)
+
+
+def decodeRecord(text):
+    """Unpacks a whole record from the text written by encodeRecord.
+
+    Args:
+        text (str): The text of the tag's NDEF record, less its URI prefix.
+
+    Returns:
+        dict: The record's fields.
+
+    Raises:
+        TagFormatError: if the text is not a record this can read.
+
+    """
+    if not isEncodedRecord(text):
+        raise TagFormatError("Tag does not hold an encoded record.")
+    body = text[len(TAG_MARKER):].strip()
+    try:
+        data = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+    except (ValueError, TypeError):
+        raise TagFormatError("Tag data is not valid base64.")
+    if not data:
+        raise TagFormatError("Tag data is empty.")
+    version = data[0] >> 4
+    flags = data[0] & 0x0F
+    if version != TAG_FORMAT_VERSION:
+        msg = "Tag format version {} is not supported.".format(version)
+        raise TagFormatError(msg)
+    data = data[1:]
+    if flags & FLAG_COMPRESSED:
+        try:
+            data = zlib.decompress(data, -15)
+        except zlib.error:
+            raise TagFormatError("Tag data could not be decompressed.")
+    record = {}
+    offset = 0
+    while offset < len(data):
+        fieldId = data[offset] >> 3
+        kind = data[offset] & 0x07
+        offset += 1
+        if fieldId == _NAMED_FIELD:
+            (key, offset) = _unpackBytes(data, offset)
+            key = key.decode('utf-8', 'replace')
+        elif fieldId in _FIELD_NAMES:
+            key = _FIELD_NAMES[fieldId]
+        else:
+            raise TagFormatError("Unknown field {} on tag.".format(fieldId))
+        (record[key], offset) = _unpackValue(kind, data, offset)
+    return record
+
+
+def carriesRecord(ndefData):
+    """Reports whether data read off a tag can stand in for its DB record.
+
+    Args:
+        ndefData (dict): The tag data, as returned by
+            NfcSerialHandler.readTag.
+
+    Returns:
+        bool: True if every one of REQUIRED_FIELDS was on the tag.
+
+    """
+    return all(field in ndefData for field in REQUIRED_FIELDS)
+
+
+###############################################################################
+# CLASSES
+###############################################################################
+class TagFormatError(ValueError):
+    """Raised when a tag's encoded record can't be read."""